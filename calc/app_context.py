@@ -1 +1,4 @@
 stored_results = None
+pool = None
+log_task = None
+backend_task = None
@@ -0,0 +1,303 @@
+import collections
+import hashlib
+import json
+import os
+import time
+
+from data import CACHE_TTL
+
+try:
+    import redis                                        # optional, for RedisBackend
+except ImportError:
+    redis = None
+
+# url of Redis shared by servers and evaluators, e.g. redis://localhost:6379/0, empty - server works alone
+REDIS_URL = os.environ.get('CALC_REDIS_URL', '')
+# time to live of mark of processing job, it's prolonged by server of job while job is running,
+# so job of stopped server doesn't block its expression longer, seconds
+JOB_TTL = float(os.environ.get('CALC_JOB_TTL', 60))
+
+
+def get_key(expression):
+    return hashlib.sha1(expression.encode()).hexdigest()
+
+
+def get_ttl(ttl):
+    '''
+    :return: ttl in whole seconds for Redis, None if ttl is 0 - no limit
+    '''
+    return max(int(ttl), 1) if ttl else None
+
+
+class MemoryBackend:
+    '''
+    class MemoryBackend,
+    store of pids, processing jobs, results and queue of jobs shared by servers and evaluators,
+    this one is in memory of one process, it's a stand-in of RedisBackend in tests,
+    claims and processing pids expire after JOB_TTL seconds by clock as in Redis, other items don't expire
+    '''
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._pid_counter = 0
+        self._claims = dict()                   # processing expressions, key - expression key, value - [pid, expiry]
+        self._processing = dict()               # processing pids, value - [expression, expiry]
+        self._results = dict()                  # key - pid, value - result
+        self._errors = dict()                   # key - pid, value - error text
+        self._cancelled = dict()                # key - pid, value - 'cancelled' or 'timeout'
+        self._calculated = dict()               # key - expression key, value - pid of result
+        self._jobs = collections.deque()        # jobs for evaluators [pid, expression]
+
+    def next_pid(self):
+        pid = self._pid_counter
+        self._pid_counter += 1
+        return pid
+
+    def _get_expiry(self):
+        return self._clock() + JOB_TTL if JOB_TTL else float('inf')
+
+    def _expire(self):
+        now = self._clock()
+        for items in (self._claims, self._processing):
+            for key in [key for key, item in items.items() if item[1] <= now]:
+                del items[key]
+
+    def claim(self, expression, pid):
+        '''
+        mark expression as processing by job of pid if it isn't processing yet
+        :return: pid of job which processes expression
+        '''
+        self._expire()
+        key = get_key(expression)
+        if key not in self._claims:
+            self._claims[key] = [pid, self._get_expiry()]
+            self._processing[pid] = [expression, self._get_expiry()]
+        return self._claims[key][0]
+
+    def get_processing(self, expression):
+        self._expire()
+        claim = self._claims.get(get_key(expression))
+        return None if claim is None else claim[0]
+
+    def get_processing_pids(self, pids):
+        '''
+        :return: set of processing pids from pids
+        '''
+        self._expire()
+        return set(pid for pid in pids if pid in self._processing)
+
+    def refresh_processing(self, pids):
+        '''
+        prolong time to live of processing pids of running jobs and of claims of their expressions
+        :return: set of processing pids from pids
+        '''
+        pids = self.get_processing_pids(pids)
+        expiry = self._get_expiry()
+        for pid in pids:
+            item = self._processing[pid]
+            item[1] = expiry
+            claim = self._claims.get(get_key(item[0]))
+            if claim is not None and claim[0] == pid:
+                claim[1] = expiry
+        return pids
+
+    def _finish(self, pid):
+        item = self._processing.pop(pid, None)
+        if item is None:
+            return
+        claim = self._claims.get(get_key(item[0]))
+        if claim is not None and claim[0] == pid:
+            del self._claims[get_key(item[0])]
+
+    def set_result(self, pid, expression, res):
+        self._results[pid] = res
+        self._calculated[get_key(expression)] = pid
+        self._finish(pid)
+
+    def set_error(self, pid, expression, err_text):
+        self._errors[pid] = err_text
+        self._finish(pid)
+
+    def set_cancelled(self, pid, status, expression=None):
+        self._cancelled[pid] = status
+        self._finish(pid)
+
+    def get_result(self, pid):
+        return self._results.get(pid)
+
+    def get_error(self, pid):
+        return self._errors.get(pid)
+
+    def get_cancelled(self, pid):
+        return self._cancelled.get(pid)
+
+    def get_cached(self, expression):
+        pid = self._calculated.get(get_key(expression))
+        if pid is None:
+            return None
+        return self._results.get(pid)
+
+    def push_job(self, pid, expression):
+        self._jobs.append([pid, expression])
+
+    def pop_job(self, timeout=0):
+        '''
+        :return: the oldest job [pid, expression] or None if queue is empty, it doesn't wait in memory
+        '''
+        if not self._jobs:
+            return None
+        return self._jobs.popleft()
+
+    def close(self):
+        pass
+
+
+# removes claim of expression only if it's claimed by pid
+RELEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+end
+redis.call('del', KEYS[2])
+'''
+
+# prolongs claim of expression only if it's claimed by pid
+EXTEND_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('expire', KEYS[1], ARGV[2])
+end
+'''
+
+
+class RedisBackend:
+    '''
+    class RedisBackend,
+    MemoryBackend in Redis: pids are got by INCR, claims of expressions are set by SET NX, so servers on
+    different hosts share pids, results and processing expressions, evaluators pop jobs by BRPOP
+    Args:
+        client = Redis client instead of connection to url, e.g. fakeredis in tests
+    '''
+
+    def __init__(self, url, prefix='calc:', client=None):
+        if redis is None:
+            raise RuntimeError('redis package is required for CALC_REDIS_URL, pip install redis')
+        self._db = client if client is not None else redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._release = self._db.register_script(RELEASE_SCRIPT)
+        self._extend = self._db.register_script(EXTEND_SCRIPT)
+
+    def _key(self, *parts):
+        return self._prefix + ':'.join('%s' % part for part in parts)
+
+    def next_pid(self):
+        return self._db.incr(self._key('pid')) - 1
+
+    def claim(self, expression, pid):
+        claim_key = self._key('claim', get_key(expression))
+        while True:
+            if self._db.set(claim_key, pid, nx=True, ex=get_ttl(JOB_TTL)):
+                self._db.set(self._key('processing', pid), expression, ex=get_ttl(JOB_TTL))
+                return pid
+            other_pid = self._db.get(claim_key)
+            if other_pid is not None:           # else claim is released right now, try again
+                return int(other_pid)
+
+    def get_processing(self, expression):
+        pid = self._db.get(self._key('claim', get_key(expression)))
+        return None if pid is None else int(pid)
+
+    def get_processing_pids(self, pids):
+        pids = list(pids)
+        if not pids:
+            return set()
+        pipe = self._db.pipeline(transaction=False)
+        for pid in pids:
+            pipe.exists(self._key('processing', pid))
+        return set(pid for pid, exists in zip(pids, pipe.execute()) if exists)
+
+    def refresh_processing(self, pids):
+        if not JOB_TTL:
+            return self.get_processing_pids(pids)
+        pids = list(pids)
+        if not pids:
+            return set()
+        pipe = self._db.pipeline(transaction=False)
+        for pid in pids:
+            pipe.get(self._key('processing', pid))
+            pipe.expire(self._key('processing', pid), get_ttl(JOB_TTL))
+        items = pipe.execute()
+        refreshed = set()
+        # claim is prolonged too, otherwise other server starts expression of long job again
+        pipe = self._db.pipeline(transaction=False)
+        for pid, expression, exists in zip(pids, items[::2], items[1::2]):
+            if exists:
+                refreshed.add(pid)
+                self._extend(keys=[self._key('claim', get_key(expression.decode()))], args=[pid, get_ttl(JOB_TTL)],
+                             client=pipe)
+        pipe.execute()
+        return refreshed
+
+    def _set(self, name, pid, value, expression=None):
+        '''
+        store value of finished pid and release claim of its expression in one transaction,
+        expression is read from processing pid only if it's unknown, e.g. job of other server is cancelled
+        '''
+        processing_key = self._key('processing', pid)
+        if expression is None:
+            expression = self._db.get(processing_key)
+            expression = None if expression is None else expression.decode()
+        pipe = self._db.pipeline()
+        pipe.set(self._key(name, pid), value, ex=get_ttl(CACHE_TTL))
+        if name == 'result':
+            pipe.set(self._key('calculated', get_key(expression)), pid, ex=get_ttl(CACHE_TTL))
+        claim_key = self._key('claim', get_key(expression) if expression is not None else '')
+        self._release(keys=[claim_key, processing_key], args=[pid], client=pipe)
+        pipe.execute()
+
+    def set_result(self, pid, expression, res):
+        self._set('result', pid, json.dumps(res), expression)
+
+    def set_error(self, pid, expression, err_text):
+        self._set('error', pid, err_text, expression)
+
+    def set_cancelled(self, pid, status, expression=None):
+        self._set('cancelled', pid, status, expression)
+
+    def get_result(self, pid):
+        res = self._db.get(self._key('result', pid))
+        return None if res is None else json.loads(res)
+
+    def get_error(self, pid):
+        err_text = self._db.get(self._key('error', pid))
+        return None if err_text is None else err_text.decode()
+
+    def get_cancelled(self, pid):
+        status = self._db.get(self._key('cancelled', pid))
+        return None if status is None else status.decode()
+
+    def get_cached(self, expression):
+        pid = self._db.get(self._key('calculated', get_key(expression)))
+        if pid is None:
+            return None
+        return self.get_result(int(pid))
+
+    def push_job(self, pid, expression):
+        self._db.lpush(self._key('jobs'), json.dumps([pid, expression]))
+
+    def pop_job(self, timeout=0):
+        '''
+        :return: the oldest job [pid, expression] or None if queue is empty after timeout seconds
+        '''
+        item = self._db.brpop(self._key('jobs'), timeout=max(int(timeout), 1))
+        return None if item is None else json.loads(item[1])
+
+    def close(self):
+        self._db.close()
+
+
+def get_backend(url=REDIS_URL):
+    '''
+    :return: RedisBackend if url is set, otherwise None - server works alone without backend
+    '''
+    if not url:
+        return None
+    return RedisBackend(url)
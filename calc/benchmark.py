@@ -0,0 +1,235 @@
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import calc
+from calc import Tree
+
+# metrics of cost, lower is better, run fails if one of them grows more than threshold
+COST_METRICS = ['parse_us_per_node', 'optimize_us_per_node', 'calculate_us_per_node', 'compile_us_per_node',
+                'execute_us_per_node', 'peak_bytes_per_node']
+
+
+def generate_expression(length, seed=0, max_depth=8, operations='+-*/'):
+    '''
+    generate valid math expression with about length symbols,
+    brackets are nested up to max_depth levels, operations are chosen from operations
+    '''
+    rnd = random.Random(seed)
+    parts = []
+    size = 0
+    depth = 0
+    while size < length:
+        if depth < max_depth and rnd.randint(0, 4) == 0:
+            parts.append('(')
+            depth += 1
+        parts.append(str(rnd.randint(1, 9999)))
+        if depth and rnd.randint(0, 3) == 0:
+            parts.append(')')
+            depth -= 1
+        parts.append(operations[rnd.randint(0, len(operations) - 1)])
+        size += len(parts[-1]) + len(parts[-2]) + 1
+    parts.append('1')
+    parts.append(')' * depth)
+    return ''.join(parts)
+
+
+def generate_deep_expression(depth, seed=0, operations='+-*/'):
+    '''
+    generate valid math expression with depth nested brackets, like stress_test.Generator: (((a) op b) op c)...
+    '''
+    rnd = random.Random(seed)
+    parts = ['(' * depth, str(rnd.randint(1, 9999))]
+    for i in range(depth):
+        parts.append(')%s%s' % (operations[rnd.randint(0, len(operations) - 1)], rnd.randint(1, 9999)))
+    return ''.join(parts)
+
+
+# cases of suite: name, generator, its arguments, sizes are scaled by --scale
+CASES = [
+    ['mixed', generate_expression, {'length': 30000}],
+    ['sum', generate_expression, {'length': 30000, 'operations': '+-'}],
+    ['product', generate_expression, {'length': 30000, 'operations': '*/'}],
+    ['flat', generate_expression, {'length': 30000, 'max_depth': 0}],
+    ['deep', generate_deep_expression, {'depth': 10000}],
+]
+
+
+def count_nodes(node):
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children)
+    return count
+
+
+def best_time(func, repeat):
+    '''
+    :return: the best time of func() in seconds from repeat runs
+    '''
+    best = None
+    # as in timeit, gc runs make time of creation of many objects unstable
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start_time = time.perf_counter()
+            func()
+            run_time = time.perf_counter() - start_time
+            if best is None or run_time < best:
+                best = run_time
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+
+def bench_expression(expression, repeat=3):
+    '''
+    measure parse, optimize, calculate, compile and execute of expression without delay of slow operations
+    :return: dict of metrics, times are per Node of parsed tree
+    '''
+    delay = calc.DELAY
+    calc.DELAY = 0
+    try:
+        tree = Tree(expression)
+        assert tree.is_valid
+        nodes = count_nodes(tree._root)
+        parse_time = best_time(lambda: Tree(expression), repeat)
+        trees = [Tree(expression) for i in range(repeat)]
+        optimize_time = best_time(lambda: trees.pop().optimize(), repeat)
+        calculate_time = best_time(tree.calculate, repeat)
+        compile_time = best_time(tree.compile, repeat)
+        program = tree.compile()
+        execute_time = best_time(program.execute, repeat)
+        assert repr(program.execute()) == repr(tree.calculate())
+    finally:
+        calc.DELAY = delay
+    tracemalloc.start()
+    try:
+        Tree(expression).compile()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    us_per_node = 1e6 / nodes
+    return {
+        'length': len(expression),
+        'nodes': nodes,
+        'parse_symbols_per_s': len(expression) / parse_time,
+        'parse_us_per_node': parse_time * us_per_node,
+        'optimize_us_per_node': optimize_time * us_per_node,
+        'calculate_us_per_node': calculate_time * us_per_node,
+        'compile_us_per_node': compile_time * us_per_node,
+        'execute_us_per_node': execute_time * us_per_node,
+        'peak_bytes_per_node': peak / nodes,
+    }
+
+
+def run_suite(cases=CASES, repeat=3, scale=1.0, seed=0):
+    '''
+    :input: scale - multiplier of sizes of expressions
+    :return: dict of metrics of each case, see bench_expression()
+    '''
+    results = dict()
+    for name, generator, args in cases:
+        args = dict(args)
+        for key in ('length', 'depth'):
+            if key in args:
+                args[key] = max(int(args[key] * scale), 1)
+        results[name] = bench_expression(generator(seed=seed, **args), repeat)
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    '''
+    :input: threshold - allowed relative growth of cost metrics, e.g. 0.2 - 20%
+    :return: list of [case, metric, baseline value, value] of metrics which grew more than threshold
+    '''
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        base_metrics = baseline.get(name)
+        if not base_metrics:
+            continue
+        for metric in COST_METRICS:
+            if metric in metrics and base_metrics.get(metric) and \
+                    metrics[metric] > base_metrics[metric] * (1 + threshold):
+                regressions.append([name, metric, base_metrics[metric], metrics[metric]])
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print('%-10s %10s %10s %10s %10s %10s %10s %10s %10s' % ('case', 'nodes', 'parse', 'optimize', 'calculate',
+                                                             'compile', 'execute', 'bytes', 'Msym/s'))
+    for name, metrics in results.items():
+        print('%-10s %10s %10.3f %10.3f %10.3f %10.3f %10.3f %10.1f %10.2f' % (
+            name, metrics['nodes'], metrics['parse_us_per_node'], metrics['optimize_us_per_node'],
+            metrics['calculate_us_per_node'], metrics['compile_us_per_node'], metrics['execute_us_per_node'],
+            metrics['peak_bytes_per_node'], metrics['parse_symbols_per_s'] / 1e6))
+        if baseline and name in baseline:
+            print('%-10s %10s %s' % ('', 'change', ' '.join(
+                '%9.1f%%' % ((metrics[metric] / baseline[name][metric] - 1) * 100)
+                if baseline[name].get(metric) else '%10s' % '-' for metric in COST_METRICS)))
+
+
+def bench_parse(lengths, repeat=3):
+    '''
+    measure Tree parse time for expressions of each length
+    :return: list of [length, best time in seconds]
+    '''
+    results = []
+    for length in lengths:
+        expression = generate_expression(length)
+        results.append([len(expression), best_time(lambda: Tree(expression), repeat)])
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark parsing and calculation of math expressions.')
+    parser.add_argument('--repeat', metavar='N', type=int, default=7,
+                        help='count of runs of each measurement, the best time is used')
+    parser.add_argument('--scale', metavar='X', type=float, default=1.0,
+                        help='multiplier of sizes of expressions in cases')
+    parser.add_argument('--seed', metavar='N', type=int, default=0, help='seed of generated expressions')
+    parser.add_argument('--save', metavar='PATH', help='save results as baseline to json file')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='compare results with baseline from json file, exit code is 1 if there is regression')
+    parser.add_argument('--threshold', metavar='X', type=float, default=0.2,
+                        help='allowed relative growth of costs per node and memory compared with baseline')
+    parser.add_argument('--scaling', action='store_true',
+                        help='only print parse time of expressions growing by 4 times up to --max_length')
+    parser.add_argument('--max_length', metavar='N', type=int, default=4096000,
+                        help='maximum length of expression for --scaling')
+    args = parser.parse_args()
+    if args.scaling:
+        lengths = []
+        length = 1000
+        while length <= args.max_length:
+            lengths.append(length)
+            length *= 4
+        print('%12s %12s %12s' % ('length', 'parse, s', 'us/symbol'))
+        for length, run_time in bench_parse(lengths, args.repeat):
+            print('%12s %12.4f %12.4f' % (length, run_time, run_time * 1e6 / length))
+        sys.exit(0)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    results = run_suite(repeat=args.repeat, scale=args.scale, seed=args.seed)
+    print('costs per node: us of parse, optimize, calculate, compile, execute, bytes of peak memory')
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline:
+        regressions = find_regressions(results, baseline, args.threshold)
+        for name, metric, base_value, value in regressions:
+            print('REGRESSION %s %s: %.4f -> %.4f (+%.1f%%)' % (name, metric, base_value, value,
+                                                                 (value / base_value - 1) * 100))
+        if regressions:
+            sys.exit(1)
@@ -1,400 +1,1537 @@
-import re
-import time
-
-# delay in operation / to emit long cpu calculations
-DELAY = 30
-
-# only integer values is supported, float delimiter , or . aren't supported
-# all supported operations
-operations = [{'(', ')'},
-              {'/', '*'},
-              {'+', '-'}
-              ]
-all_supported_operations = set()
-for op_set in operations:
-    all_supported_operations.update(op_set)
-
-
-def get_operation_priority(operation):
-    for i in range(len(operations)):
-        if operation in operations[i]:
-            return i
-    return -1  # not supported operation
-
-
-class ErrorLvls:
-    INFO = 0
-    WARN = 1
-    ERR = 2
-    OFF = 3
-
-
-USED_MIN_ERR_LEVEL = ErrorLvls.OFF
-err_texts = ['INFO', 'WARN', 'ERR', 'OFF']
-
-
-class Logger:
-    def __init__(self):
-        self._log_fd = None
-
-    def init(self, log_file_name='log.txt'):
-        if USED_MIN_ERR_LEVEL == ErrorLvls.OFF:
-            return
-        self._log_fd = open(log_file_name, 'w+')
-
-    def log(self, message_str='', error_lvl=ErrorLvls.INFO, context=''):
-        if USED_MIN_ERR_LEVEL == ErrorLvls.OFF:
-            return
-        if USED_MIN_ERR_LEVEL <= error_lvl:
-            log_info = '\n[%s] %s: %s\n' % (err_texts[error_lvl], ('in %s ' % context) if context else '', message_str)
-            if self._log_fd:
-                self._log_fd.write(log_info)
-            else:
-                print(log_info)
-
-    def stop(self):
-        if USED_MIN_ERR_LEVEL == ErrorLvls.OFF:
-            return
-        if self._log_fd:
-            self._log_fd.close()
-            self._log_fd = None
-
-    def __del__(self):
-        if USED_MIN_ERR_LEVEL == ErrorLvls.OFF:
-            return
-        self.stop()
-
-
-logger = Logger()
-
-
-def log(message_str='', error_lvl=ErrorLvls.INFO, context=''):
-    logger.log(message_str, error_lvl, context)
-
-
-class Node:
-    '''
-    class Node,
-    Note: used in class Tree
-    each Node contains complex or simple math expression,
-    if expression is complex, split it to childs and etc(recursive)
-    res contains result of math expression or processing status or error
-    Args:
-        _level = deep level in Tree
-        _expression_str = expression for this Node
-        _operation = operation for this Node to aplly res to parent result
-        children = elements of subtree
-        is_simple = if Node contains only number in _expression_str
-        is_valid = flag, set during parsing _expression_str & calculation, default True
-        res = calculated result of _expression_str( depend recursive on all children's res and _operation)
-    Attributes:
-        max_level - maximum deep level for all created Node objects
-    '''
-    max_level = 0
-
-    def __init__(self, expression_str, operation=None, level=0):
-        self._level = level
-        self._expression_str = expression_str
-        self._operation = operation
-        self.children = []
-        self.is_simple = False
-        self.is_valid = True
-        self.res = None
-        self._pre_parse()
-
-    def get_expression_str(self):
-        return self._expression_str
-
-    def _pre_parse(self):
-        '''
-        check if expression is simple or not,
-        check simple validation
-        '''
-        for op_set in operations:
-            for op in op_set:
-                if op in self._expression_str:
-                    self.is_simple = False
-                    return
-        self.is_simple = True
-        self.is_valid = bool(re.match('^[0-9]+$', self._expression_str) != None)
-        if not self.is_valid:
-            log('invalid node = %s in expression, node should contain only digits in 0..9!' %
-                self._expression_str, ErrorLvls.ERR, 'Node:_pre_parse()')
-
-    def remove_senseless_brackets(self):
-        '''
-        remove repetable brackets at begin and end
-        :return: expression without senseless brackets
-        '''
-        pattern = '^\(+'
-        double_brackets = re.search(pattern, self._expression_str)
-        if not double_brackets:
-            return
-        double_brackets_str = double_brackets.group(0)
-        close_double_brackets_str = ')' * len(double_brackets_str)
-        if self._expression_str.endswith(close_double_brackets_str):
-            self._expression_str = self._expression_str.replace(close_double_brackets_str, ')', 1)
-            self._expression_str = self._expression_str.replace(double_brackets_str, '(', 1)
-
-        # remove last brackets at begin and end if it's possible
-        if self._expression_str[-1] == ')' and \
-                self._expression_str[0] == '(':
-            # check if this brackets is a pair
-            candidate = self._expression_str[1:-1]
-            if self._expression_str.count(')') == 1:
-                self._expression_str = candidate
-            else:
-                close_index = candidate.find(')')
-                open_index = candidate.find('(')
-                close_index_end = candidate.rfind(')')
-                open_index_end = candidate.rfind('(')
-
-                if close_index == -1 or open_index == -1:
-                    return
-                if close_index > open_index and \
-                        close_index_end > open_index_end:
-                    self._expression_str = candidate
-
-    def parse(self, node_creation, is_first_run=True):
-        '''
-        :input: node_creation - functor for create new Node;
-        is_first_run - first or second run of parse func( depend on operation priority in expression)
-        parse node expression and create subtree for this Node
-        :return: -1 if parsing errors or nothing
-        '''
-        if not self.is_valid:
-            return -1
-        if self.is_simple:  # no need to parse simple nodes
-            return
-
-        # if expression like (((some expression))) - do remove brackets at begin & end
-        self.remove_senseless_brackets()
-        self._pre_parse()
-        if self.is_simple:
-            return
-
-        node_expression = ''
-        open_bracket_counter = 0
-        close_bracket_counter = 0
-        node_operation = None
-
-        def add_node(expression, operation):
-            node = node_creation(expression, operation, self._level + 1)
-            if not node.is_valid:
-                self.is_valid = False
-                return -1
-            self.add_child(node)
-            if node.parse(node_creation) == -1:
-                self.is_valid = False
-                return -1
-
-        for symbol in self._expression_str:
-            if symbol in all_supported_operations:
-                if symbol in operations[0]:                              # brakets
-                    node_expression += str(symbol)
-                    if symbol == ')':
-                        if open_bracket_counter == 0 or open_bracket_counter <= close_bracket_counter:
-                            log('close braket without open braket', ErrorLvls.ERR, 'Node:parse()')
-                            self.res = 'error in expression'
-                            self.is_valid = False
-                            return -1
-                        else:
-                            close_bracket_counter += 1
-                    else:
-                        open_bracket_counter += 1
-                else:                                               # *, /, +, -
-                    if is_first_run and symbol in operations[2] or\
-                            not is_first_run and symbol in operations[1]:  # first run - only +, - processed, second * /
-                        if open_bracket_counter == 0 or\
-                                close_bracket_counter == open_bracket_counter:  # properly brackets
-                            if add_node(node_expression, node_operation) == -1:
-                                return -1
-                            node_operation = symbol
-                            # reset
-                            close_bracket_counter = 0
-                            open_bracket_counter = 0
-                            node_expression = ''
-                    if node_expression != '':       # node doesn't created
-                        node_expression += str(symbol)   # will be parsed after removing brackets
-            else:                                           # number
-                if re.match('^[0-9]$', symbol):
-                    node_expression += str(symbol)
-                else:                                       # invalid symbol
-                    self.is_valid = False
-                    return -1
-
-        if node_expression != '' and node_expression != self._expression_str:
-            if add_node(node_expression, node_operation) == -1:
-                return -1
-
-        # all operations +- processed,
-        # parse second time for operations * /
-        if not self.is_simple and len(self.children) == 0 and is_first_run:
-            if self.parse(node_creation, not is_first_run) == -1:
-                self.is_valid = False
-                return -1
-
-    def add_child(self, child):
-        if not isinstance(child, Node):
-            log('err in Node::add_child(): invalid child type\n')
-            return
-        self.children.append(child)
-        if Node.max_level < child._level:
-            Node.max_level = child._level
-
-    def print_node(self):
-        log('|', ErrorLvls.INFO)
-        log('%s--> (%s) %s [%s] res = %s' %
-            ('-' * 8 * self._level, self._operation, self._expression_str, self.is_simple, self.res),
-            ErrorLvls.INFO)
-        for child in self.children:
-            child.print_node()
-
-    def do_operation(self, res=0, val=0):
-        if not res:
-            res = 0
-        if not self._operation and res == 0:
-            res = val
-            return res
-        if self._operation == '-':
-            return res - float(val)
-        if self._operation == '+':
-            return res + float(val)
-        if self._operation == '*':
-            return res * float(val)
-        if self._operation == '/':
-            # add delay to emit long cpu calculations
-            time.sleep(DELAY)
-            if val != 0:
-                return float(res) / float(val)
-            else:
-                log('division by zero!', ErrorLvls.ERR, 'Node::calculate()')
-                raise
-        return res
-
-    def calculate(self, parent=None):
-        '''
-        :input: parent - parent Node
-        calculate math expression result for all childs recursive
-        and apply calculated node result with self operation to parent result
-        fill res for all Nodes in subtree and change parent Node res
-        :return: -1 if calculating errors or nothing
-        '''
-        if not self.is_valid:
-            self.res = None
-            return -1
-        if self.is_simple:
-            self.res = int(self._expression_str)
-            if not parent:                          # is root
-                return
-            try:
-                parent.res = self.do_operation(parent.res, int(self._expression_str))
-            except:
-                self.is_valid = False
-                self.res = None
-                return -1
-        else:
-            for child in self.children:
-                child.calculate(self)
-                if not child.is_valid:
-                    self.res = None
-                    return -1
-                if not child.is_simple:
-                    try:
-                        self.res = child.do_operation(self.res, child.res)
-                    except:
-                        log('error in operation %s expr = %s=%s res = %s' %
-                            (child._operation, child._expression_str, child.res, self.res),
-                            ErrorLvls.ERR, 'Node:calculate()')
-                        self.is_valid = False
-                        self.res = None
-                        return -1
-
-
-class Tree:
-    '''
-    :class: Tree,
-    use to parse math expression
-    root contains the whole math expression,
-    if expression is complex, split it to childs and etc
-    :return: result of math expression or processing status or error
-    '''
-
-    def __init__(self, expression_str):
-        self._root = Node(expression_str)
-        self.is_valid = True
-        self.max_height = 0
-        self._res = None
-        if not self._root.is_valid:
-            self.is_valid = False
-        else:
-            self.max_height = 1
-            self._res = 0
-            if self._root.is_simple:
-                self._res = int(expression_str)
-            else:
-                self.parse()
-
-    def parse(self):
-        if not self.is_valid:
-            return -1
-
-        def create_node(val, s, lvl):
-            return Node(val, s, lvl)
-
-        if self._root.parse(create_node) == -1:
-            self.is_valid = False
-            return -1
-        self.max_height = Node.max_level
-
-    def print_tree(self):
-        if not self.is_valid:
-            return -1
-        self._root.print_node()
-
-    def calculate(self):
-        if not self.is_valid:
-            log('invalid expression = %s' % self._root.get_expression_str(), ErrorLvls.ERR, 'Tree:calculate')
-            return None
-        self._root.calculate()
-        self._res = self._root.res
-        return self._res
-
-
-def is_expression_valid(expression_s):
-    if expression_s == '':
-        return False, 'expression is empty string!'
-    open_brackets_count = expression_s.count('(')
-    close_brackets_count = expression_s.count(')')
-    is_valid = open_brackets_count == close_brackets_count
-    err_text = ''
-    if not is_valid:
-        err_text = "count of '(' != count of ')'!"
-    return is_valid, err_text
-
-
-def parse_expression(expression_s, pid, delay=30):
-    global DELAY
-    DELAY = delay
-    logger.init('./log_%s.txt' % pid)
-    expression_s = expression_s.replace(' ', '')  # remove whitespaces
-    log('expression = %s' % expression_s, ErrorLvls.INFO, 'parse_expression()')
-    is_valid, err_text = is_expression_valid(expression_s)
-    res = None
-    err = None
-    if not is_valid:
-        log('invalid expression %s\n' % err_text, ErrorLvls.ERR, 'parse_expression()')
-        err = err_text
-    else:
-        tree = Tree(expression_s)
-        if not tree.is_valid:
-            err = 'error in parsing'
-        else:
-            # tree.print_tree()
-            res = tree.calculate()
-            if not res:
-                err = 'error in calculating'
-            # tree.print_tree()
-            log('res=%s tree_heigh = %s' % (res, tree.max_height), ErrorLvls.INFO, 'Tree:parse_expression()')
-    logger.stop()
-    return [res, err]
+from array import array
+import asyncio
+from collections import OrderedDict
+import gc
+import hashlib
+import heapq
+from itertools import islice, repeat
+import math
+import operator
+import re
+import sys
+import time
+
+try:
+    import numpy                                        # optional, for vectorized calculation of templates
+except ImportError:
+    numpy = None
+
+from logs import ErrorLvls, log, logger
+
+# delay in operation / to emit long cpu calculations
+DELAY = 30
+# shared counters [done, total] of slow operations of running program, it's set in worker processes
+progress = None
+# prefix of keys of expressions received by StreamParser, their text isn't kept
+STREAM_PREFIX = 'stream:'
+
+# only integer values is supported, float delimiter , or . aren't supported
+# all supported operations
+operations = [{'(', ')'},
+              {'/', '*'},
+              {'+', '-'}
+              ]
+all_supported_operations = set()
+for op_set in operations:
+    all_supported_operations.update(op_set)
+
+
+operation_funcs = {'+': operator.add, '-': operator.sub, '*': operator.mul}
+operation_bytes = {None: b' ', '+': b'+', '-': b'-', '*': b'*', '/': b'/'}
+
+
+def get_operation_priority(operation):
+    for i in range(len(operations)):
+        if operation in operations[i]:
+            return i
+    return -1  # not supported operation
+
+
+digits = set('0123456789')
+name_start = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_')
+token_pattern = re.compile(r'\s*([0-9]+|[A-Za-z_][A-Za-z0-9_]*|->|\S)')
+
+
+class ParseError(Exception):
+    pass
+
+
+def tokenize(expression_str):
+    '''
+    split math expression to tokens in a single pass,
+    whitespaces between tokens are skipped
+    :return: iterator of tokens - numbers, names, operations, brackets, commas and ->
+    (unsupported symbols are returned as is and rejected by Parser)
+    '''
+    for match in token_pattern.finditer(expression_str):
+        yield match.group(1)
+
+
+class StreamTokenizer:
+    '''
+    class StreamTokenizer,
+    incremental tokenizer for expression received by chunks,
+    number, name or - at the end of chunk is kept until the next chunk, because it can be continued there
+    '''
+
+    def __init__(self):
+        self._tail = ''
+
+    def feed(self, text):
+        '''
+        :return: iterator of complete tokens of text
+        '''
+        text = self._tail + text
+        head = text.rstrip('0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_')
+        if head.endswith('-'):                          # begin of ->
+            head = head[:-1]
+        self._tail = text[len(head):]
+        return tokenize(head)
+
+    def finish(self):
+        '''
+        :return: iterator of the rest tokens
+        '''
+        tail = self._tail
+        self._tail = ''
+        return tokenize(tail)
+
+
+class Node:
+    '''
+    class Node,
+    Note: used in class Tree
+    each Node contains number or chain of children with operations of the same priority,
+    e.g. 1 + 2*3 - (4 - 5) is chain [1, +2*3, -(4 - 5)], 2*3 and (4 - 5) are chains too
+    res contains result of math expression or processing status or error
+    Args:
+        _expression_str = number for simple Node, None for chain
+        _operation = operation for this Node to aplly res to parent result
+        children = elements of chain, empty for simple Node
+        is_simple = if Node contains only number
+        is_valid = flag, set during calculation, default True
+        is_group = if Node was in brackets in expression
+        height = height of subtree, 0 for simple Node
+        divisions = count of slow / operations in subtree
+        digest = structural hash of chain, equal subtrees have equal digests, None for simple Node
+        res = calculated result of Node( depend recursive on all children's res and _operation)
+    '''
+    __slots__ = ('_expression_str', '_operation', 'children', 'is_simple', 'is_valid', 'is_group',
+                 'height', 'divisions', 'digest', 'res')
+
+    def __init__(self, expression_str=None, operation=None, children=()):
+        self._expression_str = expression_str
+        self._operation = operation
+        self.children = children
+        self.is_simple = not children
+        self.is_valid = True
+        self.is_group = False
+        self.height = 0
+        self.divisions = 0
+        self.digest = None
+        self.res = None
+        if children:
+            self._hash_children()
+
+    def _hash_children(self):
+        '''
+        set height, divisions and digest of chain from its children,
+        digest is hash of children operations with numbers and digests of children chains,
+        chain with variables or calls of functions has no digest, its value depends on definitions
+        '''
+        height = 0
+        divisions = 0
+        parts = []
+        is_pure = True
+        for child in self.children:
+            parts.append(operation_bytes[child._operation])
+            if child.__class__ is ConstNode:
+                parts.append(b'f%s;' % child._expression_str.encode())
+            elif child.is_simple:
+                parts.append(b'n%s;' % (child._expression_str.lstrip('0') or '0').encode())
+            else:
+                if child.digest is None:
+                    is_pure = False
+                else:
+                    parts.append(b'c')
+                    parts.append(child.digest)
+                divisions += child.divisions
+                if child.height >= height:
+                    height = child.height
+            if child._operation == '/':
+                divisions += 1
+        self.height = height + 1
+        self.divisions = divisions
+        if is_pure:
+            self.digest = hashlib.blake2b(b''.join(parts), digest_size=16).digest()
+
+    def get_expression_str(self):
+        '''
+        restore expression of this Node from subtree, used for logging
+        '''
+        if self.is_simple:
+            return self._expression_str
+        parts = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, str):
+                parts.append(node)
+                continue
+            if node is not self and node._operation:
+                parts.append(node._operation)
+            if node.is_simple or not node.children:       # number, variable or call of function
+                parts.append(node._expression_str)
+                continue
+            if node is not self and node.is_group:
+                parts.append('(')
+                stack.append(')')
+            stack.extend(reversed(node.children))
+        return ''.join(parts)
+
+    def print_node(self):
+        if logger.level > ErrorLvls.INFO:
+            return
+        stack = [(self, 0)]
+        while stack:
+            node, level = stack.pop()
+            log('|', ErrorLvls.INFO)
+            log('%s--> (%s) %s [%s] res = %s', ErrorLvls.INFO, '',
+                '-' * 8 * level, node._operation, node.get_expression_str(), node.is_simple, node.res)
+            stack.extend((child, level + 1) for child in reversed(node.children))
+
+    def do_operation(self, res=0, val=0):
+        if not res:
+            res = 0
+        if not self._operation and res == 0:
+            res = val
+            return res
+        if self._operation == '-':
+            return res - float(val)
+        if self._operation == '+':
+            return res + float(val)
+        if self._operation == '*':
+            return res * float(val)
+        if self._operation == '/':
+            # add delay to emit long cpu calculations
+            if DELAY:
+                time.sleep(DELAY)
+            if val != 0:
+                return float(res) / float(val)
+            else:
+                log('division by zero!', ErrorLvls.ERR, 'Node::calculate()')
+                raise
+        return res
+
+    def calculate(self):
+        '''
+        calculate math expression result for subtree without recursion,
+        stack contains chain Nodes from this Node to the current one with index of their next child,
+        simple children are applied to Node res in place, so stack depth is only count of nested chains
+        fill res for all Nodes in subtree
+        :return: -1 if calculating errors or nothing
+        '''
+        if not self.is_valid:
+            self.res = None
+            return -1
+        if self.is_simple:
+            self.res = self.value if self.__class__ is ConstNode else int(self._expression_str)
+            return
+        self.res = None
+        stack = [[self, 0]]
+        while stack:
+            frame = stack[-1]
+            node = frame[0]
+            children = node.children
+            index = frame[1]
+            child = None
+            try:
+                while index < len(children):
+                    child = children[index]
+                    index += 1
+                    if not child.is_simple:
+                        break
+                    child.res = child.value if child.__class__ is ConstNode else int(child._expression_str)
+                    operation = child._operation
+                    if operation is None:               # first child
+                        node.res = child.res
+                    elif operation == '/':
+                        node.res = child.do_operation(node.res, child.res)
+                    else:
+                        node.res = operation_funcs[operation](node.res or 0, float(child.res))
+                    child = None
+                if child is not None:                   # go down to child chain
+                    frame[1] = index
+                    child.res = None
+                    stack.append([child, 0])
+                    continue
+                stack.pop()                             # all children applied, go up
+                if stack:
+                    child = node
+                    node = stack[-1][0]
+                    node.res = child.do_operation(node.res, child.res)
+            except:
+                if logger.level <= ErrorLvls.ERR:
+                    log('error in operation %s expr = %s res = %s', ErrorLvls.ERR, 'Node:calculate()',
+                        child._operation, child.get_expression_str(), node.res)
+                child.is_valid = False
+                child.res = None
+                for frame in stack:
+                    frame[0].is_valid = False
+                    frame[0].res = None
+                return -1
+
+
+class VarNode(Node):
+    '''
+    class VarNode,
+    variable in body of function or in template, index is position of argument or of variable in template
+    '''
+    __slots__ = ('index',)
+
+    def __init__(self, name, index):
+        Node.__init__(self, name)
+        self.is_simple = False
+        self.index = index
+
+
+class CallNode(Node):
+    '''
+    class CallNode,
+    call of function, index of function is set when all functions are defined
+    '''
+    __slots__ = ('name', 'args', 'index')
+
+    def __init__(self, name, args):
+        Node.__init__(self, '%s(...)' % name)
+        self.is_simple = False
+        self.name = name
+        self.args = args
+        self.index = None
+        self._hash_children()
+
+    def _hash_children(self):
+        '''
+        set height and divisions from arguments, call has no digest
+        '''
+        self.divisions = 0
+        self.height = 0
+        for arg in self.args:
+            self.divisions += arg.divisions
+            if arg.height >= self.height:
+                self.height = arg.height + 1
+
+
+class ConstNode(Node):
+    '''
+    class ConstNode,
+    number calculated by optimizer, value is float, see optimize_node()
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value, operation=None):
+        Node.__init__(self, repr(value), operation)
+        self.value = value
+
+
+class Parser:
+    '''
+    class Parser,
+    single pass operator precedence parser, builds Node tree from tokens
+    in linear time and without recursion
+    each open bracket has own frame [sum_children, sum_operation, term_children, term_operation, call]:
+    term is chain of * / operations, sum is chain of + - operations over terms,
+    call is [function name, arguments] for brackets of function call, None for other brackets
+    expression can begin with definitions of functions separated by ;
+    fun Name(Pattern, ...) -> expression; ... expression
+    pattern is number or name of variable, function is defined by clauses, the first one with matching
+    patterns is called
+    template is expression with variables, their values are given for each calculation
+    Args:
+        functions = list of [name, count of arguments, clauses], clause is [patterns, body Node],
+         pattern is int or None for variable
+        variables = indexes of variables of template by name, None if expression isn't template
+    '''
+
+    def __init__(self, is_template=False):
+        self._frames = [[[], None, [], None, None]]
+        self._expect_operand = True
+        self._name = None                   # name before next token: variable or function in call
+        self._header = None                 # tokens of header of function definition
+        self._clause = None                 # [name, patterns, variables] of function in definition
+        self._definitions = []              # [name, patterns, body Node]
+        self._calls = []                    # CallNodes to check after all definitions
+        self.functions = []
+        self.variables = dict() if is_template else None
+
+    def push(self, token):
+        '''
+        :input: token - number, name, operation or bracket
+        add token to the tree, raise ParseError if token is unexpected
+        '''
+        if self._name is not None:
+            name = self._name
+            self._name = None
+            if token == '(':
+                self._frames.append([[], None, [], None, [name, []]])
+                return
+            self._add_operand(self._frames[-1], self._get_variable(name))
+        elif self._header is not None:
+            self._push_header(token)
+            return
+        frame = self._frames[-1]
+        if self._expect_operand:
+            if token[0] in digits:
+                self._add_operand(frame, Node(token))
+            elif token == '(':
+                self._frames.append([[], None, [], None, None])
+            elif token[0] in name_start:
+                if token == 'fun' and len(self._frames) == 1 and not frame[0] and not frame[2]:
+                    if self._clause is not None:
+                        raise ParseError('unexpected fun in body of function')
+                    self._header = []
+                else:
+                    self._name = token
+            elif token == ')' and frame[4] is not None and not frame[4][1] and not frame[2]:
+                self._frames.pop()                          # call without arguments
+                self._add_operand(self._frames[-1], self._get_call(frame[4][0], []))
+            else:
+                raise ParseError('unexpected %s, number or ( expected' % token)
+            return
+        if token in operations[1]:                          # * /
+            frame[3] = token
+            self._expect_operand = True
+        elif token in operations[2]:                        # + -
+            self._close_term(frame)
+            frame[1] = token
+            self._expect_operand = True
+        elif token == ')':
+            if len(self._frames) == 1:
+                raise ParseError('close bracket without open bracket')
+            self._frames.pop()
+            node = self._close_frame(frame)
+            if frame[4] is None:
+                node.is_group = True
+            else:
+                frame[4][1].append(node)
+                node = self._get_call(*frame[4])
+            self._add_operand(self._frames[-1], node)
+        elif token == ',' and frame[4] is not None:         # next argument of call
+            frame[4][1].append(self._close_frame(frame))
+            frame[0] = []
+            frame[1] = None
+            self._expect_operand = True
+        elif token == ';' and self._clause is not None and len(self._frames) == 1:
+            name, patterns, variables = self._clause
+            self._definitions.append([name, patterns, self._close_frame(frame)])
+            self._clause = None
+            self._frames = [[[], None, [], None, None]]
+            self._expect_operand = True
+        else:
+            raise ParseError('unexpected %s, operation or ) expected' % token)
+
+    def finish(self):
+        '''
+        :return: root Node of parsed expression, raise ParseError if expression is incomplete
+        '''
+        if self._name is not None:
+            self._add_operand(self._frames[-1], self._get_variable(self._name))
+            self._name = None
+        if self._header is not None or self._clause is not None:
+            raise ParseError('expression after definitions of functions expected')
+        if self._expect_operand:
+            raise ParseError('unexpected end of expression')
+        if len(self._frames) != 1:
+            raise ParseError('open bracket without close bracket')
+        root = self._close_frame(self._frames[0])
+        if self._calls:
+            self._link_functions()
+        return root
+
+    def _push_header(self, token):
+        if token != '->':
+            self._header.append(token)
+            if len(self._header) > 2 and self._header[1] != '(':
+                raise ParseError('( expected after name of function')
+            return
+        header = self._header
+        self._header = None
+        if len(header) < 3 or header[0][0] not in name_start or header[0] == 'fun' or header[1] != '(' or header[-1] != ')':
+            raise ParseError('invalid definition of function, fun Name(Arguments) -> expression expected')
+        arguments = header[2:-1]
+        if arguments[1::2] != [','] * (len(arguments) // 2) or arguments and len(arguments) % 2 == 0:
+            raise ParseError('invalid arguments of function %s' % header[0])
+        patterns = []
+        variables = dict()
+        for i, argument in enumerate(arguments[0::2]):
+            if argument[0] in digits:
+                patterns.append(int(argument))
+            elif argument[0] in name_start and argument != 'fun' and argument not in variables:
+                patterns.append(None)
+                variables[argument] = i
+            else:
+                raise ParseError('invalid argument %s of function %s' % (argument, header[0]))
+        self._clause = [header[0], tuple(patterns), variables]
+
+    def _get_variable(self, name):
+        if self._clause is None and self.variables is not None and name != 'fun':
+            index = self.variables.setdefault(name, len(self.variables))
+            return VarNode(name, index)
+        if self._clause is None or name not in self._clause[2]:
+            raise ParseError('unknown variable %s' % name)
+        return VarNode(name, self._clause[2][name])
+
+    def _get_call(self, name, arguments):
+        node = CallNode(name, arguments)
+        self._calls.append(node)
+        return node
+
+    def _link_functions(self):
+        '''
+        group clauses by functions and set index of function in calls
+        '''
+        indexes = dict()
+        for name, patterns, body in self._definitions:
+            if name not in indexes:
+                indexes[name] = len(self.functions)
+                self.functions.append([name, len(patterns), []])
+            function = self.functions[indexes[name]]
+            if function[1] != len(patterns):
+                raise ParseError('different count of arguments in clauses of function %s' % name)
+            function[2].append([patterns, body])
+        for node in self._calls:
+            if node.name not in indexes:
+                raise ParseError('unknown function %s' % node.name)
+            node.index = indexes[node.name]
+            if self.functions[node.index][1] != len(node.args):
+                raise ParseError('function %s expects %s arguments' % (node.name, self.functions[node.index][1]))
+
+    def _add_operand(self, frame, node):
+        node._operation = frame[3]
+        frame[2].append(node)
+        self._expect_operand = False
+
+    def _close_term(self, frame):
+        term = frame[2]
+        node = term[0] if len(term) == 1 else Node(children=term)
+        node._operation = frame[1]
+        frame[0].append(node)
+        frame[2] = []
+        frame[3] = None
+
+    def _close_frame(self, frame):
+        self._close_term(frame)
+        chain = frame[0]
+        node = chain[0] if len(chain) == 1 else Node(children=chain)
+        node._operation = None
+        return node
+
+
+class Tree:
+    '''
+    :class: Tree,
+    use to parse math expression
+    root contains the whole math expression,
+    if expression is complex, split it to childs and etc
+    :return: result of math expression or processing status or error
+    '''
+
+    def __init__(self, expression_str, root=None, functions=(), is_template=False):
+        self._expression_str = expression_str
+        self._root = root
+        self.functions = functions                      # see Parser.functions
+        self.is_template = is_template
+        self.variables = ()                             # names of variables of template by index
+        self.is_valid = True
+        self.max_height = 0
+        self._res = None
+        if root is None:
+            self.parse()
+        else:                                           # tree is parsed already, e.g. by StreamParser
+            self.max_height = max(root.height, 1)
+
+    def parse(self):
+        parser = Parser(self.is_template)
+        # Node tree has no reference cycles, gc runs only slow down creation of millions of Nodes
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for token in tokenize(self._expression_str):
+                parser.push(token)
+            self._root = parser.finish()
+            self.functions = parser.functions
+            if self.is_template:
+                self.variables = tuple(parser.variables)
+        except ParseError as e:
+            log('%s', ErrorLvls.ERR, 'Tree:parse()', e)
+            self.is_valid = False
+            return -1
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.max_height = max(self._root.height, 1)
+
+    def print_tree(self):
+        if not self.is_valid:
+            return -1
+        self._root.print_node()
+
+    def calculate(self):
+        if not self.is_valid:
+            log('invalid expression = %s', ErrorLvls.ERR, 'Tree:calculate', self._expression_str)
+            return None
+        if self.functions or self.variables:
+            log('functions and templates are calculated only by Program', ErrorLvls.ERR, 'Tree:calculate')
+            return None
+        self._root.calculate()
+        self._res = self._root.res
+        return self._res
+
+    def optimize(self):
+        '''
+        simplify tree and bodies of functions before calculation, see optimize_node()
+        :return: [count of removed Nodes, count of removed slow operations]
+        '''
+        removed = [0, 0]
+        if not self.is_valid:
+            return removed
+        self._root = optimize_node(self._root, removed)
+        for name, arity, clauses in self.functions:
+            for clause in clauses:
+                clause[1] = optimize_node(clause[1], removed)
+        self.max_height = max(self._root.height, 1)
+        log('optimized: nodes removed = %s, slow operations removed = %s', ErrorLvls.INFO, 'Tree:optimize()',
+            *removed)
+        return removed
+
+    def split(self, count):
+        '''
+        choose independent chains with slow operations to calculate them in parallel:
+        the chain with the most slow operations is replaced by its chains with slow operations
+        until there are count chains, equal chains are calculated once
+        :return: list of Nodes, empty if expression can't be split
+        '''
+        if count < 2 or not self.is_valid or not self._root.divisions:
+            return []
+        heap = [(-self._root.divisions, 0, self._root)]
+        digests = set()
+        parts = []
+        order = 1                                       # insertion order, to compare equal items
+        while heap and len(heap) + len(parts) < count:
+            node = heapq.heappop(heap)[2]
+            is_split = False
+            for child in node.children:
+                if child.divisions and child.digest is not None and child.digest not in digests:
+                    digests.add(child.digest)
+                    heapq.heappush(heap, (-child.divisions, order, child))
+                    order += 1
+                    is_split = True
+            if not is_split and node.digest is not None:    # only own slow operations, can't be split
+                parts.append(node)
+        parts.extend(item[2] for item in sorted(heap))
+        if len(parts) < 2:
+            return []
+        return parts
+
+    def compile(self, parts=1):
+        '''
+        compile tree and bodies of functions to Program, see compile_node()
+        :input: parts - count of chains to calculate in parallel, see split(), they are stored chains too
+        :return: Program or None if tree is invalid
+        '''
+        if not self.is_valid:
+            return None
+        program = compile_node(self._root, [node.digest for node in self.split(parts)])
+        program.functions = tuple(Function(name, arity, tuple((patterns, compile_node(body))
+                                                              for patterns, body in clauses))
+                                  for name, arity, clauses in self.functions)
+        program.variables = self.variables
+        return program
+
+
+def optimize_node(root, removed):
+    '''
+    simplify subtree without recursion, result of calculation stays the same bit by bit:
+    - numbers at the beginning of chain are calculated until the first / (constant folding),
+      e.g. 2*3*4/x -> 24.0/x, chain of numbers without / becomes number, e.g. 0*(1 + 2) -> 0.0
+    - the first child chain without slow operations is merged, e.g. (1 + x) + 2 -> 1 + x + 2
+    - / 1 becomes * 1, * 1, + 0 and - 0 are removed if they aren't the last operation of chain,
+      0 + and 1 * are removed at the beginning of chain of 3 and more items
+    other rewrites change floats, so they aren't done: numbers after the first / or after
+    variables aren't folded, as float operations aren't associative, / isn't calculated as it's slow
+    and can raise division by zero, so 0 * x isn't removed if x contains / or variables,
+    the last identity operation isn't removed, it converts int to float and -0.0 to 0.0
+    :input: removed - [count of removed Nodes, count of removed slow operations], it's increased
+    :return: new root
+    '''
+    if not root.children and root.__class__ is not CallNode:
+        return root
+    stack = [[root, 0, False]]                      # [chain, index of next child, is changed]
+    while True:
+        frame = stack[-1]
+        node = frame[0]
+        children = node.args if node.__class__ is CallNode else node.children
+        if frame[1] < len(children):
+            child = children[frame[1]]
+            frame[1] += 1
+            if child.children or child.__class__ is CallNode:
+                stack.append([child, 0, False])
+            continue
+        stack.pop()
+        is_changed = frame[2]
+        if node.__class__ is CallNode:
+            if is_changed:
+                node._hash_children()
+        else:
+            new_node = simplify_chain(node, removed)
+            if new_node is not None:
+                node = new_node
+                is_changed = True
+            elif is_changed:
+                node._hash_children()
+        if not stack:
+            return node
+        if is_changed:
+            parent = stack[-1]
+            children = parent[0].args if parent[0].__class__ is CallNode else parent[0].children
+            children[parent[1] - 1] = node
+            parent[2] = True
+
+
+def get_simple_value(node):
+    '''
+    :return: number of simple node, None if its literal is longer than int conversion limit of python
+    '''
+    if node.__class__ is ConstNode:
+        return node.value
+    try:
+        return int(node._expression_str)
+    except ValueError:
+        return None
+
+
+def simplify_chain(node, removed):
+    '''
+    simplify chain with simplified children, see optimize_node()
+    :return: new Node, node if only its children are changed, None if chain isn't changed
+    '''
+    children = node.children
+    operation = node._operation
+    is_changed = False
+    first = children[0]
+    if first.__class__ is Node and first.children and not first.divisions and \
+            get_operation_priority(first.children[1]._operation) == get_operation_priority(children[1]._operation):
+        children[0:1] = first.children
+        removed[0] += 1
+        is_changed = True
+    # constant folding, numbers are calculated as in Program.execute()
+    count = 0
+    res = None
+    for child in children:
+        if not child.is_simple or count and child._operation == '/':
+            break
+        value = get_simple_value(child)
+        if value is None:
+            break
+        try:
+            res = operation_funcs[child._operation](res or 0, float(value)) if count else value
+        except OverflowError:
+            break
+        count += 1
+    if count == len(children):
+        removed[0] += count
+        return ConstNode(res, operation)
+    if count > 1:
+        children[0:count] = [ConstNode(res)]
+        removed[0] += count - 1
+        is_changed = True
+    # identity operations
+    if len(children) > 2 and children[0].is_simple and children[1]._operation in ('+', '*'):
+        value = get_simple_value(children[0])
+        if value == (0 if children[1]._operation == '+' else 1):
+            del children[0]
+            children[0]._operation = None
+            removed[0] += 1
+            is_changed = True
+    i = 1
+    while i < len(children):
+        child = children[i]
+        if child.is_simple:
+            value = get_simple_value(child)
+            if value == (0 if child._operation in ('+', '-') else 1):
+                if child._operation == '/':
+                    child._operation = '*'
+                    removed[1] += 1
+                    is_changed = True
+                if i < len(children) - 1:
+                    del children[i]
+                    removed[0] += 1
+                    is_changed = True
+                    continue
+        i += 1
+    if not is_changed:
+        return None
+    node._hash_children()
+    return node
+
+
+def compile_node(root, part_digests=()):
+    '''
+    compile subtree to Program in reverse polish notation without recursion,
+    chain [a, +b, *c] is compiled to a b + c *, call F(a, b) is compiled to a b F
+    chains with slow operations which are in brackets or repeated in expression are compiled
+    as OP_ENTER chain OP_LEAVE, their values are stored by digest and calculated only once
+    :input: part_digests - digests of chains to calculate in parallel, they are stored chains too
+    :return: Program
+    '''
+    part_indexes = dict((digest, i) for i, digest in enumerate(part_digests))
+    part_ranges = [None] * len(part_digests)
+    counts = dict()                                 # count of chains with slow operations, key - digest
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node.divisions:
+            counts[node.digest] = counts.get(node.digest, 0) + 1
+            stack.extend(node.args if node.__class__ is CallNode else node.children)
+    code = bytearray()
+    operands = array('q')
+    constants = []
+    slots = dict()                                  # index of stored value, key - digest
+    digests = []
+    skipped_divisions = 0                           # slow operations in repeated chains
+    repeated_level = 0                              # count of repeated chains around current item
+    depth = 0                                       # size of values stack during execution
+    max_depth = 0
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        if item.__class__ is int:                   # opcode of operation
+            code.append(item)
+            depth -= 1
+        elif item.__class__ is list:                # end of stored chain
+            slot, code_start, operands_start, is_repeated = item
+            if is_repeated:
+                repeated_level -= 1
+            code.append(OP_LEAVE)
+            operands.append(slot)
+            # OP_ENTER operands: slot, count of opcodes and operands to skip if value is known
+            operands[operands_start - 2] = len(code) - code_start
+            operands[operands_start - 1] = len(operands) - operands_start
+            part = part_indexes.get(digests[slot])
+            if part is not None and not is_repeated:
+                # code of part begins from its OP_ENTER
+                part_ranges[part] = (slot, code_start - 1, len(code), operands_start - 3, len(operands))
+        elif item.__class__ is tuple:               # call of function: index of function, count of arguments
+            code.append(OP_CALL)
+            operands.extend(item)
+            depth -= item[1] - 1
+            if depth > max_depth:
+                max_depth = depth
+        elif item.is_simple:
+            depth += 1
+            if depth > max_depth:
+                max_depth = depth
+            value = item.value if item.__class__ is ConstNode else int(item._expression_str)
+            if value.__class__ is int and INT64_MIN <= value <= INT64_MAX:
+                code.append(OP_PUSH)
+                operands.append(value)
+            else:                                   # too big number for operands array
+                code.append(OP_CONST)
+                operands.append(len(constants))
+                constants.append(value)
+        elif not item.children:                     # variable or call of function
+            if item.__class__ is VarNode:
+                depth += 1
+                if depth > max_depth:
+                    max_depth = depth
+                code.append(OP_ARG)
+                operands.append(item.index)
+            else:
+                stack.append((item.index, len(item.args)))
+                stack.extend(reversed(item.args))
+        else:
+            if item.divisions and item.digest is not None and \
+                    (item.is_group or item is root or counts[item.digest] > 1 or item.digest in part_indexes):
+                slot = slots.get(item.digest)
+                is_repeated = slot is not None
+                if is_repeated:
+                    if not repeated_level:
+                        skipped_divisions += item.divisions
+                    repeated_level += 1
+                else:
+                    slot = slots[item.digest] = len(digests)
+                    digests.append(item.digest)
+                code.append(OP_ENTER)
+                operands.extend((slot, 0, 0))
+                stack.append([slot, len(code), len(operands), is_repeated])
+            children = item.children
+            for i in range(len(children) - 1, 0, -1):
+                stack.append(operation_opcodes[children[i]._operation])
+                stack.append(children[i])
+            stack.append(children[0])
+    if operands:                                    # use the smallest item size for numbers
+        low = min(operands)
+        high = max(operands)
+        for typecode in 'bhi':
+            bound = 2 ** (array(typecode).itemsize * 8 - 1)
+            if -bound <= low and high < bound:
+                operands = array(typecode, operands)
+                break
+    return Program(bytes(code), operands, tuple(constants), max_depth, tuple(digests),
+                   code.count(OP_DIV) - skipped_divisions, tuple(part_ranges))
+
+
+class StreamParser:
+    '''
+    class StreamParser,
+    parses expression received by chunks of bytes, chunks aren't kept after parsing,
+    so memory is bounded by tree of expression and invalid expression is rejected at the first bad token
+    Args:
+        size = count of received bytes
+        digest = hash of received bytes, it's a key of expression in caches
+    '''
+
+    def __init__(self):
+        self._tokenizer = StreamTokenizer()
+        self._parser = Parser()
+        self._hash = hashlib.blake2b(digest_size=16)
+        self.size = 0
+
+    def feed(self, chunk):
+        '''
+        parse next chunk of expression, raise ParseError if expression is invalid
+        '''
+        self.size += len(chunk)
+        self._hash.update(chunk)
+        try:
+            text = chunk.decode('ascii')
+        except UnicodeDecodeError:
+            raise ParseError('unsupported symbol in expression')
+        self._push(self._tokenizer.feed(text))
+
+    def finish(self, parts=1, optimize=False):
+        '''
+        :input: parts - see Tree.compile(), optimize - simplify tree before compilation, see Tree.optimize()
+        :return: [key, Program] - key of expression for caches and compiled expression,
+        raise ParseError if expression is invalid
+        '''
+        self._push(self._tokenizer.finish())
+        root = self._parser.finish()
+        tree = Tree(None, root, self._parser.functions)
+        try:
+            if optimize:
+                tree.optimize()
+            program = tree.compile(parts)
+        except ValueError as e:
+            raise ParseError('%s' % e)
+        return [STREAM_PREFIX + self._hash.hexdigest(), program]
+
+    def _push(self, tokens):
+        # see Tree.parse(), gc only slows down creation of Nodes
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for token in tokens:
+                self._parser.push(token)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+
+# opcodes of Program
+OP_PUSH = 0     # push next number from operands
+OP_CONST = 1    # push constant with index from operands
+OP_ADD = 2
+OP_SUB = 3
+OP_MUL = 4
+OP_DIV = 5
+OP_ENTER = 6    # begin of stored chain, push stored value and skip chain if it's known
+OP_LEAVE = 7    # end of stored chain, store its value
+OP_ARG = 8      # push argument of function with index from operands
+OP_CALL = 9     # call function with index and count of arguments from operands
+operation_opcodes = {'+': OP_ADD, '-': OP_SUB, '*': OP_MUL, '/': OP_DIV}
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+# estimated time of one opcode in Program.execute, seconds
+OPCODE_COST = 2e-7
+# maximum count of nested calls of functions
+MAX_CALL_DEPTH = 100000
+# maximum count of cached results of calls of functions in one calculation
+CALL_CACHE_SIZE = 100000
+
+
+class FunctionError(Exception):
+    pass
+
+
+class Function:
+    '''
+    class Function,
+    compiled user-defined function
+    Args:
+        name = name of function
+        arity = count of arguments
+        clauses = [patterns, body Program], pattern is int or None for variable,
+         body of the first clause with matching patterns is calculated
+    '''
+    __slots__ = ('name', 'arity', 'clauses')
+
+    def __init__(self, name, arity, clauses):
+        self.name = name
+        self.arity = arity
+        self.clauses = clauses
+
+    def get_size(self):
+        return sum(body.get_size() + 8 * len(patterns) for patterns, body in self.clauses)
+
+    def find_body(self, args):
+        for patterns, body in self.clauses:
+            for pattern, arg in zip(patterns, args):
+                if pattern is not None and pattern != arg:
+                    break
+            else:
+                return body
+        raise FunctionError('no clause of function %s matches arguments %s' % (self.name, args))
+
+
+class Program:
+    '''
+    class Program,
+    math expression compiled to reverse polish notation,
+    flat buffers are cheap to cache and to pickle for worker processes
+    Args:
+        code = bytes of opcodes
+        operands = array of integer operands of opcodes, in order of usage
+        constants = numbers which don't fit to int64 and numbers calculated by optimizer
+        depth = maximum size of values stack during execution
+        digests = digests of stored chains, index in digests is slot of OP_ENTER and OP_LEAVE
+        divisions = count of slow / operations to calculate
+        parts = independent stored chains to calculate in parallel,
+         (slot, code start, code end, operands start, operands end) for each
+        functions = user-defined functions called by program, index in functions is operand of OP_CALL
+        variables = names of variables of template, index in variables is operand of OP_ARG,
+         template is calculated only by execute_columns()
+    '''
+    __slots__ = ('code', 'operands', 'constants', 'depth', 'digests', 'divisions', 'parts', 'functions',
+                 'variables')
+
+    def __init__(self, code, operands, constants=(), depth=0, digests=(), divisions=None, parts=(), functions=(),
+                 variables=()):
+        self.code = code
+        self.operands = operands
+        self.constants = constants
+        self.depth = depth
+        self.digests = digests
+        self.divisions = code.count(OP_DIV) if divisions is None else divisions
+        self.parts = parts
+        self.functions = functions
+        self.variables = variables
+
+    def get_part(self, index):
+        '''
+        :return: [slot, Program] - program of part with index, it calculates value of stored chain in slot
+        '''
+        slot, code_start, code_end, operands_start, operands_end = self.parts[index]
+        return [slot, Program(self.code[code_start:code_end], self.operands[operands_start:operands_end],
+                              self.constants, self.depth, self.digests)]
+
+    def get_divisions(self, values=None):
+        '''
+        :return: count of slow operations to calculate, parts with known values are skipped,
+        0 if program calls functions: count of slow operations in their bodies is unknown before calculation
+        '''
+        if self.functions:
+            return 0
+        divisions = self.divisions
+        if values:
+            for slot, code_start, code_end, operands_start, operands_end in self.parts:
+                if values[slot] is not None:
+                    divisions -= self.code.count(OP_DIV, code_start, code_end)
+        return max(divisions, 0)
+
+    def get_size(self):
+        return len(self.code) + len(self.operands) * self.operands.itemsize + \
+            sum(sys.getsizeof(constant) for constant in self.constants) + 49 * len(self.digests) + \
+            104 * len(self.parts) + sum(function.get_size() for function in self.functions)
+
+    def execute(self, values=None):
+        '''
+        calculate program with stack of values,
+        operations are applied as in Node.do_operation
+        :input: values - values of stored chains by slot, None if value is unknown,
+        list is filled with calculated values
+        :return: result, raise ZeroDivisionError on division by zero
+        '''
+        return run_steps(self.steps(values))
+
+    def execute_columns(self, columns, rows):
+        '''
+        calculate template for all rows at once, operations are applied to whole columns,
+        with numpy arrays if numpy is installed, otherwise with lists,
+        delay of slow operation is applied once for all rows
+        :input: columns - values of variables by index, sequences of rows length
+        :return: list of results, None for rows with division by zero or overflow
+        '''
+        return run_steps(self._column_steps(columns, rows))
+
+    async def execute_async(self, values=None):
+        '''
+        the same as execute(), but delay of slow operations is awaited,
+        so many programs are calculated concurrently in one event loop
+        '''
+        steps = self.steps(values)
+        try:
+            while True:
+                next(steps)
+                await asyncio.sleep(DELAY)
+        except StopIteration as e:
+            return e.value
+
+    def steps(self, values=None):
+        '''
+        generator of calculation, it yields before each slow operation to let caller wait for delay
+        :return: result as value of StopIteration
+        '''
+        if values is None:
+            values = [None] * len(self.digests)
+        if self.functions:
+            return self._call_steps(values)
+        return self._steps(values)
+
+    def _steps(self, values):
+        operands = self.operands
+        constants = self.constants
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        i = 0
+        codes = iter(self.code)
+        for opcode in codes:
+            if opcode == OP_PUSH:
+                push(operands[i])
+                i += 1
+            elif opcode == OP_CONST:
+                push(constants[operands[i]])
+                i += 1
+            elif opcode <= OP_DIV:
+                val = float(pop())
+                res = stack[-1] or 0
+                if opcode == OP_ADD:
+                    stack[-1] = res + val
+                elif opcode == OP_SUB:
+                    stack[-1] = res - val
+                elif opcode == OP_MUL:
+                    stack[-1] = res * val
+                else:
+                    yield
+                    if val == 0:
+                        raise ZeroDivisionError('division by zero!')
+                    stack[-1] = float(res) / val
+            elif opcode == OP_ENTER:
+                value = values[operands[i]]
+                if value is None:
+                    i += 3
+                else:
+                    push(value)
+                    next(islice(codes, operands[i + 1], operands[i + 1]), None)
+                    i += 3 + operands[i + 2]
+            else:
+                values[operands[i]] = stack[-1]
+                i += 1
+        return stack[0]
+
+    def _column_steps(self, columns, rows):
+        if numpy is not None:
+            columns = [numpy.asarray(column, dtype=numpy.float64) for column in columns]
+            apply_operation = numpy_operation
+        else:
+            columns = [[float(value) for value in column] for column in columns]
+            apply_operation = list_operation
+        values = [None] * len(self.digests)
+        operands = self.operands
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        i = 0
+        codes = iter(self.code)
+        for opcode in codes:
+            if opcode == OP_PUSH:
+                push(float(operands[i]))
+                i += 1
+            elif opcode == OP_CONST:
+                push(float(self.constants[operands[i]]))
+                i += 1
+            elif opcode <= OP_DIV:
+                if opcode == OP_DIV:
+                    yield
+                val = pop()
+                stack[-1] = apply_operation(opcode, stack[-1], val)
+            elif opcode == OP_ENTER:
+                value = values[operands[i]]
+                if value is None:
+                    i += 3
+                else:
+                    push(value)
+                    next(islice(codes, operands[i + 1], operands[i + 1]), None)
+                    i += 3 + operands[i + 2]
+            elif opcode == OP_LEAVE:
+                values[operands[i]] = stack[-1]
+                i += 1
+            else:
+                push(columns[operands[i]])
+                i += 1
+        res = stack[0]
+        if numpy is not None:
+            res = numpy.broadcast_to(res, (rows,)).tolist()
+        elif res.__class__ is not list:
+            res = [res] * rows
+        return [value if math.isfinite(value) else None for value in res]
+
+    def _call_steps(self, values):
+        '''
+        generator of calculation of program with calls of functions, see steps(),
+        frames of callers are kept in list instead of python recursion,
+        results of calls are cached by function and arguments, so each distinct call is calculated once
+        '''
+        functions = self.functions
+        cache = OrderedDict()           # results of calls, key - index of function, arguments and their types
+        body_values = dict()            # values of stored chains of bodies, key - id of body
+        frames = []                     # callers: code, operands, constants, values, args, position, operand, key
+        code = self.code
+        operands = self.operands
+        constants = self.constants
+        args = ()
+        key = None
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        position = 0
+        i = 0
+        while True:
+            if position == len(code):   # end of body, its result is on stack
+                if not frames:
+                    return stack[0]
+                cache[key] = stack[-1]
+                if len(cache) > CALL_CACHE_SIZE:
+                    cache.popitem(last=False)
+                code, operands, constants, values, args, position, i, key = frames.pop()
+                continue
+            opcode = code[position]
+            position += 1
+            if opcode == OP_PUSH:
+                push(operands[i])
+                i += 1
+            elif opcode == OP_CONST:
+                push(constants[operands[i]])
+                i += 1
+            elif opcode <= OP_DIV:
+                val = float(pop())
+                res = stack[-1] or 0
+                if opcode == OP_ADD:
+                    stack[-1] = res + val
+                elif opcode == OP_SUB:
+                    stack[-1] = res - val
+                elif opcode == OP_MUL:
+                    stack[-1] = res * val
+                else:
+                    yield
+                    if val == 0:
+                        raise ZeroDivisionError('division by zero!')
+                    stack[-1] = float(res) / val
+            elif opcode == OP_ENTER:
+                value = values[operands[i]]
+                if value is None:
+                    i += 3
+                else:
+                    push(value)
+                    position += operands[i + 1]
+                    i += 3 + operands[i + 2]
+            elif opcode == OP_LEAVE:
+                values[operands[i]] = stack[-1]
+                i += 1
+            elif opcode == OP_ARG:
+                push(args[operands[i]])
+                i += 1
+            else:
+                index = operands[i]
+                count = operands[i + 1]
+                i += 2
+                call_args = tuple(stack[len(stack) - count:])
+                del stack[len(stack) - count:]
+                call_key = (index, call_args, tuple(arg.__class__ for arg in call_args))
+                result = cache.get(call_key)
+                if result is not None:
+                    cache.move_to_end(call_key)
+                    push(result)
+                    continue
+                if len(frames) >= MAX_CALL_DEPTH:
+                    raise FunctionError('maximum depth of calls %s is exceeded' % MAX_CALL_DEPTH)
+                body = functions[index].find_body(call_args)
+                frames.append((code, operands, constants, values, args, position, i, key))
+                code = body.code
+                operands = body.operands
+                constants = body.constants
+                values = body_values.get(id(body))
+                if values is None:
+                    values = body_values[id(body)] = [None] * len(body.digests)
+                args = call_args
+                key = call_key
+                position = 0
+                i = 0
+
+
+def is_expression_valid(expression_s):
+    if expression_s == '' or expression_s.isspace():
+        return False, 'expression is empty string!'
+    open_brackets_count = expression_s.count('(')
+    close_brackets_count = expression_s.count(')')
+    is_valid = open_brackets_count == close_brackets_count
+    err_text = ''
+    if not is_valid:
+        err_text = "count of '(' != count of ')'!"
+    return is_valid, err_text
+
+
+def parse_expression(expression_s, pid, delay=30, optimize=False):
+    global DELAY
+    DELAY = delay
+    log('pid=%s expression = %s', ErrorLvls.INFO, 'parse_expression()', pid, expression_s)
+    is_valid, err_text = is_expression_valid(expression_s)
+    res = None
+    err = None
+    if not is_valid:
+        log('invalid expression %s', ErrorLvls.ERR, 'parse_expression()', err_text)
+        err = err_text
+    else:
+        tree = Tree(expression_s)
+        if not tree.is_valid:
+            err = 'error in parsing'
+        else:
+            if optimize:
+                tree.optimize()
+            if tree.functions:                          # functions are calculated only by Program
+                try:
+                    res, err = run_program(tree.compile(), pid, delay)
+                except ValueError as e:
+                    log('%s', ErrorLvls.ERR, 'parse_expression()', e)
+                    err = 'error in parsing'
+            else:
+                # tree.print_tree()
+                res = tree.calculate()
+                if res.__class__ is float and not math.isfinite(res):
+                    res = None
+                if res is None:
+                    err = 'error in calculating'
+                # tree.print_tree()
+            log('pid=%s res=%s tree_heigh = %s', ErrorLvls.INFO, 'Tree:parse_expression()',
+                pid, res, tree.max_height)
+    logger.flush()
+    return [res, err]
+
+
+def check_finite(res):
+    '''
+    raise OverflowError if float result is inf or nan, e.g. after many multiplications in calls of functions,
+    such result can't be sent in JSON
+    :return: res
+    '''
+    if res.__class__ is float and not math.isfinite(res):
+        raise OverflowError('result %s is out of range' % res)
+    return res
+
+
+def run_steps(steps):
+    '''
+    run generator of calculation, see Program.steps(), with delay before each slow operation
+    :return: result of calculation
+    '''
+    try:
+        while True:
+            next(steps)
+            # add delay to emit long cpu calculations
+            if DELAY:
+                time.sleep(DELAY)
+            if progress is not None:
+                progress[0] += 1
+    except StopIteration as e:
+        return e.value
+
+
+def numpy_operation(opcode, res, val):
+    '''
+    apply operation to numpy arrays or numbers, result of division by zero is nan,
+    -0.0 in res is replaced by 0.0 as in Program.execute()
+    '''
+    with numpy.errstate(all='ignore'):
+        res = numpy.add(res, 0.0) if res.__class__ is numpy.ndarray else res or 0.0
+        if opcode == OP_ADD:
+            return numpy.add(res, val)
+        elif opcode == OP_SUB:
+            return numpy.subtract(res, val)
+        elif opcode == OP_MUL:
+            return numpy.multiply(res, val)
+        return numpy.where(numpy.equal(val, 0), numpy.nan, numpy.divide(res, val))
+
+
+def list_operation(opcode, res, val):
+    '''
+    apply operation to lists of floats or numbers, result of division by zero is nan,
+    -0.0 in res is replaced by 0.0 as in Program.execute()
+    '''
+    if res.__class__ is not list and val.__class__ is not list:
+        return list_operation(opcode, [res], [val])[0]
+    res = [x or 0.0 for x in res] if res.__class__ is list else res or 0.0
+    pairs = zip(res if res.__class__ is list else repeat(res), val if val.__class__ is list else repeat(val))
+    if opcode == OP_ADD:
+        return [x + y for x, y in pairs]
+    elif opcode == OP_SUB:
+        return [x - y for x, y in pairs]
+    elif opcode == OP_MUL:
+        return [x * y for x, y in pairs]
+    return [x / y if y else math.nan for x, y in pairs]
+
+
+def estimate_cost(program, delay=None, rows=1, calls_once=False):
+    '''
+    static estimation of program calculation time in seconds:
+    opcodes and values stack size cost OPCODE_COST each for each of rows of template,
+    slow / operation costs delay once for all rows,
+    count of calls of functions is unknown, so cost of program with functions is inf,
+    calls_once - body of each function is counted once instead, it's a lower bound for order of jobs
+    '''
+    size = len(program.code) + program.depth
+    divisions = program.divisions
+    if program.functions:
+        if not calls_once:                              # count of calls is unknown
+            return float('inf')
+        for function in program.functions:
+            for patterns, body in function.clauses:
+                size += len(body.code) + body.depth
+                divisions += body.divisions
+    if delay is None:
+        delay = DELAY
+    return size * rows * OPCODE_COST + divisions * delay
+
+
+def compile_expression(expression_s, parts=1, optimize=False, trace=None):
+    '''
+    parse math expression and compile it to Program,
+    parts - count of chains to calculate in parallel, see Tree.split(),
+    optimize - simplify tree before compilation, see Tree.optimize(),
+    trace - list to append [event, time] of the end of parse, optimize and compile, optional
+    :return: [Program or None, error text or None]
+    '''
+    is_valid, err_text = is_expression_valid(expression_s)
+    if not is_valid:
+        log('invalid expression %s', ErrorLvls.ERR, 'compile_expression()', err_text)
+        return [None, err_text]
+    tree = Tree(expression_s)
+    if trace is not None:
+        trace.append(['parse end', time.time()])
+    if not tree.is_valid:
+        return [None, 'error in parsing']
+    try:
+        if optimize:
+            tree.optimize()
+            if trace is not None:
+                trace.append(['optimize end', time.time()])
+        program = tree.compile(parts)
+        if trace is not None:
+            trace.append(['compile end', time.time()])
+        return [program, None]
+    except ValueError as e:
+        log('%s', ErrorLvls.ERR, 'compile_expression()', e)
+        return [None, 'error in parsing']
+
+
+def compile_template(expression_s, optimize=False):
+    '''
+    parse math expression with variables and compile it to Program, see Program.execute_columns(),
+    optimize - simplify tree before compilation, see Tree.optimize()
+    :return: [Program or None, error text or None]
+    '''
+    is_valid, err_text = is_expression_valid(expression_s)
+    if not is_valid:
+        log('invalid template %s', ErrorLvls.ERR, 'compile_template()', err_text)
+        return [None, err_text]
+    tree = Tree(expression_s, is_template=True)
+    if not tree.is_valid:
+        return [None, 'error in parsing']
+    if tree.functions:
+        return [None, 'functions are not supported in templates']
+    try:
+        if optimize:
+            tree.optimize()
+        return [tree.compile(), None]
+    except ValueError as e:
+        log('%s', ErrorLvls.ERR, 'compile_template()', e)
+        return [None, 'error in parsing']
+
+
+def run_template(program, columns, rows, pid, delay=30):
+    '''
+    calculate template for each row of columns, see Program.execute_columns()
+    :return: [list of results or None, err]
+    '''
+    global DELAY
+    DELAY = delay
+    if progress is not None:
+        progress[0] = 0
+        progress[1] = program.divisions
+    res = None
+    err = None
+    try:
+        res = program.execute_columns(columns, rows)
+    except OverflowError as e:
+        log('pid=%s %s', ErrorLvls.ERR, 'run_template()', pid, e)
+        err = 'error in calculating'
+    log('pid=%s rows=%s', ErrorLvls.INFO, 'run_template()', pid, rows)
+    return [res, err]
+
+
+async def run_program_async(program, pid, delay=30, values=None):
+    '''
+    calculate program in event loop, parts of program are calculated concurrently
+    :return: [res, err] as run_program()
+    '''
+    global DELAY
+    DELAY = delay
+    if values is None:
+        values = [None] * len(program.digests)
+    res = None
+    err = None
+    tasks = []
+    try:
+        for i in range(len(program.parts)):
+            slot, part = program.get_part(i)
+            if values[slot] is None:
+                tasks.append(asyncio.ensure_future(part.execute_async(values)))
+        await asyncio.gather(*tasks)
+        res = check_finite(await program.execute_async(values))
+    except (ZeroDivisionError, OverflowError, FunctionError) as e:
+        log('pid=%s %s', ErrorLvls.ERR, 'run_program_async()', pid, e)
+    finally:
+        for task in tasks:
+            task.cancel()
+    if res is None:
+        err = 'error in calculating'
+    log('pid=%s res=%s', ErrorLvls.INFO, 'run_program_async()', pid, res)
+    return [res, err]
+
+
+def run_program(program, pid, delay=30, values=None):
+    global DELAY
+    DELAY = delay
+    if progress is not None:
+        progress[0] = 0
+        progress[1] = program.get_divisions(values)
+    res = None
+    err = None
+    try:
+        res = check_finite(program.execute(values))
+    except (ZeroDivisionError, OverflowError, FunctionError) as e:
+        log('pid=%s %s', ErrorLvls.ERR, 'run_program()', pid, e)
+    if res is None:
+        err = 'error in calculating'
+    log('pid=%s res=%s', ErrorLvls.INFO, 'run_program()', pid, res)
+    return [res, err]
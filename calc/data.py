@@ -1,62 +1,386 @@
+import collections
+import os
+import sys
+import time
+
+from logs import ErrorLvls, log
+import metrics
+
+# limits of each cache in SharedData: count of items, size of keys and values in bytes, time to live in seconds,
+# 0 - no limit
+CACHE_MAX_ITEMS = int(os.environ.get('CALC_CACHE_MAX_ITEMS', 100000))
+CACHE_MAX_BYTES = int(os.environ.get('CALC_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+CACHE_TTL = float(os.environ.get('CALC_CACHE_TTL', 24 * 60 * 60))
+
+
+def get_size(key, value):
+    '''
+    approximate size of cache item in bytes, value can define own get_size()
+    '''
+    if hasattr(value, 'get_size'):
+        return sys.getsizeof(key) + value.get_size()
+    return sys.getsizeof(key) + sys.getsizeof(value)
+
+
+class BoundedCache:
+    '''
+    class BoundedCache,
+    dict with LRU eviction by count of items or their size in bytes and with time to live of items
+    Args:
+        _items = ordered from least to most recently used, key - key, value - [value, expire time, size]
+        hits, misses = counters of get() calls
+        evictions = count of items removed by limit of items or bytes
+        expirations = count of items removed by ttl
+    '''
+
+    def __init__(self, max_items=CACHE_MAX_ITEMS, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._items = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return self._get_item(key) is not None
+
+    def _get_item(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        if self._ttl and item[1] < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return item
+
+    def _remove(self, key):
+        item = self._items.pop(key)
+        self._bytes -= item[2]
+        return item
+
+    def get(self, key, default=None):
+        item = self._get_item(key)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end(key)
+        return item[0]
+
+    def set(self, key, value):
+        if key in self._items:
+            self._remove(key)
+        size = get_size(key, value)
+        self._items[key] = [value, time.monotonic() + self._ttl, size]
+        self._bytes += size
+        self._evict()
+
+    def pop(self, key, default=None):
+        if key not in self._items:
+            return default
+        return self._remove(key)[0]
+
+    def _evict(self):
+        # drop expired items from the head, each item is dropped once, so amortized cost is O(1)
+        now = time.monotonic()
+        while self._ttl and self._items:
+            key, item = next(iter(self._items.items()))
+            if item[1] >= now:
+                break
+            self._remove(key)
+            self.expirations += 1
+        while self._items and (self._max_items and len(self._items) > self._max_items or
+                               self._max_bytes and self._bytes > self._max_bytes):
+            self._remove(next(iter(self._items)))
+            self.evictions += 1
+
+    def get_stats(self):
+        return {
+            'items': len(self._items),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
 class SharedData:
-    def __init__(self):
-        self._results = dict()                  # results of calculated expressions, key - pid, value - result
-        self._calculated_expressions = dict()   # cache of soon calculated expressions, key - expression, value - pid
-        self._processing = set()                # pid's now running
+    '''
+    class SharedData,
+    state of jobs and caches of server process, with backend (see backends.py) pids, results, errors and
+    processing expressions are shared with other servers and evaluators, local caches are checked first
+    '''
+
+    def __init__(self, max_items=CACHE_MAX_ITEMS, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL, storage=None,
+                 backend=None):
+        def cache():
+            return BoundedCache(max_items, max_bytes, ttl)
+        self._results = cache()                 # results of calculated expressions, key - pid, value - result
+        self._calculated_expressions = cache()  # cache of soon calculated expressions, key - expression, value - pid
+        self._processing = dict()               # pid's now running, value - expression
         self._processing_expressions = dict()   # dict of processing expressions, key - expression, value - pid
-        self._errors = dict()                   # dict of errors, key - pid, value - err_text
+        self._errors = cache()                  # dict of errors, key - pid, value - err_text
         self._pid_counter = 0
-        self._invalid_expressions = set()      #cache of invalid expressions, key - expression
+        self._invalid_expressions = cache()     # cache of invalid expressions, key - expression, value - True
+        self._programs = cache()                # cache of compiled expressions, key - expression, value - Program
+        self._subtree_values = cache()          # cache of values of chains with slow operations, key - digest
+        self._cancelled = cache()               # stopped jobs, key - pid, value - 'cancelled' or 'timeout'
+        self._listeners = dict()                # callbacks called when job is done, key - pid, value - list
+        self._traces = cache()                  # events of jobs, key - pid, value - list of [event, time]
+        self._storage = storage                 # on-disk store of results and errors, optional
+        self._pid_limit = 0                     # end of pid block reserved in storage
+        self._backend = backend                 # store shared by servers and evaluators, optional
+        self._remote = set()                    # pids of jobs of other servers or evaluators with listeners
+        if storage:
+            self._load(max_items, ttl)
+
+    def _load(self, max_items, ttl):
+        results, errors, self._pid_counter = self._storage.load(max_items, ttl)
+        for pid, expression, res in results:
+            self._calculated_expressions.set(expression, pid)
+            self._results.set(pid, res)
+        for pid, expression, err_text in errors:
+            self._errors.set(pid, err_text)
+            self.add_invalid(expression)
+        self._pid_limit = self._pid_counter
+        log('loaded results = %s errors = %s pid = %s', ErrorLvls.INFO, 'SharedData', len(results), len(errors),
+            self._pid_counter)
 
     def _del_from_processing(self, pid, expression):
         if pid in self._processing:
-            self._processing.remove(pid)
+            del self._processing[pid]
             if expression in self._processing_expressions:
                 del self._processing_expressions[expression]
+        for callback in self._listeners.pop(pid, ()):
+            callback(pid)
+
+    def add_listener(self, pid, callback):
+        '''
+        callback(pid) is called once when result or error of job with pid is added,
+        it isn't called if job isn't processing, jobs of other servers are checked by check_backend()
+        '''
+        if pid in self._processing:
+            self._listeners.setdefault(pid, []).append(callback)
+        elif self.is_processing(pid):
+            self._listeners.setdefault(pid, []).append(callback)
+            self._remote.add(pid)
+
+    def remove_listener(self, pid, callback):
+        callbacks = self._listeners.get(pid)
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+            if not callbacks:
+                del self._listeners[pid]
+                self._remote.discard(pid)
+
+    def check_backend(self):
+        '''
+        call listeners of jobs of other servers which are done, keep own jobs processing in backend
+        :return: list of own pids which aren't processing in backend: cancelled by other server,
+        calculated by evaluator or expired
+        '''
+        if not self._backend:
+            return []
+        for pid in self._remote - self._backend.get_processing_pids(self._remote):
+            self._remote.discard(pid)
+            for callback in self._listeners.pop(pid, ()):
+                callback(pid)
+        own = list(self._processing)
+        return list(set(own) - self._backend.refresh_processing(own))
+
+    def forget_processing(self, pid):
+        '''
+        remove own pid from processing when its job is finished in backend
+        '''
+        self._del_from_processing(pid, self._processing.get(pid))
+
+    def is_own(self, pid):
+        '''
+        :return: True if job of pid is processing in this server
+        '''
+        return pid in self._processing
+
+    def push_job(self, pid, expression):
+        '''
+        send job to evaluators connected to backend
+        '''
+        self._backend.push_job(pid, expression)
+
+    def add_trace(self, pid, event, timestamp=None):
+        '''
+        add event to trace of pid, trace is started when pid is added to processing
+        '''
+        trace = self._traces.get(pid)
+        if trace is not None:
+            trace.append([event, time.time() if timestamp is None else timestamp])
+
+    def get_trace(self, pid):
+        '''
+        :return: list of [event, time] of job of pid ordered by time, None if it's unknown
+        '''
+        trace = self._traces.get(pid)
+        if trace is None:
+            return None
+        return sorted(trace, key=lambda event: event[1])
 
     def add_result(self, res, pid, expression):
-        self._calculated_expressions[expression] = pid
-        self._results[pid] = res
+        self.add_trace(pid, 'result stored')
+        self._calculated_expressions.set(expression, pid)
+        self._results.set(pid, res)
         self._del_from_processing(pid, expression)
-        print('\nend process pid=%s res=%s expression = %s\n' % (pid, res, expression))
+        if self._backend:
+            self._backend.set_result(pid, expression, res)
+        if self._storage:
+            self._storage.save_result(pid, expression, res)
+        log('end process pid=%s res=%s expression = %s', ErrorLvls.INFO, 'SharedData', pid, res, expression)
 
     def add_processing(self, expression):
-        pid = self._pid_counter
-        self._processing.add(pid)
+        '''
+        :return: pid of new job of expression, with backend it's pid of job of other server
+        if expression was started there first, see is_own()
+        '''
+        if self._backend:
+            pid = self._backend.next_pid()
+            other_pid = self._backend.claim(expression, pid)
+            if other_pid != pid:
+                return other_pid
+        else:
+            pid = self._pid_counter
+            if self._storage and pid >= self._pid_limit:
+                self._pid_limit = self._storage.reserve_pids(pid)
+            self._pid_counter += 1
+        self._processing[pid] = expression
         self._processing_expressions[expression] = pid
-        self._pid_counter += 1
-        print('\nstart process pid=%s expression=%s\n' % (pid, expression))
+        self._traces.set(pid, [['submit', time.time()]])
+        log('start process pid=%s expression=%s', ErrorLvls.INFO, 'SharedData', pid, expression)
         return pid
 
     def add_error(self, err_text, pid, expression):
-        self._errors[pid] = 'ERROR: %s in calculating expression %s; task with pid = %s failed\n' % (err_text, expression, pid)
+        err_text = 'ERROR: %s in calculating expression %s; task with pid = %s failed\n' % (err_text, expression, pid)
+        self.add_trace(pid, 'error stored')
+        self._errors.set(pid, err_text)
         self._del_from_processing(pid, expression)
+        if self._backend:
+            self._backend.set_error(pid, expression, err_text)
+        if self._storage:
+            self._storage.save_error(pid, expression, err_text)
+        self.add_invalid(expression)
+
+    def add_invalid(self, expression):
         if not expression in self._invalid_expressions:
-            self._invalid_expressions.add(expression)
+            self._invalid_expressions.set(expression, True)
 
     def is_invalid(self, expression):
-        return expression in self._invalid_expressions
+        if expression in self._invalid_expressions:
+            metrics.INVALID_HITS.inc()
+            return True
+        return False
 
     def get_cached(self, expression):
-        if expression in self._calculated_expressions:
-            if self._calculated_expressions[expression] in self._results:
-                return self._results[self._calculated_expressions[expression]]
+        pid = self._calculated_expressions.get(expression)
+        if pid is not None:
+            res = self._results.get(pid)
+            if res is not None:
+                metrics.CACHE_HITS.inc()
+                return res
+        if self._backend:
+            res = self._backend.get_cached(expression)
+            if res is not None:
+                metrics.CACHE_HITS.inc()
+                return res
+        metrics.CACHE_MISSES.inc()
         return None
 
+    def get_processing_count(self):
+        return len(self._processing)
+
+    def add_program(self, program, expression):
+        self._programs.set(expression, program)
+
+    def get_program(self, expression):
+        return self._programs.get(expression)
+
+    def add_subtree_values(self, digests, values):
+        for digest, value in zip(digests, values):
+            if value is not None:
+                self._subtree_values.set(digest, value)
+
+    def get_subtree_values(self, digests):
+        '''
+        :return: list of known values of chains with digests, None if value is unknown
+        '''
+        return [self._subtree_values.get(digest) for digest in digests]
+
+    def has_subtree_values(self):
+        return len(self._subtree_values) > 0
+
     def get_processing(self, expression):
         if expression in self._processing_expressions:
             return self._processing_expressions[expression]
+        if self._backend:
+            return self._backend.get_processing(expression)
         return None
 
+    def _get_shared(self, cache, pid, get_func):
+        '''
+        :return: value of pid from local cache or from backend by get_func(pid), it's cached locally
+        '''
+        value = cache.get(pid)
+        if value is None and self._backend:
+            value = get_func(pid)
+            if value is not None:
+                cache.set(pid, value)
+        return value
+
     def get_result(self, pid):
-        if pid in self._results:
-            return self._results[pid]
-        return None
+        return self._get_shared(self._results, pid, self._backend and self._backend.get_result)
 
     def get_error(self, pid):
-        if pid in self._errors:
-            return self._errors[pid]
-        return None
+        return self._get_shared(self._errors, pid, self._backend and self._backend.get_error)
+
+    def add_cancelled(self, status, pid):
+        '''
+        stop processing of pid with status 'cancelled' or 'timeout',
+        expression isn't marked as invalid, so it can be calculated again
+        '''
+        self.add_trace(pid, status)
+        self._cancelled.set(pid, status)
+        expression = self._processing.get(pid)
+        self._del_from_processing(pid, expression)
+        if self._backend:
+            self._backend.set_cancelled(pid, status, expression)
+        log('stop process pid=%s status=%s', ErrorLvls.INFO, 'SharedData', pid, status)
+
+    def get_cancelled(self, pid):
+        return self._get_shared(self._cancelled, pid, self._backend and self._backend.get_cancelled)
 
     def is_processing(self, pid):
-        return pid in self._processing
\ No newline at end of file
+        if pid in self._processing:
+            return True
+        return bool(self._backend) and bool(self._backend.get_processing_pids([pid]))
+
+    def get_stats(self):
+        return {
+            'results': self._results.get_stats(),
+            'calculated_expressions': self._calculated_expressions.get_stats(),
+            'errors': self._errors.get_stats(),
+            'invalid_expressions': self._invalid_expressions.get_stats(),
+            'programs': self._programs.get_stats(),
+            'subtree_values': self._subtree_values.get_stats(),
+            'cancelled': self._cancelled.get_stats(),
+            'traces': self._traces.get_stats()
+        }
+
+    def close(self):
+        if self._storage:
+            self._storage.close()
+        if self._backend:
+            self._backend.close()
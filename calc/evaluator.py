@@ -0,0 +1,74 @@
+import argparse
+import multiprocessing
+import os
+import sys
+
+from backends import get_backend, REDIS_URL
+from data import SharedData
+from logs import logger
+import metrics
+import proc
+
+
+def evaluate_job(shared_data, backend, pid, expression):
+    '''
+    calculate job from queue of backend and store its result or error, job cancelled meanwhile is skipped
+    :return: False if job is skipped
+    '''
+    if not backend.get_processing_pids([pid]):
+        return False
+    res, err, program, values = proc.process_func(None, pid, expression)
+    # traces and metrics are collected by servers only
+    proc.take_events()
+    metrics.registry.drain()
+    logger.flush()
+    if not backend.get_processing_pids([pid]):
+        return False
+    if res is not None:
+        shared_data.add_result(res, pid, expression)
+    else:
+        shared_data.add_error(err, pid, expression)
+    return True
+
+
+def run_evaluator(backend, count=0, timeout=1):
+    '''
+    loop of evaluator: pop jobs from queue of backend and calculate them one by one
+    :input: count - stop after count jobs or when queue is empty, 0 - endless,
+    timeout - seconds to wait for job in queue before next try
+    :return: count of calculated jobs
+    '''
+    shared_data = SharedData(backend=backend)
+    done = 0
+    while not count or done < count:
+        job = backend.pop_job(timeout)
+        if job is None:
+            if count:
+                break
+            continue
+        if evaluate_job(shared_data, backend, *job):
+            done += 1
+    return done
+
+
+def evaluator_main():
+    try:
+        run_evaluator(get_backend())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Calculate jobs of servers started with CALC_REMOTE_EVALUATORS=1.')
+    parser.add_argument('--processes', metavar='N', type=int, default=proc.WORKERS,
+                        help='count of evaluator processes, default - CALC_WORKERS or count of cpus')
+    args = parser.parse_args()
+    if not REDIS_URL:
+        print('CALC_REDIS_URL of backend shared with servers is required')
+        sys.exit(1)
+    processes = [multiprocessing.Process(target=evaluator_main) for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    print('%s evaluators are started, pid = %s' % (len(processes), os.getpid()))
+    for process in processes:
+        process.join()
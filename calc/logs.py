@@ -0,0 +1,186 @@
+import multiprocessing
+import os
+import time
+
+
+class ErrorLvls:
+    INFO = 0
+    WARN = 1
+    ERR = 2
+    OFF = 3
+
+
+err_texts = ['INFO', 'WARN', 'ERR', 'OFF']
+
+# minimum level of logged messages: INFO, WARN, ERR or OFF
+LOG_LEVEL = err_texts.index(os.environ.get('CALC_LOG_LEVEL', 'OFF').upper())
+# file of log, it's rotated when it's larger than LOG_MAX_BYTES, LOG_BACKUPS previous files are kept
+LOG_PATH = os.environ.get('CALC_LOG_PATH', 'log.txt')
+LOG_MAX_BYTES = int(os.environ.get('CALC_LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.environ.get('CALC_LOG_BACKUPS', 3))
+# only each N-th INFO message is logged, warnings and errors are always logged
+LOG_SAMPLE = int(os.environ.get('CALC_LOG_SAMPLE', 1))
+# messages are sent to writer when there are LOG_BATCH of them or the oldest one waits LOG_FLUSH_TIME seconds
+LOG_BATCH = 1000
+LOG_FLUSH_TIME = 1.0
+
+
+class LogWriter:
+    '''
+    class LogWriter,
+    buffered writer of lines to file with rotation by size: path -> path.1 -> path.2 ... path.backups
+    '''
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._file = open(path, 'a', buffering=1024 * 1024)
+        self._size = self._file.tell()
+
+    def write(self, lines):
+        text = ''.join(lines)
+        if self._max_bytes and self._size and self._size + len(text) > self._max_bytes:
+            self._rotate()
+        self._file.write(text)
+        self._size += len(text)
+
+    def _rotate(self):
+        self._file.close()
+        if self._backups:
+            for i in range(self._backups - 1, 0, -1):
+                if os.path.exists('%s.%s' % (self._path, i)):
+                    os.replace('%s.%s' % (self._path, i), '%s.%s' % (self._path, i + 1))
+            os.replace(self._path, '%s.1' % self._path)
+        self._file = open(self._path, 'w', buffering=1024 * 1024)
+        self._size = 0
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def writer_main(queue, path, max_bytes, backups):
+    '''
+    loop of writer process: receive lists of lines from queue and write them, None stops writer,
+    file is flushed when queue is empty
+    '''
+    writer = LogWriter(path, max_bytes, backups)
+    while True:
+        try:
+            lines = queue.get()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if lines is None:
+            break
+        writer.write(lines)
+        if queue.empty():
+            writer.flush()
+    writer.close()
+
+
+class Logger:
+    '''
+    class Logger,
+    messages are formatted only if they pass level check and sampling, formatted lines are buffered and
+    sent to writer process in batches, without writer process they are written to file by this process
+    Args:
+        level = minimum level of logged messages, ErrorLvls.OFF - nothing is logged
+        _sample, _skipped = each _sample-th INFO message is logged, count of skipped ones
+        _queue = queue of writer process, it's shared by server and worker processes
+    '''
+
+    def __init__(self, level=LOG_LEVEL, path=LOG_PATH, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS,
+                 sample=LOG_SAMPLE):
+        self.level = level
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._sample = max(sample, 1)
+        self._skipped = 0
+        self._buffer = []
+        self._buffer_time = 0
+        self._queue = None
+        self._process = None
+        self._writer = None
+
+    def start(self):
+        '''
+        start writer process, it's called once in server process before start of workers
+        '''
+        if self.level == ErrorLvls.OFF or self._process:
+            return
+        self._queue = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=writer_main, daemon=True,
+                                                args=(self._queue, self._path, self._max_bytes, self._backups))
+        self._process.start()
+
+    def get_queue(self):
+        return self._queue
+
+    def connect(self, queue):
+        '''
+        send messages to writer process with queue, it's called in worker process
+        '''
+        self._queue = queue
+        self._process = None
+        self._buffer = []                       # copied from parent by fork
+
+    def log(self, message_str, error_lvl=ErrorLvls.INFO, context='', args=()):
+        if error_lvl < self.level:
+            return
+        if error_lvl == ErrorLvls.INFO and self._sample > 1:
+            self._skipped += 1
+            if self._skipped < self._sample:
+                return
+            self._skipped = 0
+        if args:
+            message_str = message_str % args
+        now = time.time()
+        if not self._buffer:
+            self._buffer_time = now
+        self._buffer.append('%.6f %s [%s] %s%s\n' % (now, os.getpid(), err_texts[error_lvl],
+                                                      ('in %s: ' % context) if context else '', message_str))
+        if len(self._buffer) >= LOG_BATCH or now - self._buffer_time > LOG_FLUSH_TIME:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        lines = self._buffer
+        self._buffer = []
+        if self._queue is not None:
+            self._queue.put(lines)
+            return
+        if self._writer is None:
+            self._writer = LogWriter(self._path, self._max_bytes, self._backups)
+        self._writer.write(lines)
+        self._writer.flush()
+
+    def close(self):
+        '''
+        flush messages and stop writer process
+        '''
+        self.flush()
+        if self._process:
+            self._queue.put(None)
+            self._process.join(5)
+            self._process = None
+            self._queue = None
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+
+logger = Logger()
+
+
+def log(message_str='', error_lvl=ErrorLvls.INFO, context='', *args):
+    '''
+    log message_str % args, arguments are formatted only if message is logged,
+    loops of messages should check logger.level before them
+    '''
+    if error_lvl >= logger.level:
+        logger.log(message_str, error_lvl, context, args)
@@ -1,30 +1,203 @@
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
 import app_context
-from proc import start_calculation
+from calc import StreamParser, ParseError, compile_template
+from proc import start_calculation, calculate_inline, cancel_calculation, get_progress, process_template, WorkerPool, \
+    QueueFullError, WorkerError, PARALLEL_PARTS, OPTIMIZE, REMOTE_EVALUATORS, check_backend, get_queue_position, \
+    get_job_cost
 from data import SharedData
+from storage import SqliteStorage
+from backends import get_backend
+from logs import logger, LOG_FLUSH_TIME
+import metrics
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+# maximum count of expressions in /calculate/batch and of pids in /results
+MAX_BATCH = int(os.environ.get('CALC_MAX_BATCH', 10000))
+# maximum time of long poll in /result, seconds
+MAX_WAIT = float(os.environ.get('CALC_MAX_WAIT', 60))
+# maximum count of rows of bindings in /calculate/template
+MAX_ROWS = int(os.environ.get('CALC_MAX_ROWS', 1000000))
+# period of keep-alive comments in /results/stream, seconds
+SSE_KEEPALIVE = 15
+# period of checks of jobs of other servers and evaluators in backend, seconds
+BACKEND_POLL = float(os.environ.get('CALC_BACKEND_POLL', 0.2))
+# names of phases of job which end with events of trace
+TRACE_PHASES = {
+    'worker start': 'queue wait',
+    'parse end': 'parse',
+    'optimize end': 'optimize',
+    'compile end': 'compile',
+    'evaluate end': 'evaluate',
+    'result stored': 'return',
+}
 
 class Data(BaseModel):
     expression: str
+    timeout: Optional[float] = None
+
+class BatchData(BaseModel):
+    expressions: List[str]
+    timeout: Optional[float] = None
+
+class TemplateData(BaseModel):
+    expression: str
+    bindings: Dict[str, List[float]]
 
 app = FastAPI()
 
 @app.post("/calculate")
-async def calculate(data:Data):
+async def calculate(data:Data, request: Request):
     '''
-    :input: expression
+    :input: expression, timeout - seconds to stop calculation with status 'timeout', optional,
+    X-Client-Id header - id of client for fair share of pool, default - address of client
     :return: result of math expression or processing status or error
     '''
-    expression = data.expression
+    try:
+        return submit_expression(data.expression, data.timeout, get_client(request))
+    except QueueFullError:
+        return busy_response()
+
+@app.post("/calculate/batch")
+async def calculate_batch(data:BatchData, request: Request):
+    '''
+    :input: list of expressions
+    :return: list of results, pids or errors in the same order, each one as in /calculate,
+    repeated expressions are calculated once
+    '''
+    if len(data.expressions) > MAX_BATCH:
+        return {
+            "ret": 'too many expressions, maximum is %s' % MAX_BATCH,
+            "status": "Nok"
+        }
+    results = []
+    client = get_client(request)
+    for expression in data.expressions:
+        try:
+            results.append(submit_expression(expression, data.timeout, client))
+        except QueueFullError:
+            results.append({
+                "ret": 'server is busy, try later',
+                "status": "Nok"
+            })
+    return {
+        "ret": results,
+        "status": "ok"
+    }
+
+@app.post("/calculate/stream")
+async def calculate_stream(request: Request):
+    '''
+    :input: expression as raw or chunked request body, it's parsed while it's received
+    :return: the same as /calculate
+    '''
+    parser = StreamParser()
+    loop = asyncio.get_event_loop()
+    try:
+        async for chunk in request.stream():
+            # parsing of long expression doesn't block other requests
+            await loop.run_in_executor(None, parser.feed, chunk)
+        expression, program = await loop.run_in_executor(None, parser.finish, PARALLEL_PARTS, OPTIMIZE)
+    except ParseError as e:
+        return {
+            "ret": 'invalid expression: %s' % e,
+            "status": "Nok"
+        }
+    if app_context.stored_results.get_program(expression) is None:
+        app_context.stored_results.add_program(program, expression)
+    try:
+        return submit_expression(expression, None, get_client(request))
+    except QueueFullError:
+        return busy_response()
+
+@app.post("/calculate/template")
+async def calculate_template(data:TemplateData, request: Request):
+    '''
+    :input: expression with variables, bindings - columns of values of variables by name, of equal length
+    :return: list of results for each row of bindings, null for rows with division by zero,
+    expression is parsed once and calculated for all rows at once
+    '''
+    start_time = time.monotonic()
+    program, err = compile_template(data.expression, OPTIMIZE)
+    metrics.PARSE_SECONDS.observe(time.monotonic() - start_time)
+    if program is None:
+        return {
+            "ret": 'invalid expression: %s' % err,
+            "status": "Nok"
+        }
+    missing = [name for name in program.variables if name not in data.bindings]
+    if missing:
+        return {
+            "ret": 'values of variables %s are expected' % ', '.join(missing),
+            "status": "Nok"
+        }
+    lengths = set(len(column) for column in data.bindings.values())
+    if len(lengths) > 1:
+        return {
+            "ret": 'columns of bindings should have equal length',
+            "status": "Nok"
+        }
+    rows = lengths.pop() if lengths else 1
+    if rows > MAX_ROWS:
+        return {
+            "ret": 'too many rows, maximum is %s' % MAX_ROWS,
+            "status": "Nok"
+        }
+    columns = [data.bindings[name] for name in program.variables]
+    try:
+        future = app_context.pool.submit(process_template, program, columns, rows, cost=get_job_cost(program, rows),
+                                         client=get_client(request))
+    except QueueFullError:
+        return busy_response()
+    try:
+        res, err = await future
+    except WorkerError as e:
+        res, err = None, '%s' % e
+    if err:
+        return {
+            "ret": err,
+            "status": "Nok"
+        }
+    return {
+        "ret": res,
+        "status": "ok"
+    }
+
+def busy_response():
+    return JSONResponse(status_code=503, content={
+        "ret": 'server is busy, try later',
+        "status": "Nok"
+    })
+
+def get_client(request):
+    '''
+    :return: id of client for fair share of pool: X-Client-Id header or address of client
+    '''
+    client = request.headers.get('x-client-id')
+    if not client and request.client:
+        client = request.client.host
+    return client
+
+def submit_expression(expression, timeout=None, client=None):
+    '''
+    return cached result or pid of expression in processing, calculate cheap expression in request,
+    otherwise start calculation in pool, raise QueueFullError if queue of pool is full,
+    response with pid has "pid" field, so pid isn't mixed up with integer result
+    '''
     if app_context.stored_results.is_invalid(expression):
         return {
             "ret": 'invalid expression',
             "status": "Nok"
         }
     cached = app_context.stored_results.get_cached(expression)
-    if cached:
+    if cached is not None:
         return {
             "ret": cached,
             "status": "ok"
@@ -32,45 +205,286 @@ async def calculate(data:Data):
     else:
         pid = app_context.stored_results.get_processing(expression)
         if pid == None:
+            is_calculated, res, err = calculate_inline(expression)
+            if is_calculated:
+                if err:
+                    return {
+                        "ret": 'invalid expression: %s' % err,
+                        "status": "Nok"
+                    }
+                return {
+                    "ret": res,
+                    "status": "ok"
+                }
+            if app_context.pool.is_full():
+                raise QueueFullError('queue of jobs is full')
             pid = app_context.stored_results.add_processing(expression)
-            start_calculation(pid, expression)
+            if app_context.stored_results.is_own(pid):     # else other server has started expression first
+                start_calculation(pid, expression, timeout, client)
         return {
             "ret": pid,
-            "status": "ok"
+            "status": "ok",
+            "pid": pid
         }
 
 @app.get("/result")
-async def get_result(id: int = 0):
+async def get_result(id: int = 0, wait: float = 0, trace: int = 0):
     '''
-    :input: pid
+    :input: pid, wait - seconds to wait for the end of processing (long poll), up to CALC_MAX_WAIT,
+    trace - 1: add events of job with time and seconds since previous event
     :return: result of math expression or processing status or error
     '''
+    if wait > 0:
+        await wait_for_result(id, min(wait, MAX_WAIT))
+    response = find_result(id)
+    if trace:
+        events = app_context.stored_results.get_trace(id) or []
+        response["trace"] = [{
+            "event": event,
+            "time": timestamp,
+            "seconds": timestamp - events[i - 1][1] if i else 0
+        } for i, (event, timestamp) in enumerate(events)]
+    return response
+
+@app.get("/traces")
+async def get_traces(ids: str = ''):
+    '''
+    :input: comma separated pids
+    :return: traces of jobs in Chrome trace event format, it can be saved to file and opened in
+    chrome://tracing or Perfetto, each job is a thread with phases between events of its trace
+    '''
+    try:
+        pids = parse_ids(ids)
+    except ValueError as e:
+        return {
+            "ret": '%s' % e,
+            "status": "Nok"
+        }
+    trace_events = []
+    for pid in pids:
+        events = app_context.stored_results.get_trace(pid) or []
+        for i, (event, timestamp) in enumerate(events):
+            trace_events.append({
+                "name": event, "ph": "i", "s": "t", "pid": 1, "tid": pid, "ts": timestamp * 1e6
+            })
+            if i:
+                start = events[i - 1][1]
+                trace_events.append({
+                    "name": TRACE_PHASES.get(event, event), "ph": "X", "pid": 1, "tid": pid,
+                    "ts": start * 1e6, "dur": (timestamp - start) * 1e6
+                })
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+@app.get("/results/stream")
+async def stream_results(ids: str = ''):
+    '''
+    :input: comma separated pids
+    :return: server-sent events, event with result of each pid (as in /result) is sent when it's ready,
+    stream is closed after the last one
+    '''
+    try:
+        pids = parse_ids(ids)
+    except ValueError as e:
+        return {
+            "ret": '%s' % e,
+            "status": "Nok"
+        }
+    return StreamingResponse(result_events(pids), media_type='text/event-stream')
+
+async def wait_for_result(pid, timeout):
+    future = asyncio.get_event_loop().create_future()
+
+    def on_done(pid):
+        if not future.done():
+            future.set_result(pid)
+
+    app_context.stored_results.add_listener(pid, on_done)
+    if not app_context.stored_results.is_processing(pid):
+        on_done(pid)
+    try:
+        await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        app_context.stored_results.remove_listener(pid, on_done)
+
+async def result_events(pids):
+    '''
+    generator of server-sent events with results of pids in order of completion
+    '''
+    done = asyncio.Queue()
+    waiting = set()
+    for pid in pids:
+        if app_context.stored_results.is_processing(pid):
+            if pid not in waiting:
+                waiting.add(pid)
+                app_context.stored_results.add_listener(pid, done.put_nowait)
+        else:
+            done.put_nowait(pid)
+    try:
+        while not done.empty() or waiting:
+            try:
+                pid = await asyncio.wait_for(done.get(), SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ': keep-alive\n\n'
+                continue
+            waiting.discard(pid)
+            yield 'id: %s\ndata: %s\n\n' % (pid, json.dumps(dict(find_result(pid), id=pid)))
+    finally:
+        for pid in waiting:
+            app_context.stored_results.remove_listener(pid, done.put_nowait)
+
+@app.delete("/result")
+async def delete_result(id: int = 0):
+    '''
+    :input: pid
+    :return: ok if calculation of pid is cancelled, Nok if it isn't processing
+    '''
+    if cancel_calculation(id):
+        return {
+            "ret": 'cancelled',
+            "status": "ok"
+        }
+    return {
+        "ret": 'not processing',
+        "status": "Nok"
+    }
+
+@app.get("/results")
+async def get_results(ids: str = ''):
+    '''
+    :input: comma separated pids
+    :return: list of results in the same order, each one as in /result
+    '''
+    try:
+        pids = parse_ids(ids)
+    except ValueError as e:
+        return {
+            "ret": '%s' % e,
+            "status": "Nok"
+        }
+    return {
+        "ret": [find_result(pid) for pid in pids],
+        "status": "ok"
+    }
+
+def parse_ids(ids):
+    '''
+    :return: list of pids from comma separated string, raise ValueError if it's invalid
+    '''
+    try:
+        pids = [int(pid) for pid in ids.split(',') if pid.strip()]
+    except ValueError:
+        raise ValueError('ids should be comma separated integers')
+    if len(pids) > MAX_BATCH:
+        raise ValueError('too many ids, maximum is %s' % MAX_BATCH)
+    return pids
+
+def find_result(id):
     result = app_context.stored_results.get_result(id)
-    if result:
+    if result is not None:
         return {
             "ret": result,
             "status": "ok"
         }
     else:
         if app_context.stored_results.is_processing(id):
-            return {
+            response = {
                 "ret": 'processing soon...',
                 "status": "ok"
             }
+            position = get_queue_position(id)
+            if position is not None:
+                response["queue_position"] = position
+            progress = get_progress(id)
+            if progress:
+                percent, seconds_left = progress
+                response["progress"] = {
+                    "percent": percent,
+                    "seconds_left": seconds_left,
+                    "finish_time": time.time() + seconds_left
+                }
+            return response
         else:
             error = app_context.stored_results.get_error(id)
+            cancelled = app_context.stored_results.get_cancelled(id)
             if error:
                 return {
                     "ret": error,
                     "status": "Nok"
                 }
+            elif cancelled:
+                return {
+                    "ret": 'calculation is stopped',
+                    "status": cancelled
+                }
             else:
                 return {
                     "ret": 'not found',
                     "status": "Nok"
                 }
 
+@app.get("/stats")
+async def get_stats():
+    '''
+    :return: sizes, hit/miss and eviction counters of caches
+    '''
+    return {
+        "ret": app_context.stored_results.get_stats(),
+        "status": "ok"
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    '''
+    :return: metrics in Prometheus text format: sizes of queue and pool, cache hits and misses,
+    histograms of parse, evaluation and queue wait times
+    '''
+    pool = app_context.pool
+    workers = pool.get_worker_count()
+    metrics.QUEUE_DEPTH.set(pool.get_queue_size())
+    metrics.JOBS_IN_FLIGHT.set(pool.get_running_count())
+    metrics.WORKERS.set(workers)
+    metrics.WORKER_UTILIZATION.set(min(pool.get_running_count() / workers, 1.0) if workers else 0)
+    metrics.PROCESSING.set(app_context.stored_results.get_processing_count())
+    return PlainTextResponse(metrics.registry.export(), media_type='text/plain; version=0.0.4')
+
+async def flush_log():
+    '''
+    send buffered messages of server process to writer of log, workers send them after each job
+    '''
+    while True:
+        await asyncio.sleep(LOG_FLUSH_TIME)
+        logger.flush()
+
+async def poll_backend():
+    '''
+    notify listeners of jobs finished by other servers and evaluators, keep own jobs in backend
+    '''
+    while True:
+        await asyncio.sleep(BACKEND_POLL)
+        check_backend()
+
 @app.on_event("startup")
 async def startup_event():
-    app_context.stored_results = SharedData()
+    # writer of log is started before workers, they get its queue
+    logger.start()
+    storage_path = os.environ.get('CALC_STORAGE_PATH')
+    backend = get_backend()
+    if REMOTE_EVALUATORS and backend is None:
+        raise RuntimeError('CALC_REMOTE_EVALUATORS requires CALC_REDIS_URL')
+    app_context.stored_results = SharedData(storage=SqliteStorage(storage_path) if storage_path else None,
+                                            backend=backend)
+    app_context.pool = WorkerPool()
+    app_context.log_task = asyncio.ensure_future(flush_log())
+    app_context.backend_task = asyncio.ensure_future(poll_backend()) if backend else None
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app_context.log_task.cancel()
+    if app_context.backend_task:
+        app_context.backend_task.cancel()
+    app_context.pool.shutdown()
+    app_context.stored_results.close()
+    logger.close()
 
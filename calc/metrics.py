@@ -0,0 +1,164 @@
+import bisect
+
+# upper bounds of buckets of histograms, seconds
+PARSE_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+EVALUATION_BUCKETS = [0.001, 0.01, 0.1, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+
+
+class Counter:
+    '''
+    class Counter,
+    monotonically growing value, e.g. count of requests
+    '''
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def reset(self):
+        self.value = 0
+
+    def get_lines(self):
+        return ['%s %s' % (self.name, self.value)]
+
+
+class Gauge:
+    '''
+    class Gauge,
+    value which goes up and down, e.g. size of queue, it's set before export
+    '''
+    type = 'gauge'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def reset(self):
+        self.value = 0
+
+    def get_lines(self):
+        return ['%s %s' % (self.name, self.value)]
+
+
+class Histogram:
+    '''
+    class Histogram,
+    distribution of observed values by buckets, e.g. durations
+    Args:
+        buckets = sorted upper bounds of buckets, the last bucket +Inf is implicit
+        counts = counts of values in each bucket, not cumulative, the last one is +Inf
+        sum, count = sum and count of all values
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.reset()
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def merge(self, counts, sum, count):
+        for i, bucket_count in enumerate(counts):
+            self.counts[i] += bucket_count
+        self.sum += sum
+        self.count += count
+
+    def get_lines(self):
+        lines = []
+        total = 0
+        for bucket, bucket_count in zip(self.buckets + ['+Inf'], self.counts):
+            total += bucket_count
+            lines.append('%s_bucket{le="%s"} %s' % (self.name, bucket, total))
+        lines.append('%s_sum %s' % (self.name, self.sum))
+        lines.append('%s_count %s' % (self.name, self.count))
+        return lines
+
+
+class Registry:
+    '''
+    class Registry,
+    metrics of process by name, they are exported in Prometheus text format
+    '''
+
+    def __init__(self):
+        self._metrics = dict()
+
+    def add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def drain(self):
+        '''
+        reset histograms, it's used in worker processes to send observations to parent after each job
+        :return: list of [name, counts, sum, count] of histograms with new observations
+        '''
+        observations = []
+        for metric in self._metrics.values():
+            if metric.type == 'histogram' and metric.count:
+                observations.append([metric.name, metric.counts, metric.sum, metric.count])
+                metric.reset()
+        return observations
+
+    def merge(self, observations):
+        '''
+        add observations of histograms from drain() of other process
+        '''
+        for name, counts, sum, count in observations:
+            self._metrics[name].merge(counts, sum, count)
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def export(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.get_lines())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+QUEUE_DEPTH = registry.add(Gauge('calc_queue_depth', 'Count of jobs waiting for free worker.'))
+JOBS_IN_FLIGHT = registry.add(Gauge('calc_jobs_in_flight', 'Count of jobs running in workers.'))
+WORKERS = registry.add(Gauge('calc_workers', 'Count of worker processes.'))
+WORKER_UTILIZATION = registry.add(Gauge('calc_worker_utilization', 'Share of busy workers, from 0 to 1.'))
+WORKER_BUSY_SECONDS = registry.add(Counter('calc_worker_busy_seconds_total',
+                                           'Total time of jobs in workers, its rate divided by calc_workers '
+                                           'is average utilization.'))
+PROCESSING = registry.add(Gauge('calc_processing_expressions', 'Count of expressions being calculated.'))
+CACHE_HITS = registry.add(Counter('calc_cache_hits_total', 'Expressions answered from cache of results.'))
+CACHE_MISSES = registry.add(Counter('calc_cache_misses_total', 'Expressions not found in cache of results.'))
+INVALID_HITS = registry.add(Counter('calc_invalid_cache_hits_total',
+                                    'Expressions rejected by cache of invalid expressions.'))
+PARSE_SECONDS = registry.add(Histogram('calc_parse_seconds', 'Time of parsing and compiling of expression.',
+                                       PARSE_BUCKETS))
+EVALUATION_SECONDS = registry.add(Histogram('calc_evaluation_seconds',
+                                            'Time of calculation of compiled expression with delays.',
+                                            EVALUATION_BUCKETS))
+QUEUE_WAIT_SECONDS = registry.add(Histogram('calc_queue_wait_seconds', 'Time of job in queue of pool.',
+                                            EVALUATION_BUCKETS))
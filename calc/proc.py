@@ -1,20 +1,645 @@
-from calc import parse_expression
+from calc import compile_expression, run_program, run_program_async, run_template, estimate_cost, OPCODE_COST, \
+    STREAM_PREFIX
 import app_context
 import asyncio
-from concurrent.futures import ProcessPoolExecutor
+import calc
+import cProfile
+from logs import logger
+import metrics
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import Scheduler
 
-def process_func(expression, pid):
-    res, err = parse_expression(expression, pid)
-    return [res, err]
+# count of worker processes, default - count of cpus
+WORKERS = int(os.environ.get('CALC_WORKERS', 0)) or os.cpu_count()
+# maximum count of jobs waiting for free worker, /calculate answers 503 if queue is full
+MAX_QUEUE = int(os.environ.get('CALC_MAX_QUEUE', 1000))
+# delay of slow / operation in calculations, seconds
+DELAY = float(os.environ.get('CALC_DELAY', 30))
+# expressions with estimated cost less than budget (seconds) are calculated in request, 0 - disabled
+INLINE_BUDGET = float(os.environ.get('CALC_INLINE_BUDGET', 0.01))
+# longer expressions are sent to pool without parsing in request
+INLINE_MAX_LENGTH = int(os.environ.get('CALC_INLINE_MAX_LENGTH', 10000))
+# count of independent parts of expression calculated in parallel, default - count of workers, 1 - disabled
+PARALLEL_PARTS = int(os.environ.get('CALC_PARALLEL_PARTS', 0)) or WORKERS
+# maximum time of calculation of expression from submission to result, seconds, 0 - no limit
+MAX_JOB_TIME = float(os.environ.get('CALC_MAX_JOB_TIME', 0))
+# 1 - expressions are simplified before calculation, results are the same, see calc.Tree.optimize()
+OPTIMIZE = int(os.environ.get('CALC_OPTIMIZE', 0))
+# 1 - delays of slow operations are awaited in event loop instead of worker processes
+ASYNC_EVALUATION = int(os.environ.get('CALC_ASYNC', 0))
+# programs with longer cpu time of calculation (seconds) are calculated in pool in async mode too
+ASYNC_CPU_BUDGET = float(os.environ.get('CALC_ASYNC_CPU_BUDGET', 0.05))
+# 1 - jobs are calculated by evaluator.py processes connected to the same backend (CALC_REDIS_URL) instead of pool
+REMOTE_EVALUATORS = int(os.environ.get('CALC_REMOTE_EVALUATORS', 0))
+# each N-th job of pool is profiled by cProfile, profiles are saved to PROFILE_DIR, 0 - disabled
+PROFILE_EVERY = int(os.environ.get('CALC_PROFILE_EVERY', 0))
+PROFILE_DIR = os.environ.get('CALC_PROFILE_DIR', 'profiles')
 
-async def calculation_task(pid, expression):
-    loop = asyncio.get_event_loop()
-    res, err = await loop.run_in_executor(ProcessPoolExecutor(), process_func, expression, pid)
+
+# futures of jobs of calculations to report their progress, key - pid, value - list of futures
+_jobs = dict()
+# events of traces of jobs in worker process [pid, event, time], they are sent to parent with result of job
+_events = []
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class WorkerError(Exception):
+    pass
+
+
+def worker_main(conn, progress, log_queue):
+    '''
+    loop of worker process: receive [func, args, profile path] from parent, send back [is_ok,
+    result or error text, observations of histograms of metrics, events of traces], None from parent stops worker,
+    job is profiled by cProfile if profile path isn't None
+    :input: progress - shared counters of slow operations of current job, see calc.progress,
+    log_queue - queue of writer process of log, None if it isn't started
+    '''
+    calc.progress = progress
+    logger.connect(log_queue)
+    metrics.registry.reset()                    # values copied from parent by fork
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        func, args, profile_path = job
+        profiler = None
+        if profile_path:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            res = [True, func(*args)]
+        except Exception as e:
+            res = [False, '%s: %s' % (e.__class__.__name__, e)]
+        if profiler:
+            profiler.disable()
+            os.makedirs(os.path.dirname(profile_path) or '.', exist_ok=True)
+            profiler.dump_stats(profile_path)
+        res.append(metrics.registry.drain())
+        res.append(take_events())
+        logger.flush()
+        conn.send(res)
+
+
+class Worker:
+    '''
+    class Worker,
+    worker process with pipe to parent, runs one job at a time,
+    progress of job is reported by counters in shared memory without messages to parent,
+    observations of metrics and events of traces of the last job are kept until parent takes them
+    '''
+
+    def __init__(self):
+        self._conn, child_conn = multiprocessing.Pipe()
+        self.is_broken = False
+        self.observations = []
+        self.events = []
+        self.progress = multiprocessing.RawArray('q', 2)
+        self.process = multiprocessing.Process(target=worker_main, daemon=True,
+                                               args=(child_conn, self.progress, logger.get_queue()))
+        self.process.start()
+        child_conn.close()
+
+    def call(self, func, args, profile_path=None):
+        '''
+        run func(*args) in worker process and wait for result, blocks calling thread,
+        profile of job is saved to profile_path if it's set
+        '''
+        self.progress[0] = self.progress[1] = 0
+        try:
+            self._conn.send([func, args, profile_path])
+            is_ok, res, self.observations, self.events = self._conn.recv()
+        except (EOFError, OSError):
+            self.is_broken = True
+            raise WorkerError('worker process %s is terminated' % self.process.pid)
+        if not is_ok:
+            raise WorkerError(res)
+        return res
+
+    def is_alive(self):
+        return not self.is_broken and self.process.is_alive()
+
+    def interrupt(self):
+        '''
+        terminate process with running job, waiting thread gets WorkerError and worker is replaced
+        '''
+        self.is_broken = True
+        self.process.terminate()
+
+    def stop(self):
+        try:
+            self._conn.send(None)
+        except (EOFError, OSError):
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self._conn.close()
+
+
+class WorkerPool:
+    '''
+    class WorkerPool,
+    application-lifetime pool of worker processes with bounded queue of jobs,
+    each busy worker has a thread waiting for its result, so event loop isn't blocked
+    Args:
+        _workers = all workers
+        _idle = workers without job
+        _queue = jobs waiting for free worker [func, args, future, time of submission],
+        they are ordered by estimated cost and fair share of clients, see Scheduler
+        _running = count of jobs in workers
+        _jobs = workers of running jobs, key - future of job
+        _job_count = count of dispatched jobs, each PROFILE_EVERY-th one is profiled
+    '''
+
+    def __init__(self, workers=WORKERS, max_queue=MAX_QUEUE):
+        self._max_queue = max_queue
+        self._workers = [Worker() for i in range(workers)]
+        self._idle = list(self._workers)
+        self._queue = Scheduler()
+        self._running = 0
+        self._jobs = dict()
+        self._job_count = 0
+        self._threads = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._is_stopped = False
+
+    def is_full(self):
+        return len(self._queue) >= self._max_queue
+
+    def get_queue_size(self):
+        return len(self._queue)
+
+    def get_running_count(self):
+        return self._running
+
+    def get_worker_count(self):
+        return len(self._workers)
+
+    def get_queue_position(self, future):
+        '''
+        :return: count of jobs which go to workers before job with future, None if job isn't in queue
+        '''
+        return self._queue.get_position(future)
+
+    def get_progress(self, future):
+        '''
+        :return: [done, total] - counts of slow operations of job with future, None if job isn't running
+        '''
+        worker = self._jobs.get(future)
+        if worker is None:
+            return None
+        return [worker.progress[0], worker.progress[1]]
+
+    def submit(self, func, *args, cost=0, client=None):
+        '''
+        add job func(*args) to queue, raise QueueFullError if queue is full
+        :input: cost - estimated time of job in seconds, client - id of client for fair share
+        :return: future with result of job
+        '''
+        if self._is_stopped:
+            raise WorkerError('pool is stopped')
+        if self.is_full():
+            raise QueueFullError('queue of jobs is full, size = %s' % len(self._queue))
+        future = asyncio.get_event_loop().create_future()
+        self._queue.push(future, [func, args, future, time.monotonic()], cost, client)
+        self._dispatch()
+        return future
+
+    def submit_first(self, func, *args):
+        '''
+        add job func(*args) to head of queue without size check,
+        it's used to continue job which is admitted to pool already
+        :return: future with result of job
+        '''
+        if self._is_stopped:
+            raise WorkerError('pool is stopped')
+        future = asyncio.get_event_loop().create_future()
+        self._queue.push_first(future, [func, args, future, time.monotonic()])
+        self._dispatch()
+        return future
+
+    def cancel(self, future):
+        '''
+        cancel job with future: remove it from queue or interrupt its worker
+        '''
+        future.cancel()
+        worker = self._jobs.get(future)
+        if worker is not None:
+            worker.interrupt()
+            return
+        self._queue.remove(future)
+
+    def _dispatch(self):
+        while self._idle and self._queue:
+            func, args, future, submit_time = self._queue.pop()
+            if future.done():                   # cancelled by caller
+                continue
+            metrics.QUEUE_WAIT_SECONDS.observe(time.monotonic() - submit_time)
+            self._running += 1
+            self._job_count += 1
+            profile_path = None
+            if PROFILE_EVERY and self._job_count % PROFILE_EVERY == 0:
+                profile_path = os.path.join(PROFILE_DIR, '%s_%s_%s.prof' % (os.getpid(), self._job_count,
+                                                                           func.__name__))
+            asyncio.ensure_future(self._run(self._idle.pop(), func, args, future, profile_path))
+
+    async def _run(self, worker, func, args, future, profile_path=None):
+        loop = asyncio.get_event_loop()
+        self._jobs[future] = worker
+        start_time = time.monotonic()
+        try:
+            res = await loop.run_in_executor(self._threads, worker.call, func, args, profile_path)
+        except WorkerError as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(res)
+        # observations are merged in event loop, not in thread of worker
+        metrics.WORKER_BUSY_SECONDS.inc(time.monotonic() - start_time)
+        metrics.registry.merge(worker.observations)
+        worker.observations = []
+        add_trace_events(worker.events)
+        worker.events = []
+        del self._jobs[future]
+        self._running -= 1
+        if self._is_stopped:
+            return
+        if not worker.is_alive():               # replace crashed worker
+            worker = self._replace(worker)
+        self._idle.append(worker)
+        self._dispatch()
+
+    def _replace(self, worker):
+        worker.kill()
+        new_worker = Worker()
+        self._workers[self._workers.index(worker)] = new_worker
+        return new_worker
+
+    def shutdown(self):
+        '''
+        stop idle workers, terminate busy ones and cancel jobs in queue
+        '''
+        self._is_stopped = True
+        while self._queue:
+            self._queue.pop()[2].cancel()
+        for worker in self._workers:
+            if worker in self._idle:
+                worker.stop()
+            else:
+                worker.kill()
+        self._idle = []
+        self._threads.shutdown(wait=False)
+
+
+def mark(pid, event):
+    '''
+    add event of trace of job of pid in worker process
+    '''
+    _events.append([pid, event, time.time()])
+
+
+def take_events():
+    global _events
+    events = _events
+    _events = []
+    return events
+
+
+def add_trace_events(events):
+    '''
+    add events of jobs from worker to traces of their pids, pid of part of program is 'pid.slot'
+    '''
+    if app_context.stored_results is None:
+        return
+    for pid, event, timestamp in events:
+        if isinstance(pid, str):
+            pid, slot = pid.split('.')
+            pid, event = int(pid), '%s (part %s)' % (event, slot)
+        app_context.stored_results.add_trace(pid, event, timestamp)
+
+
+def process_func(program, pid, expression=None, values=None):
+    '''
+    :input: program - compiled expression or None if expression isn't compiled yet,
+    values - known values of stored chains of program
+    :return: [res, err, program, values] - program is returned only if it's compiled here, to cache it
+    in parent process, values - values of stored chains
+    '''
+    mark(pid, 'worker start')
+    compiled = None
+    if program is None:
+        program, err = process_compile(expression, 1, pid)
+        if program is None:
+            return [None, err, None, None]
+        compiled = program
+    if values is None:
+        values = [None] * len(program.digests)
+    start_time = time.monotonic()
+    res, err = run_program(program, pid, DELAY, values)
+    metrics.EVALUATION_SECONDS.observe(time.monotonic() - start_time)
+    mark(pid, 'evaluate end')
+    return [res, err, compiled, values]
+
+
+def process_compile(expression, parts, pid=None):
+    '''
+    :input: pid - events of compilation are added to trace of pid in worker process, optional
+    :return: [program, err], see calc.compile_expression(), its time is observed in metrics
+    '''
+    start_time = time.monotonic()
+    trace = [] if pid is not None else None
+    res = compile_expression(expression, parts, OPTIMIZE, trace)
+    metrics.PARSE_SECONDS.observe(time.monotonic() - start_time)
+    for event, timestamp in trace or ():
+        _events.append([pid, event, timestamp])
+    return res
+
+
+def compile_func(expression, parts, pid):
+    '''
+    compile expression in worker before calculation, see process_compile()
+    '''
+    mark(pid, 'worker start')
+    return process_compile(expression, parts, pid)
+
+
+def process_template(program, columns, rows):
+    '''
+    :input: program - compiled template, columns - values of its variables by index
+    :return: [results, err], see run_template()
+    '''
+    start_time = time.monotonic()
+    res = run_template(program, columns, rows, 'template', DELAY)
+    metrics.EVALUATION_SECONDS.observe(time.monotonic() - start_time)
+    return res
+
+
+def calculate_inline(expression):
+    '''
+    calculate expression in request if it's cheap, compiled expression is cached in any case,
+    expression which isn't compiled is added to invalid expressions
+    :return: [is_calculated, res, err], is_calculated is False if expression should be sent to pool
+    '''
+    if INLINE_BUDGET <= 0:
+        return [False, None, None]
+    program = app_context.stored_results.get_program(expression)
+    if program is None:
+        if len(expression) > INLINE_MAX_LENGTH:
+            return [False, None, None]
+        program, err = process_compile(expression, PARALLEL_PARTS)
+        if program is None:
+            app_context.stored_results.add_invalid(expression)
+            return [True, None, err]
+        app_context.stored_results.add_program(program, expression)
+    if estimate_cost(program, DELAY) >= INLINE_BUDGET:
+        return [False, None, None]
+    start_time = time.monotonic()
+    res, err = run_program(program, 'inline', DELAY)
+    metrics.EVALUATION_SECONDS.observe(time.monotonic() - start_time)
+    return [True, res, err]
+
+
+def add_job(pid, future):
+    '''
+    remember future of job of pid to report progress, jobs of pid are forgotten when its result or error is added
+    :return: future
+    '''
+    if pid not in _jobs:
+        _jobs[pid] = []
+        app_context.stored_results.add_listener(pid, forget_jobs)
+    _jobs[pid].append(future)
+    return future
+
+
+def forget_jobs(pid):
+    _jobs.pop(pid, None)
+
+
+def cancel_calculation(pid, status='cancelled'):
+    '''
+    stop all jobs of pid and set its status to 'cancelled' or 'timeout', capacity of pool is returned at once
+    :return: False if pid isn't processing
+    '''
+    if not app_context.stored_results.is_processing(pid):
+        return False
+    for future in _jobs.get(pid, ()):
+        app_context.pool.cancel(future)
+    app_context.stored_results.add_cancelled(status, pid)
+    return True
+
+
+def check_backend():
+    '''
+    stop own jobs which are finished in backend: cancelled by other server or calculated by evaluator,
+    running job with expired mark in backend isn't stopped, its result is stored when it's done
+    '''
+    for pid in app_context.stored_results.check_backend():
+        status = app_context.stored_results.get_cancelled(pid)
+        if status:
+            cancel_calculation(pid, status)
+        else:
+            app_context.stored_results.forget_processing(pid)
+
+
+def get_progress(pid):
+    '''
+    progress of running jobs of pid, it's read from shared counters of workers
+    :return: [percent, seconds_left] - percent of done slow operations and estimated time to finish,
+    None if progress is unknown: jobs are in queue, program isn't compiled yet, it calls functions
+    or it's calculated in event loop
+    '''
+    done = 0
+    total = 0
+    seconds_left = 0
+    for future in _jobs.get(pid, ()):
+        counters = app_context.pool.get_progress(future)
+        if not counters or not counters[1]:             # total of job is unknown
+            continue
+        done += counters[0]
+        total += counters[1]
+        # jobs of one pid run in parallel
+        seconds_left = max(seconds_left, (counters[1] - counters[0]) * DELAY)
+    if not total:
+        return None
+    return [round(100.0 * done / total, 1), seconds_left]
+
+
+def get_job_cost(program, rows=1):
+    '''
+    estimated time of job of program in seconds for order of jobs in queue, see calc.estimate_cost(),
+    calls of functions are counted once, so cost is finite
+    :input: rows - count of rows of template
+    '''
+    return estimate_cost(program, DELAY, rows, calls_once=True)
+
+
+def get_expression_cost(expression):
+    '''
+    estimated time of job of expression which isn't compiled yet in seconds, each / is slow operation
+    '''
+    return len(expression) * OPCODE_COST + expression.count('/') * DELAY
+
+
+def get_queue_position(pid):
+    '''
+    :return: the least count of jobs which go to workers before jobs of pid, None if no job of pid is in queue
+    '''
+    positions = [app_context.pool.get_queue_position(future) for future in _jobs.get(pid, ())]
+    positions = [position for position in positions if position is not None]
+    return min(positions) if positions else None
+
+
+async def compile_task(pid, expression, future, client=None):
+    try:
+        program, err = await future
+    except WorkerError as e:
+        program, err = None, '%s' % e
+    if program is not None:
+        app_context.stored_results.add_program(program, expression)
+    if not app_context.stored_results.is_processing(pid):   # cancelled
+        return
+    if program is None:
+        app_context.stored_results.add_error(err, pid, expression)
+        return
+    run_calculation(pid, expression, program, True, client)
+
+
+async def async_calculation_task(pid, expression, program):
+    values = app_context.stored_results.get_subtree_values(program.digests)
+    app_context.stored_results.add_trace(pid, 'evaluate start')
+    start_time = time.monotonic()
+    res, err = await run_program_async(program, pid, DELAY, values)
+    metrics.EVALUATION_SECONDS.observe(time.monotonic() - start_time)
+    app_context.stored_results.add_trace(pid, 'evaluate end')
+    app_context.stored_results.add_subtree_values(program.digests, values)
     if res != None:
         app_context.stored_results.add_result(res, pid, expression)
     elif err != None:
         app_context.stored_results.add_error(err, pid, expression)
 
-def start_calculation(pid, expression):
-    asyncio.create_task(calculation_task(pid, expression))
 
+async def parallel_task(pid, expression, program, values, futures):
+    '''
+    wait for parts of program calculated in parallel, then calculate the rest of program with their values
+    :input: futures - list of [slot, future] for each part
+    '''
+    for slot, future in futures:
+        try:
+            res, err, compiled, part_values = await future
+        except WorkerError as e:
+            err, part_values = '%s' % e, None
+        if part_values is None or part_values[slot] is None:
+            if app_context.stored_results.is_processing(pid):
+                for other_slot, other_future in futures:
+                    app_context.pool.cancel(other_future)
+                app_context.stored_results.add_error(err or 'error in calculating', pid, expression)
+            return
+        for i, value in enumerate(part_values):
+            if value is not None:
+                values[i] = value
+    app_context.stored_results.add_subtree_values(program.digests, values)
+    if not app_context.stored_results.is_processing(pid):   # cancelled
+        return
+    future = add_job(pid, app_context.pool.submit_first(process_func, program, pid, None, values))
+    await calculation_task(pid, expression, program, future)
+
+
+async def calculation_task(pid, expression, program, future):
+    try:
+        res, err, compiled, values = await future
+    except WorkerError as e:
+        res, err, compiled, values = None, '%s' % e, None, None
+    if compiled is not None:
+        program = compiled
+        app_context.stored_results.add_program(program, expression)
+    if values:
+        app_context.stored_results.add_subtree_values(program.digests, values)
+    if not app_context.stored_results.is_processing(pid):   # cancelled
+        return
+    if res != None:
+        app_context.stored_results.add_result(res, pid, expression)
+    elif err != None:
+        app_context.stored_results.add_error(err, pid, expression)
+
+
+def run_calculation(pid, expression, program, is_admitted=False, client=None):
+    '''
+    submit jobs of compiled program to app_context.pool: independent parts of program with unknown values
+    are calculated in parallel workers if there are at least two of them, the rest of program is calculated
+    after them, raise QueueFullError if queue of pool is full and job isn't admitted to pool yet,
+    in async mode program with cheap cpu part is calculated in event loop,
+    client - id of client for fair share of pool
+    '''
+    if ASYNC_EVALUATION and estimate_cost(program, 0) < ASYNC_CPU_BUDGET:
+        add_job(pid, asyncio.ensure_future(async_calculation_task(pid, expression, program)))
+        return
+    pool = app_context.pool
+    values = app_context.stored_results.get_subtree_values(program.digests)
+    parts = []
+    for i in range(len(program.parts)):
+        slot, part = program.get_part(i)
+        if values[slot] is None:
+            parts.append([slot, part])
+    if len(parts) > 1:
+        futures = []
+        for slot, part in parts:
+            # parts which don't fit to queue are calculated in job of the rest of program
+            if (futures or is_admitted) and pool.is_full():
+                break
+            future = pool.submit(process_func, part, '%s.%s' % (pid, slot), None, list(values),
+                                 cost=get_job_cost(part), client=client)
+            futures.append([slot, add_job(pid, future)])
+        if futures:
+            asyncio.ensure_future(parallel_task(pid, expression, program, values, futures))
+            return
+    if is_admitted:
+        future = pool.submit_first(process_func, program, pid, None, values)
+    else:
+        future = pool.submit(process_func, program, pid, None, values, cost=get_job_cost(program), client=client)
+    add_job(pid, future)
+    asyncio.ensure_future(calculation_task(pid, expression, program, future))
+
+
+def start_calculation(pid, expression, timeout=None, client=None):
+    '''
+    submit job to app_context.pool, raise QueueFullError if queue of pool is full,
+    jobs are stopped with status 'timeout' after timeout or MAX_JOB_TIME seconds,
+    client - id of client for fair share of pool
+    '''
+    if MAX_JOB_TIME and (not timeout or timeout > MAX_JOB_TIME):
+        timeout = MAX_JOB_TIME
+    if timeout:
+        timer = asyncio.get_event_loop().call_later(timeout, cancel_calculation, pid, 'timeout')
+        app_context.stored_results.add_listener(pid, lambda pid: timer.cancel())
+    # streamed expression is known only by its compiled program, so it's calculated by pool of server
+    if REMOTE_EVALUATORS and not expression.startswith(STREAM_PREFIX):
+        app_context.stored_results.push_job(pid, expression)
+        return
+    program = app_context.stored_results.get_program(expression)
+    if program is not None:
+        run_calculation(pid, expression, program, False, client)
+    elif ASYNC_EVALUATION or PARALLEL_PARTS > 1 or app_context.stored_results.has_subtree_values():
+        # compile before calculation to split program to parts, to send known values of chains with it
+        # or to calculate it in event loop
+        future = add_job(pid, app_context.pool.submit(compile_func, expression, PARALLEL_PARTS, pid,
+                                                      cost=get_expression_cost(expression), client=client))
+        asyncio.ensure_future(compile_task(pid, expression, future, client))
+    else:
+        # expression is parsed in worker and compiled program is cached
+        future = add_job(pid, app_context.pool.submit(process_func, None, pid, expression,
+                                                      cost=get_expression_cost(expression), client=client))
+        asyncio.ensure_future(calculation_task(pid, expression, None, future))
@@ -0,0 +1,123 @@
+import collections
+import heapq
+import itertools
+import os
+import time
+
+# seconds of estimated cost of job forgiven for each second of waiting in queue, so long jobs aren't starved,
+# 0 - strict shortest job first, large value - first come first served
+AGING = float(os.environ.get('CALC_SCHEDULER_AGING', 1))
+
+
+class Scheduler:
+    '''
+    class Scheduler,
+    queue of jobs of WorkerPool with fair share of clients and shortest job first:
+    the client with the least cost of dispatched jobs goes next, so one client with many long jobs
+    doesn't starve the others, jobs of client are ordered by estimated cost minus aging of waiting time
+    Args:
+        _first = jobs which go before all others, e.g. continuations of admitted jobs, [future, job]
+        _queues = jobs of clients, key - client, value - heap of [priority, order, future, job, cost]
+        _served = virtual time of clients with jobs: cost of their dispatched jobs,
+        client without jobs starts from _virtual_time - virtual time of the last dispatched client
+    '''
+
+    def __init__(self, aging=AGING):
+        self._aging = aging
+        self._first = collections.deque()
+        self._queues = dict()
+        self._served = dict()
+        self._virtual_time = 0.0
+        self._count = 0
+        self._order = itertools.count()
+        self._positions = None                  # cache of get_position(), it's reset when queue is changed
+
+    def __len__(self):
+        return self._count
+
+    def push(self, future, job, cost=0, client=None):
+        # cost - aging * (now - submit time) has the same order at any time as cost + aging * submit time
+        priority = cost + self._aging * time.monotonic()
+        queue = self._queues.get(client)
+        if queue is None:
+            queue = self._queues[client] = []
+            self._served[client] = self._virtual_time
+        heapq.heappush(queue, [priority, next(self._order), future, job, cost])
+        self._count += 1
+        self._positions = None
+
+    def push_first(self, future, job):
+        self._first.appendleft([future, job])
+        self._count += 1
+        self._positions = None
+
+    def pop(self):
+        '''
+        :return: the next job, None if queue is empty
+        '''
+        if not self._count:
+            return None
+        self._count -= 1
+        self._positions = None
+        if self._first:
+            return self._first.popleft()[1]
+        client = min(self._served, key=self._served.get)
+        queue = self._queues[client]
+        priority, order, future, job, cost = heapq.heappop(queue)
+        self._virtual_time = self._served[client]
+        self._served[client] += cost
+        if not queue:
+            del self._queues[client]
+            del self._served[client]
+        return job
+
+    def remove(self, future):
+        '''
+        remove job of future from queue
+        :return: False if it isn't in queue
+        '''
+        for item in self._first:
+            if item[0] is future:
+                self._first.remove(item)
+                break
+        else:
+            for client, queue in self._queues.items():
+                index = next((i for i, item in enumerate(queue) if item[2] is future), None)
+                if index is not None:
+                    queue.pop(index)
+                    heapq.heapify(queue)
+                    if not queue:
+                        del self._queues[client]
+                        del self._served[client]
+                    break
+            else:
+                return False
+        self._count -= 1
+        self._positions = None
+        return True
+
+    def get_position(self, future):
+        '''
+        :return: count of jobs which go before job of future, None if it isn't in queue,
+        order of all jobs is calculated once after each change of queue
+        '''
+        if self._positions is None:
+            self._positions = self._get_positions()
+        return self._positions.get(future)
+
+    def _get_positions(self):
+        positions = dict()
+        for future, job in self._first:
+            positions[future] = len(positions)
+        queues = dict((client, sorted(queue)) for client, queue in self._queues.items())
+        indexes = dict.fromkeys(queues, 0)
+        served = dict(self._served)
+        while served:
+            client = min(served, key=served.get)
+            priority, order, future, job, cost = queues[client][indexes[client]]
+            positions[future] = len(positions)
+            served[client] += cost
+            indexes[client] += 1
+            if indexes[client] == len(queues[client]):
+                del served[client]
+        return positions
@@ -0,0 +1,75 @@
+import json
+import sqlite3
+import time
+
+# pids are reserved in blocks, so pid counter is written once per PID_BLOCK jobs
+PID_BLOCK = 1000
+
+
+class SqliteStorage:
+    '''
+    class SqliteStorage,
+    on-disk store of results, errors and pid counter of SharedData,
+    it's used to warm caches after server restart
+    '''
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS results '
+                         '(pid INTEGER PRIMARY KEY, expression TEXT, res TEXT, created REAL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS errors '
+                         '(pid INTEGER PRIMARY KEY, expression TEXT, err_text TEXT, created REAL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+        self._db.commit()
+
+    def save_result(self, pid, expression, res):
+        self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                         (pid, expression, json.dumps(res), time.time()))
+        self._db.commit()
+
+    def save_error(self, pid, expression, err_text):
+        self._db.execute('INSERT OR REPLACE INTO errors VALUES (?, ?, ?, ?)',
+                         (pid, expression, err_text, time.time()))
+        self._db.commit()
+
+    def reserve_pids(self, pid):
+        '''
+        save end of pid block started from pid
+        :return: first pid after reserved block
+        '''
+        pid_limit = pid + PID_BLOCK
+        self._db.execute("INSERT OR REPLACE INTO counters VALUES ('pid', ?)", (pid_limit,))
+        self._db.commit()
+        return pid_limit
+
+    def load(self, max_items=0, ttl=0):
+        '''
+        remove results and errors older than ttl and load the most recent ones
+        :return: [results, errors, pid_counter],
+        results - list of [pid, expression, res], errors - list of [pid, expression, err_text], from old to new
+        '''
+        if ttl:
+            for table in ['results', 'errors']:
+                self._db.execute('DELETE FROM %s WHERE created < ?' % table, (time.time() - ttl,))
+            self._db.commit()
+        limit = max_items or -1
+        results = self._db.execute('SELECT pid, expression, res FROM results ORDER BY pid DESC LIMIT ?',
+                                   (limit,)).fetchall()
+        results = [[pid, expression, json.loads(res)] for pid, expression, res in reversed(results)]
+        errors = self._db.execute('SELECT pid, expression, err_text FROM errors ORDER BY pid DESC LIMIT ?',
+                                  (limit,)).fetchall()
+        errors = [list(error) for error in reversed(errors)]
+        pid_counter = 0
+        row = self._db.execute("SELECT value FROM counters WHERE name = 'pid'").fetchone()
+        if row:
+            pid_counter = row[0]
+        for table in ['results', 'errors']:
+            row = self._db.execute('SELECT MAX(pid) FROM %s' % table).fetchone()
+            if row[0] is not None and row[0] >= pid_counter:
+                pid_counter = row[0] + 1
+        return [results, errors, pid_counter]
+
+    def close(self):
+        self._db.close()
@@ -2,23 +2,30 @@ import random
 import aiohttp
 import asyncio
 import argparse
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
 import time, re
 
 
 class Generator:
     operations = ["+", "-", "*", "/"]
 
-    def __init__(self):
+    def __init__(self, seed=None):
         self.res = ''
+        self._random = random.Random(seed)
 
     def generate_valid(self, s='0'):
-        need_exit = random.randint(0, 8)
+        need_exit = self._random.randint(0, 8)
         if need_exit == 0:
             self._res = s
             return
-        a = random.randint(0, 9999999)
-        b = random.randint(0, 10)
-        op = random.randint(0, 3)
+        a = self._random.randint(0, 9999999)
+        b = self._random.randint(0, 10)
+        op = self._random.randint(0, 3)
         if op == 3 and a == 0:  # protect division by zero
             a = 1
         s = '%s%s%s' % ('(%s)' % s if b == 10 else s, self.operations[op], a)
@@ -27,16 +34,16 @@ class Generator:
     def generate_invalid(self, s=''):
         full_operations = [')', '(']
         full_operations.extend(self.operations)
-        c = random.randint(0, 8)
-        need_exit = random.randint(0, 8)
+        c = self._random.randint(0, 8)
+        need_exit = self._random.randint(0, 8)
         if need_exit == 0:
             self._res = s
             return
         if c == 0:
-            a = random.randint(0, 9999999)
+            a = self._random.randint(0, 9999999)
             s += str(a)
         else:
-            op_index = random.randint(0, 5)
+            op_index = self._random.randint(0, 5)
             s += full_operations[op_index]
         self.generate_invalid(s)
 
@@ -47,38 +54,36 @@ class Generator:
 url = 'http://localhost.ru:8000'
 
 
-async def send_post(expression):
-    session = aiohttp.ClientSession()
+async def send_post(session, expression):
     ret = await session.post('%s/calculate' % url, data='{"expression":"%s"}' % expression)
-    await session.close()
     ret_json = await ret.json()
-    if 'ret' in ret_json:
-        pid = ret_json['ret']
+    if 'pid' in ret_json:
+        pid = ret_json['pid']
         print('\nPOST ret pid = %s\n' % pid)
         return pid
+    elif 'ret' in ret_json:
+        print('\nPOST ret result = %s\n' % ret_json['ret'])
+        return None
     else:
         print('\nPOST result isn\'t pid: %s\n' % await ret.text())
         assert False
 
 
-async def get(pid):
-    session = aiohttp.ClientSession()
-    ret = await session.get("%s/result?id=%s" % (url, pid))
+async def get(session, pid, wait=0):
+    ret = await session.get("%s/result?id=%s&wait=%s" % (url, pid, wait))
     ret_json = await ret.json()
     print('\nGET ret = %s\n' % ret_json['ret'])
-    await session.close()
     return ret_json['ret']
 
 
-async def process_func(expression, is_valid):
-    pid = await send_post(expression)
-    if not pid:
+async def process_func(session, expression, is_valid):
+    pid = await send_post(session, expression)
+    if pid is None:
         print('\nadd calc task for %s expression %s failed!\n' % ('valid' if is_valid else 'invalid', expression))
         return
-    res = await get(pid)
+    res = await get(session, pid)
     if res == 'processing soon...':
-        time.sleep(30)
-        res = await get(pid)
+        res = await get(session, pid, 60)
         try:
             eval_res = eval(expression)
             assert eval_res == res
@@ -98,8 +103,8 @@ async def process_func(expression, is_valid):
             print('\nunexpected result =%s for task with expression %s with pid = %s\n' % (res, expression, pid))
 
 
-async def calculation_task(expression, is_valid):
-    await process_func(expression, is_valid)
+async def calculation_task(session, expression, is_valid):
+    await process_func(session, expression, is_valid)
 
 
 async def test_it(url_str, process_num=200):
@@ -107,17 +112,201 @@ async def test_it(url_str, process_num=200):
     url = url_str
     generator = Generator()
     tasks_list = []
-    for i in range(process_num):
-        generator.generate_valid()
-        expression = generator.get()
-        tasks_list.append(asyncio.create_task(calculation_task(expression, True)))
+    async with aiohttp.ClientSession() as session:
+        for i in range(process_num):
+            generator.generate_valid()
+            expression = generator.get()
+            tasks_list.append(asyncio.create_task(calculation_task(session, expression, True)))
 
-    for i in range(process_num):
-        generator.generate_invalid()
-        expression = generator.get()
-        tasks_list.append(asyncio.create_task(calculation_task(expression, False)))
+        for i in range(process_num):
+            generator.generate_invalid()
+            expression = generator.get()
+            tasks_list.append(asyncio.create_task(calculation_task(session, expression, False)))
 
-    await asyncio.gather(*tasks_list)
+        await asyncio.gather(*tasks_list)
+
+
+def percentile(values, percent):
+    '''
+    :input: values - sorted list
+    :return: nearest-rank percentile of values, None if values is empty
+    '''
+    if not values:
+        return None
+    return values[max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)]
+
+
+def get_latency_stats(latencies):
+    '''
+    :return: dict of latency percentiles in milliseconds
+    '''
+    values = sorted(latency * 1000 for latency in latencies)
+    return {
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else None,
+        'mean': sum(values) / len(values) if values else None,
+    }
+
+
+def check_result(expression, ret_json):
+    '''
+    compare finished calculation with python calculation of expression,
+    numbers are floats as in server, so results are the same bit by bit
+    :return: outcome: ok, wrong - other result, missing - result isn't found, error - Nok response
+    '''
+    try:
+        expected = eval(re.sub('[0-9]+', '\\g<0>.0', expression))
+    except (ZeroDivisionError, OverflowError):
+        expected = math.nan
+    if ret_json['ret'] == 'not found':
+        return 'missing'
+    if ret_json['status'] != 'ok':
+        return 'ok' if not math.isfinite(expected) else 'error'
+    res = ret_json['ret']
+    if res.__class__ not in (int, float) or not math.isclose(res, expected, rel_tol=1e-9):
+        return 'wrong'
+    return 'ok'
+
+
+class LoadTest:
+    '''
+    class LoadTest,
+    load generator with one pooled session,
+    open loop sends requests with fixed rate regardless of responses, closed loop keeps concurrency
+    requests in flight, pids are awaited by long poll of /result,
+    only requests started after warm-up are measured
+    Args:
+        rps = rate of requests per second for open loop, 0 - closed loop
+        latencies = times from POST to result of measured requests, seconds
+        post_latencies = times of POST /calculate of measured requests, seconds
+        counts = outcomes of measured requests: ok, wrong (result differs from python), missing (result
+         isn't found by pid), error (Nok result or failed request), busy (503), timeout
+    '''
+
+    def __init__(self, url, rps=0, concurrency=10, warmup=5, duration=30, wait=60, timeout=120, connections=100,
+                 seed=0):
+        self.url = url
+        self.rps = rps
+        self.concurrency = concurrency
+        self.warmup = warmup
+        self.duration = duration
+        self.wait = wait
+        self.timeout = timeout
+        self.connections = connections
+        self._generator = Generator(seed)
+        self._random = random.Random(seed)
+        self.latencies = []
+        self.post_latencies = []
+        self.counts = {'ok': 0, 'wrong': 0, 'missing': 0, 'error': 0, 'busy': 0, 'timeout': 0}
+
+    async def run(self):
+        '''
+        :return: report, see get_report()
+        '''
+        connector = aiohttp.TCPConnector(limit=self.connections)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+            loop = asyncio.get_event_loop()
+            start_time = loop.time()
+            measure_time = start_time + self.warmup
+            end_time = measure_time + self.duration
+            if self.rps > 0:
+                jobs = []
+                i = 0
+                while True:
+                    # arrivals are scheduled from start, late sending doesn't lower the rate
+                    send_time = start_time + i / self.rps
+                    if send_time >= end_time:
+                        break
+                    if send_time > loop.time():
+                        await asyncio.sleep(send_time - loop.time())
+                    jobs.append(asyncio.ensure_future(self._job(session, send_time >= measure_time)))
+                    i += 1
+                await asyncio.gather(*jobs)
+            else:
+                async def worker():
+                    while loop.time() < end_time:
+                        await self._job(session, loop.time() >= measure_time)
+                await asyncio.gather(*[worker() for i in range(self.concurrency)])
+        return self.get_report()
+
+    async def _job(self, session, is_measured):
+        # half of expressions start from 0 as in stress test, they often are 0 or 0 without operations
+        self._generator.generate_valid(str(self._random.choice([0, self._random.randint(1, 9999999)])))
+        expression = self._generator.get()
+        start_time = time.perf_counter()
+        post_time = None
+        try:
+            post_time, outcome = await asyncio.wait_for(self._calculate(session, expression, start_time),
+                                                        self.timeout)
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+        except (aiohttp.ClientError, ValueError, KeyError):
+            outcome = 'error'
+        if not is_measured:
+            return
+        self.counts[outcome] += 1
+        if post_time is not None:
+            self.post_latencies.append(post_time)
+        if outcome == 'ok':
+            self.latencies.append(time.perf_counter() - start_time)
+
+    async def _calculate(self, session, expression, start_time):
+        '''
+        :return: [time of POST, outcome]
+        '''
+        async with session.post('%s/calculate' % self.url, json={'expression': expression}) as response:
+            if response.status == 503:
+                return [time.perf_counter() - start_time, 'busy']
+            ret_json = await response.json()
+        post_time = time.perf_counter() - start_time
+        if 'pid' in ret_json:
+            pid = ret_json['pid']
+            while True:
+                async with session.get('%s/result' % self.url, params={'id': pid, 'wait': self.wait}) as response:
+                    ret_json = await response.json()
+                if ret_json['ret'] != 'processing soon...':
+                    break
+        return [post_time, check_result(expression, ret_json)]
+
+    def get_report(self):
+        requests = sum(self.counts.values())
+        return {
+            'mode': 'open' if self.rps > 0 else 'closed',
+            'rps': self.rps,
+            'concurrency': self.concurrency,
+            'warmup': self.warmup,
+            'duration': self.duration,
+            'requests': requests,
+            'counts': dict(self.counts),
+            'error_rate': (requests - self.counts['ok']) / requests if requests else None,
+            'throughput': self.counts['ok'] / self.duration if self.duration else None,
+            'latency_ms': get_latency_stats(self.latencies),
+            'post_latency_ms': get_latency_stats(self.post_latencies),
+        }
+
+
+def start_server(port, timeout=30):
+    '''
+    start uvicorn with main:app on localhost port and wait until it accepts connections,
+    calc environment variables are passed to server
+    :return: server process
+    '''
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port),
+                                '--log-level', 'warning'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server is stopped with code %s' % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('server is not started in %s s' % timeout)
 
 
 if __name__ == "__main__":
@@ -126,7 +315,44 @@ if __name__ == "__main__":
                         help='count of post requests to server with valid & invalid expressions')
     parser.add_argument('--url', metavar='url', type=str, default='http://localhost.ru:8000',
                         help='count of post requests to server with valid & invalid expressions')
+    parser.add_argument('--load', action='store_true',
+                        help='load test: measure latencies and throughput, see options below, report is json')
+    parser.add_argument('--rps', metavar='X', type=float, default=0,
+                        help='load test: open loop with rate of requests per second, 0 - closed loop')
+    parser.add_argument('--concurrency', metavar='N', type=int, default=10,
+                        help='load test: count of requests in flight in closed loop')
+    parser.add_argument('--warmup', metavar='S', type=float, default=5,
+                        help='load test: seconds of warm-up, its requests are not measured')
+    parser.add_argument('--duration', metavar='S', type=float, default=30, help='load test: seconds of measurement')
+    parser.add_argument('--wait', metavar='S', type=float, default=60, help='load test: long poll time of /result')
+    parser.add_argument('--timeout', metavar='S', type=float, default=120,
+                        help='load test: requests without result in timeout are counted as timeout')
+    parser.add_argument('--connections', metavar='N', type=int, default=100,
+                        help='load test: maximum count of connections in pool')
+    parser.add_argument('--seed', metavar='N', type=int, default=0, help='load test: seed of expressions')
+    parser.add_argument('--start_server', metavar='PORT', type=int, default=0,
+                        help='load test: start local uvicorn on port and test it, --url is ignored')
+    parser.add_argument('--output', metavar='PATH', help='load test: save report to json file')
     args = parser.parse_args()
+    if args.load:
+        server = None
+        if args.start_server:
+            server = start_server(args.start_server)
+            args.url = 'http://127.0.0.1:%s' % args.start_server
+        try:
+            load_test = LoadTest(args.url, args.rps, args.concurrency, args.warmup, args.duration, args.wait,
+                                 args.timeout, args.connections, args.seed)
+            report = asyncio.get_event_loop().run_until_complete(load_test.run())
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+        report_json = json.dumps(report, indent=2)
+        print(report_json)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(report_json)
+        sys.exit(0)
     process_num = args.process_num
     url = args.url
     start_time = time.monotonic()
@@ -1,10 +1,37 @@
 import asyncio
-from unittest import TestCase
+from unittest import TestCase, skipIf, mock
 from main import app
-from calc import parse_expression
+import app_context
+from calc import parse_expression, tokenize, Tree, compile_expression, run_program, estimate_cost, OP_PUSH, OP_MUL, \
+    StreamParser, ParseError, compile_template, run_template
+import calc
+import pickle
+from benchmark import generate_expression, generate_deep_expression, run_suite, find_regressions, CASES
 from fastapi.testclient import TestClient
 import re
-from main import startup_event
+import json
+from main import startup_event, shutdown_event
+from data import BoundedCache, SharedData
+from storage import SqliteStorage, PID_BLOCK
+import backends
+from backends import MemoryBackend, RedisBackend
+from evaluator import run_evaluator
+import tempfile
+import time
+from proc import WorkerPool, WorkerError, QueueFullError, process_func, start_calculation
+from scheduler import Scheduler
+import proc
+import os
+import logs
+from logs import Logger, LogWriter, ErrorLvls
+import metrics
+from metrics import Counter, Histogram, Registry
+from stress_test import percentile, get_latency_stats, Generator, LoadTest, check_result
+
+try:
+    import fakeredis                                    # optional, for test of RedisBackend
+except ImportError:
+    fakeredis = None
 
 client = TestClient(app)
 
@@ -51,12 +78,783 @@ class TestCalc(TestCase):
             self.inc_pid()
 
 
+class TestParser(TestCase):
+    def test_tokenize(self):
+        self.assertEqual(list(tokenize(' 12+(3 *45)/ 6 ')), ['12', '+', '(', '3', '*', '45', ')', '/', '6'])
+        self.assertEqual(list(tokenize('1+x')), ['1', '+', 'x'])
+
+    def test_tree(self):
+        tree = Tree('1 + 2*3 - ((4 - 5))')
+        self.assertTrue(tree.is_valid)
+        self.assertEqual(len(tree._root.children), 3)
+        self.assertEqual(tree._root.get_expression_str(), '1+2*3-(4-5)')
+        self.assertEqual(tree.max_height, 2)
+        self.assertEqual(tree.calculate(), 8)
+
+        for expr in ['()', '1 2', '1++2', '(1+2', '1+2)', '*1', '1+', '2(3)', 'x']:
+            self.assertFalse(Tree(expr).is_valid, 'expression = %s' % expr)
+
+    def test_long_expression(self):
+        expr = generate_expression(20000)
+        res, err = parse_expression(expr, 0, 0)
+        self.assertEqual(err, None)
+        eval_res = eval(expr)
+        self.assertTrue(abs(res - eval_res) <= 1e-9 * abs(eval_res), 'res = %s eval = %s' % (res, eval_res))
+
+
+    def test_deep_expression(self):
+        depth = 200000
+        expr = '(' * depth + '1' + '+2)-1)*1)' * (depth // 3) + '+2)' * (depth % 3)
+        tree = Tree(expr)
+        self.assertTrue(tree.is_valid)
+        self.assertEqual(tree.max_height, depth)
+        self.assertEqual(tree.calculate(), 1 + depth // 3 + 2 * (depth % 3))
+
+        res, err = parse_expression('(' * depth + '1' + '/0)' * depth, 0, 0)
+        self.assertEqual(res, None)
+        self.assertEqual(err, 'error in calculating')
+
+
+    def test_optimize(self):
+        tree = Tree('(1 + 2) + 3*1*(8/1) - 0*(4 + 5) + 7/1/1')
+        self.assertEqual(tree.optimize(), [9, 3])
+        self.assertEqual(tree._root.get_expression_str(), '3.0+3.0*(8*1)+7*1')
+        self.assertEqual(repr(tree.calculate()), repr(Tree('(1 + 2) + 3*1*(8/1) - 0*(4 + 5) + 7/1/1').calculate()))
+        exprs = [generate_expression(2000, seed) for seed in range(5)] + \
+                ['0*(0-1)', '(0-1)*0*1 + 5', '0 + 10/(1*(2-2)) + 1', '1 * 3 * 99999999999999999999', '0+(0-0*(0-1))*1',
+                 '2 * (1 + 008/2)/1', '1*10' + '0' * 400 + '/1']
+        for expr in exprs:
+            program, err = compile_expression(expr)
+            optimized, optimized_err = compile_expression(expr, 1, True)
+            self.assertEqual(repr(run_program(optimized, 0, 0)), repr(run_program(program, 0, 0)),
+                             'expression = %s' % expr)
+        depth = 200000
+        tree = Tree('(' * depth + '1' + '+2)-1)*1)' * (depth // 3) + '+2)' * (depth % 3))
+        tree.optimize()
+        self.assertEqual(tree.max_height, 1)
+        self.assertEqual(tree.calculate(), 1 + depth // 3 + 2 * (depth % 3))
+        program, err = compile_expression('fun F(0) -> 1*1; fun F(N) -> F(N - 1) + 2*3/1 + 0*N; F(10)', 1, True)
+        self.assertEqual(run_program(program, 0, 0), [61, None])
+        self.assertEqual(program.functions[0].clauses[1][1].divisions, 0)
+
+    def test_long_literal(self):
+        # literal longer than int conversion limit of python is rejected, not raised
+        expr = '1 + ' + '9' * 5000 + ' * 1'
+        for optimize in [False, True]:
+            self.assertEqual(compile_expression(expr, 1, optimize), [None, 'error in parsing'])
+            self.assertEqual(parse_expression(expr, 0, 0, optimize), [None, 'error in calculating'])
+            parser = StreamParser()
+            parser.feed(expr.encode())
+            with self.assertRaises(ParseError):
+                parser.finish(1, optimize)
+
+    def test_stream_parser(self):
+        expression = generate_expression(10000)
+        parser = StreamParser()
+        for i in range(0, len(expression), 7):
+            parser.feed(expression[i:i + 7].encode())
+        key, program = parser.finish()
+        self.assertEqual(program.code, compile_expression(expression)[0].code)
+        with self.assertRaises(ParseError):
+            StreamParser().feed('2 + \u00b2'.encode())
+        expression = 'fun Double(Value) -> Value * 2; Double(21)'
+        parser = StreamParser()
+        for i in range(0, len(expression), 3):
+            parser.feed(expression[i:i + 3].encode())
+        key, program = parser.finish()
+        self.assertEqual(run_program(program, 0, 0), [42, None])
+
+
+class TestProgram(TestCase):
+    def test_compile(self):
+        program, err = compile_expression('1 + 2*3 - (4 - 5)')
+        self.assertEqual(err, None)
+        self.assertEqual(program.code[:4], bytes([OP_PUSH, OP_PUSH, OP_PUSH, OP_MUL]))
+        self.assertEqual(list(program.operands), [1, 2, 3, 4, 5])
+        self.assertEqual(program.operands.typecode, 'b')
+
+        for expr in ['', '(1', '1+', 'x']:
+            program, err = compile_expression(expr)
+            self.assertEqual(program, None)
+            self.assertNotEqual(err, None)
+
+    def test_run(self):
+        exprs = ['(1 + 2 + 3 +4) / (9 * 6 + 9) - 10 + 4/10',
+                 '12+((1+2+3+4)/(8-9*6+9)*19 +6)-10+7/78-((10-7)/8)+8/(8+7)',
+                 '99999999999999999999 * 3 + 1000000 - 5',
+                 '9',
+                 '14/0',
+                 '0*2']
+        for expr in exprs:
+            program, err = compile_expression(expr)
+            program = pickle.loads(pickle.dumps(program))
+            self.assertEqual(run_program(program, 0, 0), parse_expression(expr, 0, 0), 'expression = %s' % expr)
+        self.assertEqual(run_program(compile_expression('3/3-1')[0], 0, 0), [0, None])
+        expr = generate_expression(20000)
+        program, err = compile_expression(expr)
+        self.assertEqual(run_program(program, 0, 0), parse_expression(expr, 0, 0))
+
+    def test_repeated_chains(self):
+        program, err = compile_expression('(1 + 8/2) * (1 + 8/2) - 3/3 * 2 + (3/3 * 2)')
+        # root, (1 + 8/2), 8/2, 3/3 * 2
+        self.assertEqual(len(program.digests), 4)
+        self.assertEqual(program.divisions, 2)
+        values = [None] * 4
+        self.assertEqual(run_program(program, 0, 0, values), [25, None])
+        self.assertEqual(values, [25, 5, 4, 2])
+        program, err = compile_expression('2 * (1 + 008/2)')
+        self.assertEqual(program.digests[1], compile_expression('1+8/2')[0].digests[0])
+        self.assertEqual(run_program(program, 0, 0, [None, 7]), [14, None])
+
+    def test_parallel_parts(self):
+        program, err = compile_expression('8/2 + 6/3 + 9/3*(4/2 - 1/1)', 4)
+        # 9/3 is calculated with the rest of program
+        self.assertEqual(len(program.parts), 4)
+        values = [None] * len(program.digests)
+        for i in range(len(program.parts)):
+            slot, part = program.get_part(i)
+            part_values = [None] * len(program.digests)
+            part.execute(part_values)
+            values[slot] = part_values[slot]
+        self.assertEqual(sorted(value for value in values if value is not None), [1, 2, 2, 4])
+        self.assertEqual(run_program(program, 0, 0, values), [9, None])
+        self.assertEqual(compile_expression('(8/2)*3 + 5', 4)[0].parts, ())
+        self.assertEqual(compile_expression('8/2 + 6/3', 1)[0].parts, ())
+
+    def test_estimate_cost(self):
+        program, err = compile_expression('1 + 2*(3 - 4)/5')
+        self.assertEqual(program.depth, 4)
+        self.assertEqual(program.divisions, 1)
+        self.assertAlmostEqual(estimate_cost(program, 30), 30, 3)
+        self.assertLess(estimate_cost(program, 0), 0.001)
+        self.assertAlmostEqual(estimate_cost(program, 0, 1000), 1000 * estimate_cost(program, 0))
+        self.assertAlmostEqual(estimate_cost(program, 30, 1000), 30, 1)
+
+    def test_functions(self):
+        fib = [0, 1]
+        while len(fib) <= 78:
+            fib.append(fib[-1] + fib[-2])
+        program, err = compile_expression('fun Fib(0) -> 0; fun Fib(1) -> 1;'
+                                          'fun Fib(N) -> Fib(N - 1) + Fib(N - 2); Fib(78)')
+        self.assertEqual(err, None)
+        self.assertEqual(len(program.functions), 1)
+        self.assertEqual(len(program.functions[0].clauses), 3)
+        program = pickle.loads(pickle.dumps(program))
+        self.assertEqual(run_program(program, 0, 0), [fib[78], None])
+        # deep calls don't use python stack
+        program, err = compile_expression('fun S(0) -> 0; fun S(N) -> N + S(N - 1); S(50000)')
+        self.assertEqual(run_program(program, 0, 0), [50000 * 50001 // 2, None])
+        program, err = compile_expression('fun F(X, Y) -> X*Y + 8/2; fun One() -> 1; F(2, 3) * (F(One(), 1) + One())')
+        self.assertEqual(run_program(program, 0, 0), [60, None])
+        self.assertEqual(estimate_cost(program, 0), float('inf'))
+        # 8/2 in body of F is counted once
+        self.assertAlmostEqual(estimate_cost(program, 30, calls_once=True), 30, 3)
+        self.assertEqual(parse_expression('fun F(X) -> X; F(3)', 0, 0), [3, None])
+        # result which overflows to inf can't be sent in JSON
+        factorial, err = compile_expression('fun F(0) -> 1; fun F(N) -> N * F(N - 1); F(200)')
+        self.assertEqual(run_program(factorial, 0, 0), [None, 'error in calculating'])
+        self.assertEqual(parse_expression('fun F(0) -> 1; fun F(N) -> N * F(N - 1); F(200)', 0, 0),
+                         [None, 'error in calculating'])
+        self.assertEqual(parse_expression('%s * %s' % ('9' * 300, '9' * 300), 0, 0), [None, 'error in calculating'])
+        self.assertEqual(run_program(compile_expression('%s * %s' % ('9' * 300, '9' * 300))[0], 0, 0),
+                         [None, 'error in calculating'])
+        self.assertEqual(parse_expression('fun F(X) -> Y; F(3)', 0, 0), [None, 'error in parsing'])
+        # slow operations in bodies of functions aren't known before calculation, so progress isn't reported
+        progress = calc.progress
+        calc.progress = [0, 0]
+        try:
+            self.assertEqual(run_program(program, 0, 0), [60, None])
+            self.assertEqual(calc.progress, [2, 0])
+        finally:
+            calc.progress = progress
+
+    def test_template(self):
+        program, err = compile_template('(x + 2) * y / (x - y) - 8/2 + x/(x - y)')
+        self.assertEqual(err, None)
+        self.assertEqual(program.variables, ('x', 'y'))
+        program = pickle.loads(pickle.dumps(program))
+        x = [1, 5, -3, 2, 7]
+        y = [2, 5, 4, 2, 0]
+        expected = [(x + 2.0) * y / (x - y) - 4 + x / (x - y) if x != y else None for x, y in zip(x, y)]
+        numpy = calc.numpy
+        try:
+            self.assertEqual(run_template(program, [x, y], 5, 0, 0), [expected, None])
+            # lists are used without numpy
+            calc.numpy = None
+            self.assertEqual(run_template(program, [x, y], 5, 0, 0), [expected, None])
+        finally:
+            calc.numpy = numpy
+        program, err = compile_template('8/2 * 3')
+        self.assertEqual(program.execute_columns([], 2), [12, 12])
+        for expr in ['fun F(X) -> X; F(x)', 'x + fun', 'x y']:
+            self.assertEqual(compile_template(expr)[0], None, 'expression = %s' % expr)
+        for optimize in [False, True]:
+            self.assertEqual(compile_template('9' * 5000 + ' + x', optimize), [None, 'error in parsing'])
+
+    def test_function_errors(self):
+        for expr in ['Fib(1)', 'fun F(X) -> Y; F(1)', 'fun F(X) -> X; F(1, 2)', 'fun F(X) -> X;',
+                     'fun F(X) -> X; fun F(X, Y) -> X; F(1)', 'fun F(X) -> fun G(Y) -> Y; 1', 'fun F(1 + 2) -> 1; F(3)']:
+            program, err = compile_expression(expr)
+            self.assertEqual(program, None, 'expression = %s' % expr)
+            self.assertNotEqual(err, None)
+        for expr in ['fun F(0) -> 1; F(2)', 'fun F(N) -> F(N + 1); F(0)', 'fun F(N) -> 1/N; F(0)']:
+            program, err = compile_expression(expr)
+            self.assertEqual(run_program(program, 0, 0), [None, 'error in calculating'], 'expression = %s' % expr)
+
+
+class TestBenchmark(TestCase):
+    def test_generators(self):
+        self.assertEqual(generate_expression(1000, 5), generate_expression(1000, 5))
+        self.assertNotEqual(generate_expression(1000, 5), generate_expression(1000, 6))
+        expr = generate_expression(1000, 0, 0, '+-')
+        self.assertEqual(re.findall(r'[^0-9+-]', expr), [])
+        tree = Tree(generate_deep_expression(1000))
+        self.assertTrue(tree.is_valid)
+        self.assertEqual(tree.max_height, 1000)
+
+    def test_regressions(self):
+        results = run_suite(CASES[:1], repeat=1, scale=0.01)
+        self.assertEqual(sorted(results), ['mixed'])
+        self.assertGreater(results['mixed']['nodes'], 0)
+        self.assertEqual(find_regressions(results, results, 0.2), [])
+        baseline = {'mixed': dict(results['mixed'], parse_us_per_node=results['mixed']['parse_us_per_node'] / 2)}
+        self.assertEqual(find_regressions(results, baseline, 0.2), [
+            ['mixed', 'parse_us_per_node', baseline['mixed']['parse_us_per_node'], results['mixed']['parse_us_per_node']]])
+
+
+class TestLoadTest(TestCase):
+    def test_latency_stats(self):
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, 50), percentile(values, 95), percentile(values, 99)], [50, 95, 99])
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertEqual(percentile([], 50), None)
+        stats = get_latency_stats([0.002, 0.001, 0.003])
+        self.assertAlmostEqual(stats['p50'], 2)
+        self.assertAlmostEqual(stats['max'], 3)
+
+    def test_report(self):
+        generator = Generator(3)
+        generator.generate_valid()
+        expression = generator.get()
+        generator = Generator(3)
+        generator.generate_valid()
+        self.assertEqual(generator.get(), expression)
+        load_test = LoadTest('http://127.0.0.1:1', rps=10, duration=2)
+        load_test.counts['ok'] = 15
+        load_test.counts['busy'] = 5
+        report = load_test.get_report()
+        self.assertEqual(report['mode'], 'open')
+        self.assertEqual(report['requests'], 20)
+        self.assertEqual(report['error_rate'], 0.25)
+        self.assertEqual(report['throughput'], 7.5)
+        self.assertEqual(report['latency_ms']['p99'], None)
+
+    def test_check_result(self):
+        self.assertEqual(check_result('0', {'ret': 0, 'status': 'ok'}), 'ok')
+        self.assertEqual(check_result('7/7-1', {'ret': 0, 'status': 'ok'}), 'ok')
+        self.assertEqual(check_result('10/4+1', {'ret': 3.5, 'status': 'ok'}), 'ok')
+        self.assertEqual(check_result('10/4+1', {'ret': 3, 'status': 'ok'}), 'wrong')
+        self.assertEqual(check_result('2*3', {'ret': 'not found', 'status': 'Nok'}), 'missing')
+        self.assertEqual(check_result('2*3', {'ret': 'error in calculating', 'status': 'Nok'}), 'error')
+        self.assertEqual(check_result('1/0', {'ret': 'error in calculating', 'status': 'Nok'}), 'ok')
+
+
+class TestWorkerPool(TestCase):
+    def setUp(self):
+        self.settings = [proc.DELAY, proc.PARALLEL_PARTS, proc.ASYNC_EVALUATION]
+        self.app_context = [app_context.stored_results, app_context.pool]
+        app_context.stored_results = SharedData()
+
+    def tearDown(self):
+        proc.DELAY, proc.PARALLEL_PARTS, proc.ASYNC_EVALUATION = self.settings
+        if app_context.pool is not self.app_context[1]:
+            app_context.pool.shutdown()
+        app_context.stored_results, app_context.pool = self.app_context
+
+    def test_submit(self):
+        pool = WorkerPool(2, 1)
+
+        async def run():
+            futures = [pool.submit(process_func, None, i, '%s*3+1' % i) for i in range(3)]
+            self.assertEqual(pool.get_running_count(), 2)
+            self.assertEqual(pool.get_queue_size(), 1)
+            with self.assertRaises(QueueFullError):
+                pool.submit(process_func, None, 3, '3*3+1')
+            return await asyncio.gather(*futures)
+
+        results = asyncio.get_event_loop().run_until_complete(run())
+        self.assertEqual([res for res, err, program, values in results], [1, 4, 7])
+        self.assertEqual(pool.get_running_count(), 0)
+        pool.shutdown()
+
+    def test_worker_crash(self):
+        pool = WorkerPool(1)
+
+        async def run():
+            with self.assertRaises(WorkerError):
+                await pool.submit(os._exit, 1)
+            return await pool.submit(process_func, None, 0, '2*2')
+
+        res, err, program, values = asyncio.get_event_loop().run_until_complete(run())
+        self.assertEqual(res, 4)
+        pool.shutdown()
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as path:
+            profile_every, profile_dir = proc.PROFILE_EVERY, proc.PROFILE_DIR
+            proc.PROFILE_EVERY, proc.PROFILE_DIR = 2, os.path.join(path, 'profiles')
+            pool = WorkerPool(1)
+
+            async def run():
+                return await asyncio.gather(*[pool.submit(process_func, None, i, '%s*3+1' % i) for i in range(5)])
+
+            try:
+                asyncio.get_event_loop().run_until_complete(run())
+            finally:
+                proc.PROFILE_EVERY, proc.PROFILE_DIR = profile_every, profile_dir
+                pool.shutdown()
+            profiles = sorted(os.listdir(os.path.join(path, 'profiles')))
+            self.assertEqual([name.split('_', 1)[1] for name in profiles],
+                             ['2_process_func.prof', '4_process_func.prof'])
+
+    async def calculate(self, expression):
+        '''
+        calculate expression in app_context.pool like /calculate
+        :return: [result, error]
+        '''
+        pid = app_context.stored_results.add_processing(expression)
+        start_calculation(pid, expression)
+        while app_context.stored_results.is_processing(pid):
+            await asyncio.sleep(0.01)
+        return [app_context.stored_results.get_result(pid), app_context.stored_results.get_error(pid)]
+
+    def test_subtree_values(self):
+        proc.DELAY = 0
+        app_context.pool = WorkerPool(1)
+        loop = asyncio.get_event_loop()
+        self.assertEqual(loop.run_until_complete(self.calculate('(8/2) + (9/3)')), [7, None])
+        stats = app_context.stored_results.get_stats()['subtree_values']
+        self.assertEqual(stats['items'], 3)
+        self.assertEqual(loop.run_until_complete(self.calculate('1 + ((9 / 3))')), [4, None])
+        stats = app_context.stored_results.get_stats()['subtree_values']
+        self.assertEqual(stats['hits'], 1)
+
+    def test_parallel_parts(self):
+        proc.DELAY = 0.5
+        proc.PARALLEL_PARTS = 4
+        app_context.pool = WorkerPool(4)
+        running = []
+
+        async def run():
+            future = asyncio.ensure_future(self.calculate('8/2 + 6/3 + 9/3 + 4/2'))
+            while not future.done():
+                running.append(app_context.pool.get_running_count())
+                await asyncio.sleep(0.01)
+            return future.result()
+
+        self.assertEqual(asyncio.get_event_loop().run_until_complete(run()), [11, None])
+        # 4 divisions run in parallel workers
+        self.assertEqual(max(running), 4)
+        self.assertEqual(app_context.stored_results.get_stats()['subtree_values']['items'], 5)
+
+    def test_async_evaluation(self):
+        proc.DELAY = 0.5
+        proc.PARALLEL_PARTS = 4
+        proc.ASYNC_EVALUATION = 1
+        # pool without workers, expressions are compiled in request and calculated in event loop
+        app_context.pool = WorkerPool(0)
+        expressions = ['%s/2 + (4/2 - 1/1)' % i for i in range(1, 101)] + ['1 + 1/0']
+        for expression in expressions:
+            self.assertEqual(proc.calculate_inline(expression)[0], False)
+
+        async def run_all():
+            return await asyncio.gather(*[self.calculate(expression) for expression in expressions])
+
+        start_time = time.time()
+        results = asyncio.get_event_loop().run_until_complete(run_all())
+        # 301 slow operations by 0.5 seconds would take 150 seconds one by one
+        self.assertLess(time.time() - start_time, 30)
+        self.assertEqual(results[:2], [[1.5, None], [2, None]])
+        self.assertEqual(results[-1][0], None)
+        self.assertIn('error in calculating', results[-1][1])
+
+
+class TestScheduler(TestCase):
+    def pop_all(self, scheduler):
+        jobs = []
+        while len(scheduler):
+            jobs.append(scheduler.pop())
+        return jobs
+
+    def test_shortest_first(self):
+        scheduler = Scheduler(aging=0)
+        for job, cost in [['long', 100], ['short', 1], ['middle', 10]]:
+            scheduler.push(job, job, cost)
+        scheduler.push_first('first', 'first')
+        self.assertEqual(scheduler.get_position('short'), 1)
+        self.assertEqual(scheduler.get_position('long'), 3)
+        self.assertEqual(scheduler.get_position('other'), None)
+        self.assertEqual(self.pop_all(scheduler), ['first', 'short', 'middle', 'long'])
+        self.assertEqual(scheduler.pop(), None)
+
+    def test_fair_share(self):
+        scheduler = Scheduler(aging=0)
+        for i in range(3):
+            scheduler.push('a%s' % i, 'a%s' % i, 100, 'a')
+        for i in range(3):
+            scheduler.push('b%s' % i, 'b%s' % i, 1, 'b')
+        positions = [scheduler.get_position(job) for job in ['a0', 'a1', 'a2', 'b0', 'b1', 'b2']]
+        jobs = self.pop_all(scheduler)
+        self.assertEqual(jobs, ['a0', 'b0', 'b1', 'b2', 'a1', 'a2'])
+        self.assertEqual(positions, [jobs.index(job) for job in ['a0', 'a1', 'a2', 'b0', 'b1', 'b2']])
+        # new client doesn't get credit for time it was idle
+        scheduler.push('a3', 'a3', 100, 'a')
+        scheduler.pop()
+        scheduler.push('a4', 'a4', 100, 'a')
+        scheduler.push('c0', 'c0', 100, 'c')
+        self.assertEqual(self.pop_all(scheduler), ['a4', 'c0'])
+
+    def test_aging(self):
+        scheduler = Scheduler(aging=1000)
+        scheduler.push('long', 'long', 10)
+        time.sleep(0.02)
+        scheduler.push('short', 'short', 1)
+        self.assertEqual(self.pop_all(scheduler), ['long', 'short'])
+
+    def test_remove(self):
+        scheduler = Scheduler(aging=0)
+        for job, cost, client in [['a', 1, 'x'], ['b', 2, 'x'], ['c', 3, 'y']]:
+            scheduler.push(job, job, cost, client)
+        scheduler.push_first('d', 'd')
+        self.assertEqual(scheduler.get_position('c'), 2)
+        self.assertTrue(scheduler.remove('a'))
+        self.assertTrue(scheduler.remove('d'))
+        self.assertFalse(scheduler.remove('a'))
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(scheduler.get_position('c'), 1)
+        self.assertEqual(self.pop_all(scheduler), ['b', 'c'])
+
+
+class TestMetrics(TestCase):
+    def test_export(self):
+        registry = Registry()
+        counter = registry.add(Counter('test_total', 'Count of tests.'))
+        histogram = registry.add(Histogram('test_seconds', 'Time of tests.', [1, 0.1]))
+        counter.inc()
+        counter.inc(2)
+        for value in [0.05, 0.1, 0.5, 7]:
+            histogram.observe(value)
+        self.assertEqual(registry.export(), '\n'.join([
+            '# HELP test_total Count of tests.',
+            '# TYPE test_total counter',
+            'test_total 3',
+            '# HELP test_seconds Time of tests.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 7.65',
+            'test_seconds_count 4']) + '\n')
+
+    def test_worker_observations(self):
+        # histograms observed in worker processes are merged to parent after each job
+        count = metrics.EVALUATION_SECONDS.count
+        wait_count = metrics.QUEUE_WAIT_SECONDS.count
+        pool = WorkerPool(1)
+
+        async def run():
+            return await asyncio.gather(*[pool.submit(process_func, None, i, '%s*3+1' % i) for i in range(3)])
+
+        asyncio.get_event_loop().run_until_complete(run())
+        pool.shutdown()
+        self.assertEqual(metrics.EVALUATION_SECONDS.count, count + 3)
+        self.assertEqual(metrics.QUEUE_WAIT_SECONDS.count, wait_count + 3)
+        observations = Registry().drain()
+        self.assertEqual(observations, [])
+
+
+class TestLogs(TestCase):
+    def test_logger(self):
+        class Arg:
+            formatted = 0
+
+            def __str__(self):
+                Arg.formatted += 1
+                return 'arg'
+
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'log.txt')
+            logger = Logger(ErrorLvls.WARN, path, sample=2)
+            logger.log('info %s', ErrorLvls.INFO, 'test', (Arg(),))
+            self.assertEqual(Arg.formatted, 0)         # dropped message isn't formatted
+            logger = Logger(ErrorLvls.INFO, path, sample=2)
+            for i in range(4):
+                logger.log('info %s %s', ErrorLvls.INFO, 'test', (i, Arg()))
+            logger.log('error %s', ErrorLvls.ERR, 'test', (Arg(),))
+            self.assertEqual(Arg.formatted, 3)         # each 2nd INFO message and all errors
+            logger.close()
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual([line.split(' ', 2)[2] for line in lines],
+                             ['[INFO] in test: info 1 arg', '[INFO] in test: info 3 arg', '[ERR] in test: error arg'])
+
+    def test_rotation(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'log.txt')
+            writer = LogWriter(path, max_bytes=100, backups=2)
+            for i in range(5):
+                writer.write(['%s' % i * 60, '\n'])
+            writer.close()
+            self.assertEqual(sorted(os.listdir(os.path.dirname(path))), ['log.txt', 'log.txt.1', 'log.txt.2'])
+            with open(path) as f:
+                self.assertEqual(f.read(), '4' * 60 + '\n')
+            with open(path + '.2') as f:
+                self.assertEqual(f.read(), '2' * 60 + '\n')
+
+    def test_writer_process(self):
+        # messages of workers are sent to writer process in batches
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'log.txt')
+            logger = Logger(ErrorLvls.INFO, path)
+            default_logger = logs.logger
+            logs.logger = proc.logger = logger
+            try:
+                logger.start()
+                pool = WorkerPool(1)
+
+                async def run():
+                    return await pool.submit(process_func, None, 7, '2*2')
+
+                res, err, program, values = asyncio.get_event_loop().run_until_complete(run())
+                pool.shutdown()
+                logger.log('server %s', ErrorLvls.INFO, '', (1,))
+                logger.close()
+            finally:
+                logs.logger = proc.logger = default_logger
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual([line.split(' ', 3)[3] for line in lines[-2:]],
+                             ['in run_program(): pid=7 res=4.0', 'server 1'])
+            self.assertNotEqual(lines[-2].split(' ')[1], lines[-1].split(' ')[1])     # pids of processes
+
+
+class TestSharedData(TestCase):
+    def test_bounded_cache(self):
+        cache = BoundedCache(max_items=3, max_bytes=0, ttl=0)
+        for i in range(5):
+            cache.set(i, i)
+        self.assertEqual(cache.get(2), 2)
+        cache.set(5, 5)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get(0), None)
+        self.assertEqual(cache.get(2), 2)          # recently used isn't evicted
+        self.assertEqual(cache.get(3), None)
+        self.assertEqual(cache.evictions, 3)
+
+        cache = BoundedCache(max_items=0, max_bytes=1000, ttl=0)
+        for i in range(100):
+            cache.set(i, 'x' * 100)
+        self.assertLess(cache.get_stats()['bytes'], 1000)
+
+        cache = BoundedCache(ttl=0.05)
+        cache.set('a', 1)
+        time.sleep(0.1)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.expirations, 1)
+
+    def test_shared_data(self):
+        shared_data = SharedData(max_items=2)
+        for i in range(3):
+            expr = '%s+1' % i
+            pid = shared_data.add_processing(expr)
+            shared_data.add_result(i + 1, pid, expr)
+        self.assertEqual(shared_data.get_cached('0+1'), None)
+        self.assertEqual(shared_data.get_cached('2+1'), 3)
+        stats = shared_data.get_stats()
+        self.assertEqual(stats['results']['evictions'], 1)
+        self.assertEqual(stats['calculated_expressions']['hits'], 1)
+
+    def test_listeners(self):
+        shared_data = SharedData()
+        done = []
+        pid = shared_data.add_processing('1/0')
+        other_pid = shared_data.add_processing('2/1')
+        shared_data.add_listener(pid, done.append)
+        shared_data.add_listener(other_pid, done.append)
+        shared_data.remove_listener(other_pid, done.append)
+        # job isn't processing
+        shared_data.add_listener(22200, done.append)
+        shared_data.add_error('error in calculating', pid, '1/0')
+        shared_data.add_result(2, other_pid, '2/1')
+        self.assertEqual(done, [pid])
+
+    def test_storage(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            path = os.path.join(dir_name, 'calc.db')
+            shared_data = SharedData(storage=SqliteStorage(path))
+            pid = shared_data.add_processing('1/2')
+            shared_data.add_result(0.5, pid, '1/2')
+            pid = shared_data.add_processing('1/0')
+            shared_data.add_error('error in calculating', pid, '1/0')
+            shared_data.add_processing('2/3')           # isn't finished before restart
+            shared_data.close()
+
+            shared_data = SharedData(storage=SqliteStorage(path))
+            self.assertEqual(shared_data.get_cached('1/2'), 0.5)
+            self.assertEqual(shared_data.get_result(0), 0.5)
+            self.assertTrue(shared_data.get_error(1).startswith('ERROR: error in calculating'))
+            self.assertTrue(shared_data.is_invalid('1/0'))
+            self.assertEqual(shared_data.add_processing('2/3'), PID_BLOCK)
+            shared_data.close()
+
+
+class TestBackend(TestCase):
+    def setUp(self):
+        self.job_ttl = backends.JOB_TTL
+        backends.JOB_TTL = 10
+        self.now = [0]
+        self.backend = self.make_backend()
+
+    def tearDown(self):
+        backends.JOB_TTL = self.job_ttl
+
+    def make_backend(self):
+        return MemoryBackend(clock=lambda: self.now[0])
+
+    def wait(self, seconds):
+        self.now[0] += seconds
+
+    def test_shared_data(self):
+        # two servers with one backend
+        server = SharedData(backend=self.backend)
+        other_server = SharedData(backend=self.backend)
+        pid = server.add_processing('1 / 1')
+        other_pid = other_server.add_processing('2 / 1')
+        self.assertNotEqual(pid, other_pid)
+        self.assertEqual(other_server.add_processing('1 / 1'), pid)          # expression is calculated once
+        self.assertFalse(other_server.is_own(pid))
+        self.assertEqual(other_server.get_processing('1 / 1'), pid)
+        self.assertTrue(other_server.is_processing(pid))
+        done = []
+        other_server.add_listener(pid, done.append)
+        server.add_result(1, pid, '1 / 1')
+        self.assertEqual(other_server.check_backend(), [])
+        self.assertEqual(done, [pid])
+        self.assertEqual(other_server.get_result(pid), 1)
+        self.assertEqual(other_server.get_cached('1 / 1'), 1)
+        # job is cancelled by other server
+        server.add_cancelled('cancelled', other_pid)
+        self.assertEqual(other_server.check_backend(), [other_pid])
+        self.assertEqual(other_server.get_cancelled(other_pid), 'cancelled')
+        self.assertEqual(self.backend.get_processing('2 / 1'), None)
+
+    def test_job_ttl(self):
+        backend = self.backend
+        pid = backend.claim('1 / 1', backend.next_pid())
+        stopped_pid = backend.claim('2 / 1', backend.next_pid())
+        # claim of running job lives while job is refreshed
+        for i in range(3):
+            self.wait(6)
+            self.assertEqual(backend.refresh_processing([pid, 22200]), {pid})
+        self.assertEqual(backend.get_processing('1 / 1'), pid)
+        self.assertEqual(backend.claim('1 / 1', backend.next_pid()), pid)
+        # job of stopped server expires
+        self.assertEqual(backend.get_processing('2 / 1'), None)
+        self.assertEqual(backend.get_processing_pids([pid, stopped_pid]), {pid})
+        self.assertEqual(backend.refresh_processing([stopped_pid]), set())
+        self.assertNotEqual(backend.claim('2 / 1', backend.next_pid()), stopped_pid)
+        # without refresh claim of running job expires too
+        self.wait(11)
+        self.assertEqual(backend.get_processing('1 / 1'), None)
+
+    def test_release(self):
+        backend = self.backend
+        pid = backend.claim('1 / 1', backend.next_pid())
+        backend.set_result(pid, '1 / 1', 1)
+        self.assertEqual(backend.get_processing('1 / 1'), None)
+        self.assertEqual(backend.get_processing_pids([pid]), set())
+        self.assertEqual(backend.get_result(pid), 1)
+        self.assertEqual(backend.get_cached('1 / 1'), 1)
+        # finished expression is claimed by new job
+        new_pid = backend.claim('1 / 1', backend.next_pid())
+        self.assertNotEqual(new_pid, pid)
+        # job of expired claim doesn't release claim of other job
+        error_pid = backend.claim('1 / 0', backend.next_pid())
+        self.wait(11)
+        other_pid = backend.claim('1 / 0', backend.next_pid())
+        backend.set_error(error_pid, '1 / 0', 'ERROR: error in calculating')
+        self.assertEqual(backend.get_error(error_pid), 'ERROR: error in calculating')
+        self.assertEqual(backend.get_processing('1 / 0'), other_pid)
+        # cancelled job without known expression releases its claim too
+        backend.set_cancelled(other_pid, 'timeout')
+        self.assertEqual(backend.get_cancelled(other_pid), 'timeout')
+        self.assertEqual(backend.get_processing('1 / 0'), None)
+
+    def test_jobs(self):
+        backend = self.backend
+        backend.push_job(1, '1 / 1')
+        backend.push_job(2, '2 / 1')
+        self.assertEqual(backend.pop_job(), [1, '1 / 1'])
+        self.assertEqual(backend.pop_job(), [2, '2 / 1'])
+        self.assertEqual(backend.pop_job(), None)
+
+    def test_evaluator(self):
+        delay, remote_evaluators, inline_budget = proc.DELAY, proc.REMOTE_EVALUATORS, proc.INLINE_BUDGET
+        proc.DELAY, proc.REMOTE_EVALUATORS, proc.INLINE_BUDGET = 0, 1, 0
+        stored_results, pool = app_context.stored_results, app_context.pool
+        backend = self.backend
+        app_context.stored_results = SharedData(backend=backend)
+        app_context.pool = WorkerPool(0)
+        try:
+            pid = client.post('/calculate', json={'expression': '6 / 2'}).json()['ret']
+            invalid_pid = client.post('/calculate', json={'expression': '6 / 0'}).json()['ret']
+            self.assertEqual(client.get('/result?id=%s' % pid).json()['ret'], 'processing soon...')
+            self.assertEqual(run_evaluator(backend, 10), 2)
+            proc.check_backend()
+            self.assertFalse(app_context.stored_results.is_own(pid))
+            self.assertEqual(client.get('/result?id=%s' % pid).json(), {'ret': 3, 'status': 'ok'})
+            self.assertEqual(client.get('/result?id=%s' % invalid_pid).json()['status'], 'Nok')
+            # text of streamed expression isn't kept, so it's calculated by pool of server
+            stream_pid = client.post('/calculate/stream', content=b'8 / 2').json()['ret']
+            self.assertEqual(backend.pop_job(), None)
+            self.assertEqual(app_context.pool.get_queue_size(), 1)
+            self.assertTrue(app_context.stored_results.is_own(stream_pid))
+        finally:
+            proc.DELAY, proc.REMOTE_EVALUATORS, proc.INLINE_BUDGET = delay, remote_evaluators, inline_budget
+            app_context.pool.shutdown()
+            app_context.stored_results, app_context.pool = stored_results, pool
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestRedisBackend(TestBackend):
+    '''
+    tests of TestBackend with RedisBackend on fakeredis, time of Redis is moved by patch of time.time
+    '''
+
+    def make_backend(self):
+        real_time = time.time
+        patcher = mock.patch('time.time', side_effect=lambda: real_time() + self.now[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return RedisBackend('redis://localhost', client=fakeredis.FakeRedis())
+
+
 class TestMain(TestCase):
     # input: string with math expression, containing () /* +- and integers(not supporting floats and float delimiter)
     # start parsing and calculating math expression
     def setUp(self):
         loop = asyncio.get_event_loop()
         loop.run_until_complete(startup_event())
+        # pool without workers keeps jobs in queue, so status of job is checked without race
+        app_context.pool.shutdown()
+        app_context.pool = WorkerPool(0)
+        self.settings = [proc.INLINE_BUDGET, proc.DELAY]
+        proc.INLINE_BUDGET = 0
+
+    def tearDown(self):
+        proc.INLINE_BUDGET, proc.DELAY = self.settings
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(shutdown_event())
 
     def send_post(self, expr_str):
         response = client.post(
@@ -87,7 +885,7 @@ class TestMain(TestCase):
         for invalid_expr in invalid_exprs:
             ret = self.send_post(invalid_expr)
             assert ret.status_code == 200
-            self.assertTrue(re.match('{"ret":[0-9]+,"status":"ok"}', ret.text) != None)
+            self.assertTrue(re.match(r'{"ret":([0-9]+),"status":"ok","pid":\1}$', ret.text) != None)
 
     def test_correct_work(self):
         # correct expression
@@ -101,13 +899,231 @@ class TestMain(TestCase):
         for valid_expr in valid_exprs:
             ret = self.send_post(valid_expr)
             assert ret.status_code == 200
-            self.assertTrue(re.match('{"ret":[0-9]+,"status":"ok"}', ret.text) != None)
+            self.assertTrue(re.match(r'{"ret":([0-9]+),"status":"ok","pid":\1}$', ret.text) != None)
             pid = int(ret.json()['ret'])
 
             print('\nstart process with pid = %s\n' % pid)
 
             ret = self.get(pid)
-            self.assertEqual(ret.text, '{"ret":"processing soon...","status":"ok"}')
+            self.assertTrue(re.match('{"ret":"processing soon...","status":"ok","queue_position":[0-9]+}$', ret.text))
 
             ret = self.get(22200)
             self.assertEqual(ret.text, '{"ret":"not found","status":"Nok"}')
+
+    def test_queue_position(self):
+        pids = []
+        for expr, client_id in [['2*3*4*5*6*7*8', 'a'], ['9*9*9*9*9*9*9', 'a'], ['1+2', 'b']]:
+            ret = client.post('/calculate', json={'expression': expr}, headers={'X-Client-Id': client_id})
+            pids.append(ret.json()['ret'])
+        positions = [self.get(pid).json()['queue_position'] for pid in pids]
+        # short job of other client goes before the second job of the first client
+        self.assertEqual(positions, [0, 2, 1])
+
+    def test_busy(self):
+        app_context.pool = WorkerPool(0, 2)
+        for expr in ['1+1', '2+1']:
+            ret = self.send_post(expr)
+            self.assertTrue(re.match(r'{"ret":([0-9]+),"status":"ok","pid":\1}$', ret.text) != None)
+        ret = self.send_post('3+1')
+        self.assertEqual(ret.status_code, 503)
+        self.assertEqual(ret.json()['status'], 'Nok')
+        # expression in processing doesn't need a place in queue
+        ret = self.send_post('1+1')
+        self.assertEqual(ret.status_code, 200)
+
+    def test_inline(self):
+        proc.INLINE_BUDGET = 1
+        ret = self.send_post('(((8 + 12)))')
+        self.assertEqual(ret.json(), {'ret': 20, 'status': 'ok'})
+        ret = self.send_post('(1 + 2')
+        self.assertEqual(ret.json()['status'], 'Nok')
+        ret = self.send_post('(1 + 2')
+        self.assertEqual(ret.text, '{"ret":"invalid expression","status":"Nok"}')
+        # zero is a result, not an error
+        for expr in ['1-1', '2*0', '1-1']:
+            self.assertEqual(self.send_post(expr).json(), {'ret': 0, 'status': 'ok'})
+        # slow division doesn't fit to budget
+        ret = self.send_post('10 / 2')
+        self.assertTrue(re.match(r'{"ret":([0-9]+),"status":"ok","pid":\1}$', ret.text) != None)
+
+    def test_stream(self):
+        proc.INLINE_BUDGET = 1
+
+        def post_chunks(chunks):
+            return client.post('/calculate/stream', content=(chunk.encode() for chunk in chunks))
+
+        # number 12 is split between chunks
+        ret = post_chunks(['(((8 + 1', '2)', '))'])
+        self.assertEqual(ret.json(), {'ret': 20, 'status': 'ok'})
+        ret = post_chunks(['1 + 2 ', ') * 3', '4'])
+        self.assertEqual(ret.json(), {'ret': 'invalid expression: close bracket without open bracket',
+                                      'status': 'Nok'})
+        ret = post_chunks(['1 + 2 -'])
+        self.assertEqual(ret.json()['status'], 'Nok')
+        ret = post_chunks(['10 / ', '2'])
+        self.assertTrue(re.match(r'{"ret":([0-9]+),"status":"ok","pid":\1}$', ret.text) != None)
+        self.assertEqual(post_chunks(['10 / 2']).json(), ret.json())
+
+    def test_batch(self):
+        proc.INLINE_BUDGET = 1
+        app_context.pool = WorkerPool(0, 2)
+        ret = client.post('/calculate/batch', json={'expressions': ['1+1', '(1', '10/2', '10/2', '9/3', '8/4', '2*3']})
+        self.assertEqual(ret.json()['status'], 'ok')
+        results = ret.json()['ret']
+        self.assertEqual(results[0], {'ret': 2, 'status': 'ok'})
+        self.assertEqual(results[1]['status'], 'Nok')
+        # repeated expression gets the same pid
+        pid = results[2]['pid']
+        self.assertEqual(results[3], {'ret': pid, 'status': 'ok', 'pid': pid})
+        self.assertEqual(results[5], {'ret': 'server is busy, try later', 'status': 'Nok'})
+        self.assertEqual(results[6], {'ret': 6, 'status': 'ok'})
+        ret = client.get('/results?ids=%s,22200' % pid)
+        self.assertEqual(ret.json()['ret'], [{'ret': 'processing soon...', 'status': 'ok', 'queue_position': 0},
+                                             {'ret': 'not found', 'status': 'Nok'}])
+        ret = client.get('/results?ids=1,x')
+        self.assertEqual(ret.json()['status'], 'Nok')
+
+    def test_long_literal(self):
+        optimize = proc.OPTIMIZE
+        proc.OPTIMIZE = 1
+        proc.INLINE_BUDGET = 1
+        try:
+            ret = self.send_post('1 + ' + '9' * 5000)
+            self.assertEqual(ret.json(), {'ret': 'invalid expression: error in parsing', 'status': 'Nok'})
+        finally:
+            proc.OPTIMIZE = optimize
+
+    def test_zero_result(self):
+        proc.DELAY = 0
+        with TestClient(app) as loop_client:
+            app_context.pool.shutdown()
+            app_context.pool = WorkerPool(1)
+            pid = loop_client.post('/calculate', json={'expression': '2/2-1'}).json()['ret']
+            self.assertEqual(loop_client.get('/result?id=%s&wait=5' % pid).json(), {'ret': 0, 'status': 'ok'})
+            self.assertEqual(loop_client.get('/results?ids=%s' % pid).json()['ret'], [{'ret': 0, 'status': 'ok'}])
+            # cached zero is returned instead of new job
+            ret = loop_client.post('/calculate', json={'expression': '2/2-1'})
+            self.assertEqual(ret.json(), {'ret': 0, 'status': 'ok'})
+
+    def test_long_poll(self):
+        proc.DELAY = 0.3
+        # client in context runs all requests in one event loop, so jobs are calculated between requests
+        with TestClient(app) as loop_client:
+            pid = loop_client.post('/calculate', json={'expression': '10 / 2'}).json()['ret']
+            other_pid = loop_client.post('/calculate', json={'expression': '(9 / 3)'}).json()['ret']
+            ret = loop_client.get('/result?id=%s&wait=0.01' % pid)
+            self.assertEqual(ret.json()['ret'], 'processing soon...')
+            ret = loop_client.get('/result?id=%s&wait=10' % pid)
+            self.assertEqual(ret.json(), {'ret': 5, 'status': 'ok'})
+            ret = loop_client.get('/results/stream?ids=%s,%s,22200' % (pid, other_pid))
+            self.assertEqual(ret.headers['content-type'].split(';')[0], 'text/event-stream')
+            events = [json.loads(line[len('data: '):]) for line in ret.text.split('\n') if line.startswith('data: ')]
+            self.assertEqual(sorted(events, key=lambda event: event['id']), [
+                {'id': pid, 'ret': 5, 'status': 'ok'},
+                {'id': other_pid, 'ret': 3, 'status': 'ok'},
+                {'id': 22200, 'ret': 'not found', 'status': 'Nok'}])
+
+    def test_progress(self):
+        proc.DELAY = 0.2
+        with TestClient(app) as loop_client:
+            app_context.pool.shutdown()
+            app_context.pool = WorkerPool(1)
+            pid = loop_client.post('/calculate', json={'expression': '1/1 + 2/1 + 3/1 + 4/1 + 5/1'}).json()['ret']
+            progress = None
+            while progress is None:
+                ret = loop_client.get('/result?id=%s&wait=0.05' % pid).json()
+                self.assertEqual(ret['ret'], 'processing soon...')
+                progress = ret.get('progress')
+            self.assertLess(progress['percent'], 100)
+            self.assertLessEqual(progress['seconds_left'], 1)
+            self.assertGreater(progress['finish_time'], time.time())
+            ret = loop_client.get('/result?id=%s&wait=10' % pid).json()
+            self.assertEqual(ret, {'ret': 15, 'status': 'ok'})
+
+    def test_template(self):
+        proc.DELAY = 0
+        with TestClient(app) as loop_client:
+            app_context.pool.shutdown()
+            app_context.pool = WorkerPool(1)
+            ret = loop_client.post('/calculate/template',
+                                   json={'expression': '(x + 1) / y', 'bindings': {'x': [1, 2, 3], 'y': [2, 0, 4]}})
+            self.assertEqual(ret.json(), {'ret': [1, None, 1], 'status': 'ok'})
+            ret = loop_client.post('/calculate/template', json={'expression': 'x / y', 'bindings': {'x': [1]}})
+            self.assertEqual(ret.json(), {'ret': 'values of variables y are expected', 'status': 'Nok'})
+            ret = loop_client.post('/calculate/template',
+                                   json={'expression': 'x / y', 'bindings': {'x': [1], 'y': [1, 2]}})
+            self.assertEqual(ret.json()['status'], 'Nok')
+            ret = loop_client.post('/calculate/template', json={'expression': 'x +', 'bindings': {'x': [1]}})
+            self.assertEqual(ret.json()['status'], 'Nok')
+            # int of too long literal isn't converted
+            ret = loop_client.post('/calculate/template', json={'expression': '9' * 5000 + '+x', 'bindings': {'x': [1]}})
+            self.assertEqual(ret.json(), {'ret': 'invalid expression: error in parsing', 'status': 'Nok'})
+
+    def test_trace(self):
+        proc.DELAY = 0
+        with TestClient(app) as loop_client:
+            app_context.pool.shutdown()
+            app_context.pool = WorkerPool(1)
+            pid = loop_client.post('/calculate', json={'expression': '6 / 2 + 1'}).json()['ret']
+            ret = loop_client.get('/result?id=%s&wait=10&trace=1' % pid).json()
+            self.assertEqual(ret['ret'], 4)
+            self.assertEqual([event['event'] for event in ret['trace']],
+                             ['submit', 'worker start', 'parse end', 'compile end', 'evaluate end', 'result stored'])
+            self.assertEqual(ret['trace'][0]['seconds'], 0)
+            self.assertTrue(all(event['seconds'] >= 0 for event in ret['trace']))
+            trace = loop_client.get('/traces?ids=%s' % pid).json()
+            phases = [event['name'] for event in trace['traceEvents'] if event['ph'] == 'X']
+            self.assertEqual(phases, ['queue wait', 'parse', 'compile', 'evaluate', 'return'])
+            self.assertNotIn('trace', loop_client.get('/result?id=%s' % pid).json())
+
+    def test_cancel(self):
+        proc.DELAY = 5
+        with TestClient(app) as loop_client:
+            app_context.pool.shutdown()
+            app_context.pool = WorkerPool(1)
+            worker_pid = app_context.pool._workers[0].process.pid
+            pid = loop_client.post('/calculate', json={'expression': '10 / 2'}).json()['ret']
+            queued_pid = loop_client.post('/calculate', json={'expression': '9 / 3'}).json()['ret']
+            timeout_pid = loop_client.post('/calculate', json={'expression': '8 / 2', 'timeout': 0.2}).json()['ret']
+            self.assertEqual(app_context.pool.get_queue_size(), 2)
+            ret = loop_client.delete('/result?id=%s' % queued_pid)
+            self.assertEqual(ret.json(), {'ret': 'cancelled', 'status': 'ok'})
+            self.assertEqual(app_context.pool.get_queue_size(), 1)
+            # running job is stopped and its worker is replaced
+            start_time = time.time()
+            loop_client.delete('/result?id=%s' % pid)
+            ret = loop_client.get('/result?id=%s&wait=1' % timeout_pid)
+            self.assertEqual(ret.json(), {'ret': 'calculation is stopped', 'status': 'timeout'})
+            # stopped job doesn't wait for its slow operation
+            self.assertLess(time.time() - start_time, proc.DELAY)
+            self.assertNotEqual(app_context.pool._workers[0].process.pid, worker_pid)
+            ret = loop_client.get('/result?id=%s' % pid)
+            self.assertEqual(ret.json(), {'ret': 'calculation is stopped', 'status': 'cancelled'})
+            ret = loop_client.delete('/result?id=%s' % pid)
+            self.assertEqual(ret.json()['status'], 'Nok')
+            # cancelled expression can be calculated again
+            ret = loop_client.post('/calculate', json={'expression': '10 / 2'})
+            self.assertNotEqual(ret.json()['ret'], pid)
+
+    def test_metrics(self):
+        hits = metrics.CACHE_HITS.value
+        invalid_hits = metrics.INVALID_HITS.value
+        app_context.stored_results.add_result(3, app_context.stored_results.add_processing('1 + 2'), '1 + 2')
+        app_context.stored_results.add_invalid('1 +')
+        self.send_post('1 + 2')
+        self.send_post('1 +')
+        self.send_post('2 / 2')
+        ret = client.get('/metrics')
+        self.assertTrue(ret.headers['content-type'].startswith('text/plain'))
+        values = dict(line.rsplit(' ', 1) for line in ret.text.splitlines() if not line.startswith('#'))
+        self.assertEqual(values['calc_queue_depth'], '1')
+        self.assertEqual(values['calc_jobs_in_flight'], '0')
+        self.assertEqual(values['calc_processing_expressions'], '1')
+        self.assertEqual(float(values['calc_cache_hits_total']), hits + 1)
+        self.assertEqual(float(values['calc_invalid_cache_hits_total']), invalid_hits + 1)
+        self.assertIn('calc_queue_wait_seconds_bucket{le="+Inf"}', values)
+
+    def test_stats(self):
+        ret = client.get('/stats')
+        self.assertEqual(ret.json()['status'], 'ok')
+        self.assertEqual(ret.json()['ret']['results']['items'], 0)